@@ -19,9 +19,13 @@ setup(name='TomBot',
       install_requires=[
           'requests',
           'websocket-client',
-          'future'
+          'future',
+          'numpy'
       ],
-      packages=['tom_bot', 'tom_bot.auth', 'tom_bot.utils', 'tom_bot.ws'],
+      extras_require={
+          'asyncio': ['websockets']
+      },
+      packages=['tom_bot', 'tom_bot.auth', 'tom_bot.utils', 'tom_bot.ws', 'tom_bot.rest', 'tom_bot.sim'],
       entry_points={
           'console_scripts': ['tombot = tom_bot:run']
       }
@@ -0,0 +1,123 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from types import SimpleNamespace
+
+import requests
+
+# tom_bot.settings reads ./settings.py; without one, run with the defaults (what `tombot setup` copies there)
+if not os.path.isfile('settings.py'):
+    import tom_bot
+    os.chdir(tempfile.mkdtemp())
+    shutil.copyfile(os.path.join(os.path.dirname(tom_bot.__file__), '_settings_base.py'), 'settings.py')
+
+from tom_bot.auth.APIKeyAuthWithExpires import APIKeyAuthWithExpires
+from tom_bot.auth.APIKeyAuth import generate_signature
+from tom_bot.bitmex import BitMEX
+
+###
+# rest-sign-bench.py
+#
+# Cost of building a signed REST request (everything _curl_bitmex does before the network), old path vs new:
+#   old: a new auth object per call, requests.Request + session.prepare_request, the signature re-parsing
+#        the URL and re-encoding the secret, the body json.dumps'ed again for the log line
+#   new: BitMEX._prepare_request: auth keyed once, signed from the path as built, body serialized once,
+#        lazy logging; still prepared by the session
+# Logging runs at WARNING, so the request log line is off, as when LOG_LEVEL is above INFO.
+#
+# Usage (from the repository root, with the bot's dependencies installed; uses ./settings.py if there is one):
+#   PYTHONPATH=. python test/rest-sign-bench.py
+###
+
+BASE_URL = 'https://testnet.bitmex.com/api/v1/'
+API_KEY = 'CfwQ4SZ6gM_t6dIy1bCLJylX'
+API_SECRET = 'f9XOPLacPCZJ1dvPzN8B6Et7nMEaPGeomMSHk8Cr2zD4NfCY'
+N = 20000
+
+logger = logging.getLogger('bench')
+logger.setLevel(logging.WARNING)
+
+REQUESTS = [
+    ('POST', 'order/bulk', None, {'orders': [{'symbol': 'XBTUSD', 'orderQty': 100, 'price': 9000.5 + i,
+                                               'clOrdID': 'Buy trend%d abcdefgh' % i, 'ordType': 'Limit'}
+                                              for i in range(4)]}),
+    ('GET', 'execution/tradeHistory', {'symbol': 'XBTUSD', 'count': 20, 'reverse': 'true'}, None),
+    ('DELETE', 'order', None, {'orderID': '00000000-0000-0000-0000-000000000000'}),
+]
+
+
+class OldAuth(requests.auth.AuthBase):
+    # Copy of the old APIKeyAuthWithExpires.__call__
+    def __init__(self, apiKey, apiSecret):
+        self.apiKey = apiKey
+        self.apiSecret = apiSecret
+
+    def __call__(self, r):
+        expires = int(round(time.time()) + 5)
+        r.headers['api-expires'] = str(expires)
+        r.headers['api-key'] = self.apiKey
+        r.headers['api-signature'] = generate_signature(self.apiSecret, r.method, r.url, expires, r.body or '')
+        return r
+
+
+def make_session():
+    session = requests.Session()
+    session.headers.update({'user-agent': 'liquidbot-bench', 'content-type': 'application/json',
+                            'accept': 'application/json'})
+    return session
+
+
+def bench_old(session):
+    start = time.perf_counter()
+    for i in range(N):
+        verb, path, query, postdict = REQUESTS[i % len(REQUESTS)]
+        auth = OldAuth(API_KEY, API_SECRET)
+        logger.info("sending req to %s: %s" % (BASE_URL + path, json.dumps(postdict or query or '')))
+        req = requests.Request(verb, BASE_URL + path, json=postdict, auth=auth, params=query)
+        session.prepare_request(req)
+    return time.perf_counter() - start
+
+
+def bench_new(client):
+    start = time.perf_counter()
+    for i in range(N):
+        verb, path, query, postdict = REQUESTS[i % len(REQUESTS)]
+        prepped = client._prepare_request(verb, path, query, postdict)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("sending req to %s: %s", prepped.url, prepped.body)
+    return time.perf_counter() - start
+
+
+def rest_client(session):
+    # What _prepare_request uses of a BitMEX, without connecting its websocket
+    client = SimpleNamespace(session=session, auth=APIKeyAuthWithExpires(API_KEY, API_SECRET),
+                             origin='https://testnet.bitmex.com', base_path='/api/v1/')
+    client._prepare_request = lambda *args: BitMEX._prepare_request(client, *args)
+    return client
+
+
+def check(client):
+    # The new path signs exactly what it sends
+    for verb, path, query, postdict in REQUESTS:
+        prepped = client._prepare_request(verb, path, query, postdict)
+        expected = generate_signature(API_SECRET, verb, prepped.url, prepped.headers['api-expires'], prepped.body or '')
+        assert prepped.headers['api-signature'] == expected, (verb, path)
+
+
+def main():
+    session = make_session()
+    client = rest_client(session)
+    check(client)
+    old = bench_old(session)
+    new = bench_new(client)
+    print("%-6s %12s %12s" % ('', 'us/request', 'requests/s'))
+    print("%-6s %12.1f %12.0f" % ('old', old / N * 1e6, N / old))
+    print("%-6s %12.1f %12.0f" % ('new', new / N * 1e6, N / new))
+    print("speedup %.1fx" % (old / new))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import threading
+import time
+
+from tom_bot.rest.actions import OrderActionQueue
+from tom_bot.rest.coalesce import TickActions
+
+###
+# test_actions.py
+#
+# The order action queue and a tick's coalesced actions.
+# Run from the repository root: PYTHONPATH=. python -m pytest test
+###
+
+
+class FakeExchange(object):
+    '''Records when each bulk request starts and ends; cancels take a while, like a slow round trip.'''
+
+    def __init__(self, cancel_delay=0.05):
+        self.actions = OrderActionQueue()
+        self.cancel_delay = cancel_delay
+        self.lock = threading.Lock()
+        self.log = []
+
+    def __request(self, kind, orders, delay=0.0):
+        with self.lock:
+            self.log.append(('start', kind))
+        time.sleep(delay)
+        with self.lock:
+            self.log.append(('end', kind))
+        return orders
+
+    def submit_cancel(self, orders):
+        return self.actions.submit([o['orderID'] for o in orders], self.__request, 'cancel', orders,
+                                   self.cancel_delay)
+
+    def submit_amend(self, orders):
+        return self.actions.submit([o['orderID'] for o in orders], self.__request, 'amend', orders)
+
+    def submit_create(self, orders, after=()):
+        return self.actions.submit([o['clOrdID'] for o in orders], self.__request, 'create', orders, after=after)
+
+
+def order(orderID, clOrdID, price, side='Buy', qty=100, ordType='Limit'):
+    return {'orderID': orderID, 'clOrdID': clOrdID, 'price': price, 'side': side, 'orderQty': qty,
+            'leavesQty': qty, 'ordType': ordType}
+
+
+def test_creates_wait_for_cancels():
+    exchange = FakeExchange()
+    actions = TickActions([order('1', 'Buy support #aaaaaa', 100)])
+    actions.cancel([order('1', 'Buy support #aaaaaa', 100)])
+    actions.create([{'clOrdID': 'Sell resistance', 'price': 200, 'side': 'Sell', 'orderQty': 100,
+                     'ordType': 'Limit'}])
+    futures = actions.flush(exchange)
+    futures['create'].result(timeout=5)
+    assert exchange.log.index(('end', 'cancel')) < exchange.log.index(('start', 'create'))
+
+
+def test_creates_run_after_a_failed_cancel():
+    queue = OrderActionQueue()
+
+    def fail():
+        raise ValueError('cancel failed')
+    cancel = queue.submit(['1'], fail)
+    create = queue.submit(['Buy x'], lambda: 'created', after=[cancel])
+    assert create.result(timeout=5) == 'created'
+    assert isinstance(cancel.exception(), ValueError)
+
+
+def test_amend_after_cancel_is_dropped():
+    actions = TickActions([order('1', 'Buy support #aaaaaa', 100)])
+    actions.cancel([order('1', 'Buy support #aaaaaa', 100)])
+    actions.amend([{'orderID': '1', 'price': 101}])
+    cancels, amends, creates = actions.plan()
+    assert [o['orderID'] for o in cancels] == ['1'] and amends == [] and creates == []
+    assert actions.coalesced == 1
+
+
+def test_cancel_after_amend_drops_the_amend():
+    actions = TickActions([order('1', 'Buy support #aaaaaa', 100)])
+    actions.amend([{'orderID': '1', 'price': 101}])
+    actions.cancel([order('1', 'Buy support #aaaaaa', 100)])
+    cancels, amends, creates = actions.plan()
+    assert [o['orderID'] for o in cancels] == ['1'] and amends == []
+
+
+def test_amends_merge_and_unchanged_amends_drop():
+    actions = TickActions([order('1', 'Buy support #aaaaaa', 100)])
+    actions.amend([{'orderID': '1', 'price': 101}])
+    actions.amend([{'orderID': '1', 'orderQty': 50}])
+    assert actions.plan()[1] == [{'orderID': '1', 'price': 101, 'orderQty': 50}]
+    actions = TickActions([order('1', 'Buy support #aaaaaa', 100)])
+    actions.amend([{'orderID': '1', 'price': 100}])
+    assert actions.plan()[1] == [] and actions.coalesced == 1
+
+
+def test_cancel_and_create_of_the_same_order_become_an_amend():
+    actions = TickActions([order('1', 'Buy support #aaaaaa', 100)])
+    actions.cancel([order('1', 'Buy support #aaaaaa', 100)])
+    actions.create([{'clOrdID': 'Buy support', 'price': 102, 'side': 'Buy', 'orderQty': 100, 'ordType': 'Limit'}])
+    cancels, amends, creates = actions.plan()
+    assert cancels == [] and creates == []
+    assert amends == [{'orderID': '1', 'origClOrdID': 'Buy support #aaaaaa', 'ordType': 'Limit', 'side': 'Buy',
+                       'price': 102, 'orderQty': 100}]
+
+
+def test_queued_amend_runs_after_the_cancel_of_its_order():
+    exchange = FakeExchange()
+    cancel = exchange.submit_cancel([order('1', 'Buy support #aaaaaa', 100)])
+    amend = exchange.submit_amend([{'orderID': '1', 'price': 101}])
+    amend.result(timeout=5)
+    assert cancel.done()
+    assert exchange.log == [('start', 'cancel'), ('end', 'cancel'), ('start', 'amend'), ('end', 'amend')]
@@ -0,0 +1,67 @@
+from tom_bot.utils import clordid
+
+###
+# test_clordid.py
+#
+# Round trips through the clOrdID codec: key() -> with_nonce() -> decode().
+# Run from the repository root: PYTHONPATH=. python -m pytest test
+###
+
+
+def test_entry_round_trip():
+    key = clordid.key(clordid.ENTRY, 'lower_support_1', 'Buy')
+    assert key == 'Buy lower_support_1'
+    clOrdID = clordid.with_nonce(key)
+    tag = clordid.decode(clOrdID)
+    assert (tag.role, tag.side, tag.leg, tag.trend) == (clordid.ENTRY, 'Buy', None, 'lower_support_1')
+    assert tag.nonce.startswith(clordid.NONCE_MARK)
+    assert tag.key == key
+
+
+def test_stop_entry_and_sl():
+    tag = clordid.decode(clordid.with_nonce(clordid.key(clordid.STOP_ENTRY, 'breakout', 'Sell')))
+    assert (tag.role, tag.side, tag.trend) == (clordid.STOP_ENTRY, 'Sell', 'breakout')
+    tag = clordid.decode(clordid.with_nonce(clordid.key(clordid.SL, 'breakout')))
+    assert (tag.role, tag.side, tag.trend) == (clordid.SL, None, 'breakout')
+
+
+def test_tp_leg_with_and_without_nonce():
+    key = clordid.key(clordid.TP, 'trend', leg='qrt')
+    assert clordid.decode(key) == clordid.OrderTag(clordid.TP, None, 'qrt', 'trend', None)
+    tag = clordid.decode(clordid.with_nonce(key))
+    assert (tag.leg, tag.trend, tag.key) == ('qrt', 'trend', key)
+    # Without a leg, the nonce isn't mistaken for the trend
+    tag = clordid.decode(clordid.with_nonce(clordid.key(clordid.TP, 'trend')))
+    assert (tag.leg, tag.trend) == (None, 'trend')
+
+
+def test_unmarked_nonce():
+    # Nonces of orders placed before they were marked
+    assert clordid.decode('Buy trend AbCdEfGh') == clordid.OrderTag(clordid.ENTRY, 'Buy', None, 'trend', 'AbCdEfGh')
+    assert clordid.decode('Tp hl trend AbCdEfGh') == clordid.OrderTag(clordid.TP, None, 'hl', 'trend', 'AbCdEfGh')
+
+
+def test_not_ours():
+    for clOrdID in ('', None, 'mm_bitmex_abc', 'Buy', 'Buy a b c', 'manual order'):
+        assert clordid.decode(clOrdID) is None
+
+
+def test_long_trend_fits():
+    long_trend = 'higher_resistance_of_the_weekly_range_7'
+    for role, side, leg in ((clordid.ENTRY, 'Sell', None), (clordid.STOP_ENTRY, 'Sell', None),
+                            (clordid.TP, None, 'q3rt'), (clordid.SL, None, None)):
+        key = clordid.key(role, long_trend, side, leg)
+        clOrdID = clordid.with_nonce(key)
+        assert len(clOrdID) <= clordid.MAX_LEN
+        tag = clordid.decode(clOrdID)
+        assert tag.key == key
+        # The start and end of the name survive
+        assert tag.trend.startswith('higher') and tag.trend.endswith('_7')
+    # Different trends keep different keys
+    assert clordid.key(clordid.TP, long_trend + '1', leg='q3rt') != clordid.key(clordid.TP, long_trend + '2', leg='q3rt')
+
+
+def test_long_key_gets_shortened():
+    clOrdID = clordid.with_nonce('Tp q3rt ' + 'x' * 40)
+    assert len(clOrdID) <= clordid.MAX_LEN
+    assert clordid.decode(clOrdID).leg == 'q3rt'
@@ -0,0 +1,57 @@
+from tom_bot.utils import clordid
+from tom_bot.ws.fills import FillLedger
+
+###
+# test_fills.py
+#
+# The fill ledger: the window of fills kept per symbol and executions delivered again.
+# Run from the repository root: PYTHONPATH=. python -m pytest test
+###
+
+
+def fill(i, symbol='XBTUSD', clOrdID='', execType='Trade'):
+    return {'execID': 'e%04d' % i, 'symbol': symbol, 'execType': execType, 'clOrdID': clOrdID,
+            'timestamp': '2020-01-01T00:%02d:%02d.000Z' % (i // 60, i % 60)}
+
+
+class SmallLedger(FillLedger):
+    MAX_FILLS = 5
+    MAX_SEEN = 20
+
+
+def test_trims_to_the_newest_fills():
+    ledger = SmallLedger()
+    ledger.add([fill(i) for i in range(12)])
+    assert [f['execID'] for f in ledger.recent('XBTUSD', 10)] == ['e0011', 'e0010', 'e0009', 'e0008', 'e0007']
+    assert ledger.last('XBTUSD', tagged=False)['execID'] == 'e0011'
+
+
+def test_trimmed_fills_delivered_again_are_ignored():
+    ledger = SmallLedger()
+    ledger.add([fill(i) for i in range(12)])
+    ledger.add([fill(1), fill(11)])
+    assert ledger.last('XBTUSD', tagged=False)['execID'] == 'e0011'
+    assert len(ledger.recent('XBTUSD', 10)) == 5
+
+
+def test_seen_execids_are_capped():
+    ledger = SmallLedger()
+    ledger.add([fill(i) for i in range(50)])
+    assert len(ledger.seen) == 20
+    assert 'e0049' in ledger.seen and 'e0000' not in ledger.seen
+
+
+def test_symbols_and_exec_types():
+    ledger = SmallLedger()
+    ledger.add([fill(0), fill(1, symbol='ETHUSD'), fill(2, execType='Funding')])
+    assert [f['execID'] for f in ledger.recent('XBTUSD')] == ['e0000']
+    assert [f['execID'] for f in ledger.recent('ETHUSD')] == ['e0001']
+
+
+def test_entry_kept_past_the_window():
+    ledger = SmallLedger()
+    entry = clordid.with_nonce(clordid.key(clordid.ENTRY, 'trend', 'Buy'))
+    ledger.add([fill(0, clOrdID=entry)] + [fill(i) for i in range(1, 10)])
+    assert ledger.entry('XBTUSD')['execID'] == 'e0000'
+    assert ledger.last('XBTUSD')['execID'] == 'e0000'
+    assert [f['execID'] for f in ledger.since_entry('XBTUSD')] == ['e0005', 'e0006', 'e0007', 'e0008', 'e0009']
@@ -0,0 +1,76 @@
+from tom_bot.ws.orderbook import BookSide, OrderBook
+
+###
+# test_orderbook.py
+#
+# The L2 order book: partials, inserts, updates and deletes at and behind the touch.
+# Run from the repository root: PYTHONPATH=. python -m pytest test
+###
+
+
+def level(id, side, price, size):
+    return {'symbol': 'XBTUSD', 'id': id, 'side': side, 'price': price, 'size': size}
+
+
+def book():
+    book = OrderBook('XBTUSD', 0.5)
+    book.apply('partial', [level(1, 'Sell', 101.0, 30), level(2, 'Sell', 100.5, 10),
+                           level(3, 'Buy', 100.0, 20), level(4, 'Buy', 99.0, 40)])
+    return book
+
+
+def test_partial():
+    b = book()
+    assert b.best_bid() == (100.0, 20)
+    assert b.best_ask() == (100.5, 10)
+    assert b.depth(5) == {'bids': [(100.0, 20), (99.0, 40)], 'asks': [(100.5, 10), (101.0, 30)]}
+
+
+def test_updates_at_the_touch():
+    b = book()
+    # Updates and deletes only carry the level id
+    b.apply('update', [{'symbol': 'XBTUSD', 'id': 3, 'side': 'Buy', 'size': 25}])
+    assert b.best_bid() == (100.0, 25)
+
+    b.apply('insert', [level(5, 'Buy', 99.5, 5)])
+    assert b.best_bid() == (100.0, 25)  # behind the touch
+    b.apply('delete', [{'symbol': 'XBTUSD', 'id': 3, 'side': 'Buy'}])
+    assert b.best_bid() == (99.5, 5)
+
+    b.apply('delete', [{'symbol': 'XBTUSD', 'id': 2, 'side': 'Sell'}])
+    assert b.best_ask() == (101.0, 30)
+    b.apply('insert', [level(6, 'Sell', 100.0, 7)])
+    assert b.best_ask() == (100.0, 7)
+
+
+def test_update_of_an_unknown_level_is_ignored():
+    b = book()
+    b.apply('update', [{'symbol': 'XBTUSD', 'id': 99, 'side': 'Buy', 'size': 1}])
+    b.apply('delete', [{'symbol': 'XBTUSD', 'id': 99, 'side': 'Buy'}])
+    assert b.depth(5)['bids'] == [(100.0, 20), (99.0, 40)]
+
+
+def test_size_to_price():
+    b = book()
+    assert b.size_to_price('Sell', 100.5) == 10
+    assert b.size_to_price('Sell', 200.0) == 40
+    assert b.size_to_price('Sell', 100.0) == 0
+    assert b.size_to_price('Buy', 99.0) == 60
+
+
+def test_far_levels():
+    side = BookSide(is_bid=True)
+    side.MAX_TICKS = 64
+    side.INITIAL_TICKS = 16
+    side.set(1000, 1)
+    side.set(500, 2)         # too far from the touch for the array
+    assert len(side.sizes) <= 64 and side.far == {500: 2}
+    assert side.levels(5) == [(1000, 1), (500, 2)]
+    assert side.size_to(0) == 3
+    side.set(2000, 3)        # a new touch out of the array: the array follows it
+    assert side.levels(5) == [(2000, 3), (1000, 1), (500, 2)]
+    side.set(2000, 0)
+    side.set(1000, 0)
+    assert side.levels(5) == [(500, 2)]
+    side.set(500, 0)
+    assert side.levels(5) == []
@@ -0,0 +1,63 @@
+from tom_bot.rest.ratelimit import RateLimiter, TokenBucket
+
+###
+# test_ratelimit.py
+#
+# The client-side rate limit buckets: spending, refilling and the burst bucket for order requests.
+# Run from the repository root: PYTHONPATH=. python -m pytest test
+###
+
+
+def test_token_bucket_refills_at_its_rate():
+    bucket = TokenBucket(60, 60)
+    bucket.stamp = 1000.0
+    bucket.tokens = 0.0
+    assert bucket.wait() == 1.0
+    bucket.refill(1002.5)
+    assert bucket.tokens == 2.5 and bucket.wait() == 0
+    bucket.refill(1000.0)  # the clock going back doesn't take tokens away
+    assert bucket.tokens == 2.5
+    bucket.refill(2000.0)
+    assert bucket.tokens == 60  # never past capacity
+
+
+def test_acquire_spends_and_waits_for_the_refill():
+    limiter = RateLimiter(limit=3, burst=None)
+    assert all(limiter.acquire(block=False) for _ in range(3))
+    assert not limiter.acquire(block=False)
+    limiter.minute.stamp -= 20  # 20 seconds later: one token (3 per minute) has come back
+    assert limiter.acquire(block=False)
+    assert not limiter.acquire(block=False)
+    assert limiter.in_flight == 4
+
+
+def test_order_verbs_spend_the_burst_bucket():
+    limiter = RateLimiter(limit=120, burst=2)
+    assert limiter.acquire('POST', block=False) and limiter.acquire('DELETE', block=False)
+    assert not limiter.acquire('PUT', block=False)
+    assert limiter.acquire('GET', block=False)
+    limiter.burst.stamp -= 0.5  # half the burst period: one token back
+    assert limiter.acquire('PUT', block=False)
+
+
+class Response(object):
+    def __init__(self, status_code=200, **headers):
+        self.status_code = status_code
+        self.headers = {k.replace('_', '-'): str(v) for k, v in headers.items()}
+
+
+def test_update_takes_the_exchange_count_less_requests_in_flight():
+    limiter = RateLimiter(limit=120, burst=None)
+    limiter.acquire()
+    limiter.acquire()
+    limiter.update(Response(**{'X_RateLimit_Limit': 120, 'X_RateLimit_Remaining': 50}))
+    assert limiter.remaining() == 49  # one request still in flight
+
+
+def test_429_blocks_until_retry_after():
+    limiter = RateLimiter(limit=120, burst=None)
+    limiter.acquire()
+    limiter.update(Response(429, Retry_After=30))
+    assert limiter.remaining() == 0
+    assert 29 < limiter.blocked_for() <= 30
+    assert not limiter.acquire(block=False)
@@ -0,0 +1,59 @@
+from tom_bot.rest.retry import CircuitBreaker, RetryPolicy
+
+###
+# test_retry.py
+#
+# Retry budgets per verb and endpoint, backoff, and the circuit breaker.
+# Run from the repository root: PYTHONPATH=. python -m pytest test
+###
+
+
+def test_retry_budget_per_verb():
+    policy = RetryPolicy()
+    assert policy.attempts('GET', '/position') == 3
+    assert policy.attempts('DELETE', '/order') == 3
+    assert policy.attempts('POST', '/order/bulk') == 0
+    assert policy.attempts('PUT', '/order') == 0
+    assert policy.attempts('PATCH', '/order') == 0  # unknown verbs aren't retried
+
+
+def test_retry_budget_per_endpoint():
+    policy = RetryPolicy({'GET position': 1, 'POST order': 2})
+    assert policy.attempts('PUT', '/order/bulk') == 2
+    assert policy.attempts('GET', '/position') == 1
+    assert policy.attempts('GET', '/instrument') == 3
+    assert policy.attempts('POST', 'order') == 2
+    assert RetryPolicy().attempts('POST', 'order') == 0  # overrides don't leak into other policies
+
+
+def test_backoff_grows_with_jitter_and_a_cap():
+    policy = RetryPolicy(backoff=0.5, max_backoff=2)
+    for attempt, backoff in ((1, 0.5), (2, 1.0), (3, 2.0), (6, 2.0)):
+        delay = policy.delay(attempt)
+        assert backoff / 2 <= delay <= backoff
+
+
+def test_circuit_opens_after_failures_in_a_row():
+    breaker = CircuitBreaker(failures=3, cooldown=30)
+    breaker.failure()
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    breaker.failure()
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.is_open() and not breaker.allow()
+
+
+def test_circuit_lets_one_request_through_after_the_cooldown():
+    breaker = CircuitBreaker(failures=1, cooldown=30)
+    breaker.failure()
+    breaker.opened_at -= 30
+    assert breaker.allow()       # the test request
+    assert not breaker.allow()   # and nothing else while it is out
+    breaker.failure()
+    assert breaker.is_open() and breaker.trips == 2
+    breaker.opened_at -= 30
+    assert breaker.allow()
+    breaker.success()
+    assert not breaker.is_open() and breaker.allow()
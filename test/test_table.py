@@ -0,0 +1,69 @@
+from tom_bot.ws.table import Table
+
+###
+# test_table.py
+#
+# Realtime tables: partials, updates and deletes located by the table keys.
+# Run from the repository root: PYTHONPATH=. python -m pytest test
+###
+
+
+def order(orderID, price, leavesQty=100):
+    return {'orderID': orderID, 'symbol': 'XBTUSD', 'price': price, 'leavesQty': leavesQty}
+
+
+def test_partial_update_delete():
+    table = Table()
+    table.partial([order('a', 100), order('b', 101)], ['orderID'])
+    assert table.keys == ('orderID',)
+    assert table.find({'orderID': 'b'})['price'] == 101
+
+    assert table.update({'orderID': 'a', 'price': 99})['price'] == 99
+    assert table.find({'orderID': 'a'}) == order('a', 99)
+    assert table.update({'orderID': 'unknown', 'price': 1}) is None
+
+    assert table.delete({'orderID': 'a'})['orderID'] == 'a'
+    assert table.delete({'orderID': 'a'}) is None
+    assert [row['orderID'] for row in table] == ['b']
+
+
+def test_find_without_the_keys():
+    table = Table()
+    table.partial([order('a', 100)], ['orderID'])
+    assert table.find({'price': 100}) is None
+
+
+def test_partial_rekeys_rows_held_so_far():
+    table = Table()
+    table.insert([order('a', 100)])
+    assert table.find({'orderID': 'a'}) is None  # no keys yet
+    table.partial([order('b', 101)], ['orderID'])
+    assert table.find({'orderID': 'a'})['price'] == 100
+    assert [row['orderID'] for row in table] == ['a', 'b']
+
+
+def test_multiple_keys():
+    table = Table()
+    table.partial([{'symbol': 'XBTUSD', 'account': 1, 'currentQty': 0},
+                   {'symbol': 'ETHUSD', 'account': 1, 'currentQty': 5}], ['account', 'symbol'])
+    table.update({'account': 1, 'symbol': 'ETHUSD', 'currentQty': 7})
+    assert table.find({'account': 1, 'symbol': 'ETHUSD'})['currentQty'] == 7
+    assert table.find({'account': 1, 'symbol': 'XBTUSD'})['currentQty'] == 0
+
+
+def test_copy_on_write_leaves_old_rows_alone():
+    table = Table(copy_on_write=True)
+    table.partial([order('a', 100)], ['orderID'])
+    before = table.find({'orderID': 'a'})
+    table.update({'orderID': 'a', 'price': 99})
+    assert before['price'] == 100
+    assert table.find({'orderID': 'a'})['price'] == 99
+
+
+def test_trim_drops_the_oldest_half():
+    table = Table()
+    table.partial([order(str(i), i) for i in range(10)], ['orderID'])
+    assert table.trim(10) == []
+    table.insert([order('10', 10)])
+    assert [row['orderID'] for row in table.trim(10)] == ['0', '1', '2', '3', '4']
+    assert len(table) == 6
@@ -0,0 +1,81 @@
+import json
+import logging
+import random
+import sys
+import time
+
+from tom_bot.ws.decode import DECODERS
+from tom_bot.ws.feed import read_feed
+
+###
+# ws-decode-bench.py
+#
+# Messages per second through the websocket decode step, old path vs new:
+#   old: json.loads, then json.dumps again for logger.debug, then '%s: inserting %s' % (...) per message
+#   new: pluggable decoder, debug payloads only built when DEBUG is enabled
+# Logging runs at INFO, as the bot does.
+#
+# Usage (from the repository root):
+#   PYTHONPATH=. python test/ws-decode-bench.py [recorded-feed]
+# The feed is a file with one raw frame per line, optionally prefixed by a receive timestamp and a tab
+# (the format WS_RECORD_FILE records, see tom_bot/ws/feed.py), plain or gzipped. Without one, a synthetic feed is used.
+###
+
+logger = logging.getLogger('bench')
+logger.setLevel(logging.INFO)
+
+
+def synthetic_feed(n=50000):
+    frames = []
+    for i in range(n):
+        price = 10000 + random.randint(-50, 50) / 2
+        if i % 3 == 0:
+            frames.append(json.dumps({'table': 'trade', 'action': 'insert', 'data': [
+                {'timestamp': '2020-11-03T12:34:56.789Z', 'symbol': 'XBTUSD', 'side': 'Buy', 'size': 100,
+                 'price': price, 'tickDirection': 'PlusTick', 'trdMatchID': '%032x' % i,
+                 'grossValue': 1000000, 'homeNotional': 0.01, 'foreignNotional': 100}]}))
+        elif i % 3 == 1:
+            frames.append(json.dumps({'table': 'quote', 'action': 'insert', 'data': [
+                {'timestamp': '2020-11-03T12:34:56.789Z', 'symbol': 'XBTUSD', 'bidSize': 1000, 'bidPrice': price,
+                 'askPrice': price + 0.5, 'askSize': 2000}]}))
+        else:
+            frames.append(json.dumps({'table': 'instrument', 'action': 'update', 'data': [
+                {'symbol': 'XBTUSD', 'markPrice': price, 'fairPrice': price, 'lastPrice': price,
+                 'timestamp': '2020-11-03T12:34:56.789Z'}]}))
+    return frames
+
+
+def old_path(frames):
+    start = time.perf_counter()
+    for frame in frames:
+        message = json.loads(frame)
+        logger.debug(json.dumps(message))
+        logger.debug('%s: inserting %s' % (message.get('table'), message.get('data')))
+    return time.perf_counter() - start
+
+
+def new_path(frames, decode):
+    start = time.perf_counter()
+    for frame in frames:
+        message = decode(frame)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(json.dumps(message))
+        logger.debug('%s: inserting %s', message.get('table'), message.get('data'))
+    return time.perf_counter() - start
+
+
+def main():
+    frames = [frame for _, frame in read_feed(sys.argv[1])] if len(sys.argv) > 1 else synthetic_feed()
+    print("%d frames" % len(frames))
+    old = old_path(frames)
+    print("%-28s %10.0f msg/s" % ('old (json + dumps + %)', len(frames) / old))
+    for name, decode in sorted(DECODERS.items()):
+        if decode is None:
+            print("%-28s %10s" % ('new (%s)' % name, 'not installed'))
+            continue
+        new = new_path(frames, decode)
+        print("%-28s %10.0f msg/s  %5.1fx" % ('new (%s)' % name, len(frames) / new, old / new))
+
+
+if __name__ == "__main__":
+    main()
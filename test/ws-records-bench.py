@@ -0,0 +1,78 @@
+import time
+import tracemalloc
+
+from tom_bot.ws.records import FIELDS, record_type
+from tom_bot.ws.table import Table
+
+###
+# ws-records-bench.py
+#
+# Compares plain dict rows with the compact records (ws/records.py) for a position table: memory per
+# row, and the cost of applying 'update' messages to a copy-on-write table (as the websocket does for
+# snapshot tables) and in place.
+# Run from the repository root: PYTHONPATH=. python test/ws-records-bench.py
+###
+
+ROWS = 2000
+UPDATES = 50000
+KEYS = ['account', 'symbol', 'currency']
+
+
+def make_rows(n):
+    # A realistic position row: the fields we keep plus enough others to reach the ~85 BitMEX sends
+    rows = []
+    for i in range(n):
+        row = {f: 0 for f in FIELDS['position']}
+        row.update({'extraField%d' % j: j * 1.5 for j in range(85 - len(row))})
+        row.update({'account': 1, 'symbol': 'SYM%d' % i, 'currency': 'XBt', 'currentQty': i})
+        rows.append(row)
+    return rows
+
+
+def make_updates(rows):
+    # A typical position update: a handful of fields, some of which we don't keep
+    return [{'account': 1, 'symbol': rows[i % len(rows)]['symbol'], 'currency': 'XBt', 'markPrice': 10000.0 + i % 50,
+             'unrealisedPnl': i, 'extraField3': i, 'extraField7': i, 'timestamp': '2020-01-01T00:00:00.000Z'}
+            for i in range(UPDATES)]
+
+
+def bench_memory(rows, record):
+    tracemalloc.start()
+    table = Table(record=record)
+    table.partial([dict(r) for r in rows], KEYS)
+    # What the table holds once the partial's own dicts are gone (records don't keep them)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size / len(table)
+
+
+def bench_updates(rows, updates, record, copy_on_write):
+    table = Table(copy_on_write=copy_on_write, record=record)
+    table.partial([dict(r) for r in rows], KEYS)
+    start = time.perf_counter()
+    for updateData in updates:
+        table.update(updateData)
+    return time.perf_counter() - start
+
+
+def main():
+    rows = make_rows(ROWS)
+    updates = make_updates(rows)
+    record = record_type('position')
+    print("position rows: %d fields sent, %d kept" % (len(rows[0]), len(FIELDS['position'])))
+
+    dict_size = bench_memory(rows, None)
+    record_size = bench_memory(rows, record)
+    print("%-22s %10.0f bytes/row" % ('dict rows', dict_size))
+    print("%-22s %10.0f bytes/row  (%.1fx smaller)" % ('records', record_size, dict_size / record_size))
+
+    print("%-22s %14s %14s %10s" % ('updates', 'dict upd/s', 'record upd/s', 'speedup'))
+    for copy_on_write in (True, False):
+        d = bench_updates(rows, updates, None, copy_on_write)
+        r = bench_updates(rows, updates, record, copy_on_write)
+        print("%-22s %14.0f %14.0f %9.1fx" % ('copy-on-write' if copy_on_write else 'in place',
+                                              UPDATES / d, UPDATES / r, d / r))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import time
+import uuid
+
+from tom_bot.ws.table import Table
+
+###
+# ws-table-index-bench.py
+#
+# Measures how fast websocket 'update' messages can be applied as a table grows.
+# Compares the old list + findItemByKeys linear scan against the key-indexed Table.
+# Run from the repository root: PYTHONPATH=. python test/ws-table-index-bench.py
+###
+
+TABLE_SIZES = [10, 100, 1000, 10000]
+UPDATES = 5000
+KEYS = ['orderID']
+
+
+def findItemByKeys(keys, table, matchData):
+    # Copy of the old lookup in ws_thread, so this runs without a settings.py.
+    for item in table:
+        matched = True
+        for key in keys:
+            if item[key] != matchData[key]:
+                matched = False
+        if matched:
+            return item
+
+
+def make_rows(n):
+    return [{'orderID': str(uuid.uuid4()), 'symbol': 'XBTUSD', 'leavesQty': 100, 'price': 10000.0}
+            for _ in range(n)]
+
+
+def make_updates(rows):
+    # Cycle through the table so every position (front, middle, back) gets hit.
+    return [{'orderID': rows[i % len(rows)]['orderID'], 'price': 10000.0 + i % 50}
+            for i in range(UPDATES)]
+
+
+def bench_scan(rows, updates):
+    table = [dict(r) for r in rows]
+    start = time.perf_counter()
+    for updateData in updates:
+        item = findItemByKeys(KEYS, table, updateData)
+        item.update(updateData)
+    return time.perf_counter() - start
+
+
+def bench_indexed(rows, updates):
+    table = Table()
+    table.partial([dict(r) for r in rows], KEYS)
+    start = time.perf_counter()
+    for updateData in updates:
+        table.update(updateData)
+    return time.perf_counter() - start
+
+
+def main():
+    print("%8s %16s %16s %10s" % ('rows', 'scan upd/s', 'indexed upd/s', 'speedup'))
+    for n in TABLE_SIZES:
+        rows = make_rows(n)
+        updates = make_updates(rows)
+        scan = bench_scan(rows, updates)
+        indexed = bench_indexed(rows, updates)
+        print("%8d %16.0f %16.0f %9.1fx" % (n, UPDATES / scan, UPDATES / indexed, scan / indexed))
+
+
+if __name__ == "__main__":
+    main()
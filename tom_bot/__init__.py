@@ -9,17 +9,45 @@ __version__ = 'v1.5.1'
 
 def run():
     parser = argparse.ArgumentParser(description='BitMEX TOM Bot')
-    parser.add_argument('command', nargs='?', help='Instrument symbol on BitMEX or "setup" for first-time config')
+    parser.add_argument('command', nargs='?',
+                        help='Instrument symbol on BitMEX, "setup" for first-time config, "replay" to replay a feed '
+                             'or "serve" to run a local BitMEX stand-in')
+    parser.add_argument('path', nargs='?', help='Feed recorded with WS_RECORD_FILE, for "replay"')
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay this many times faster than recorded')
+    parser.add_argument('--max', action='store_true', help='Replay as fast as possible')
+    parser.add_argument('--symbol', default='XBTUSD',
+                        help='Default symbol of the replayed data; for "serve", the symbols to list (comma separated)')
+    parser.add_argument('--port', type=int, default=8765, help='"serve": port to listen on')
+    parser.add_argument('--rate', type=float, default=10.0, help='"serve": market steps per second per symbol')
+    parser.add_argument('--latency', type=float, default=0.0, help='"serve": seconds added to every REST response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='"serve": up to this many more seconds, at random')
+    parser.add_argument('--errors', default='',
+                        help='"serve": share of REST requests to fail per status, e.g. 429:0.01,503:0.02')
+    parser.add_argument('--ratelimit', type=int, default=120,
+                        help='"serve": REST requests per minute before 429s (0 for no limit)')
     args = parser.parse_args()
 
     if args.command is not None and args.command.strip().lower() == 'setup':
         copy_files()
 
+    elif args.command is not None and args.command.strip().lower() == 'replay':
+        if args.path is None:
+            parser.error('replay needs the path of a recorded feed')
+        replay_feed(args.path, None if args.max else args.speed, args.symbol)
+
+    elif args.command is not None and args.command.strip().lower() == 'serve':
+        # Reads settings.py for the API key and secret to accept
+        from tom_bot.sim.server import serve
+        errors = dict((int(status), float(share)) for status, share in
+                      (pair.split(':') for pair in args.errors.split(',') if pair))
+        serve(args.port, symbols=args.symbol.split(','), rate=args.rate, latency=args.latency, jitter=args.jitter,
+              errors=errors, rate_limit=args.ratelimit)
+
     else:
-        # import market_maker here rather than at the top because it depends on settings.py existing
+        # import tom_bot here rather than at the top because it depends on settings.py existing
         try:
-            from market_maker import market_maker
-            market_maker.run()
+            from tom_bot import tom_bot
+            tom_bot.run()
         except ImportError:
             print('Can\'t find settings.py. Run "marketmaker setup" to create project.')
 
@@ -35,3 +63,20 @@ def copy_files():
         print('Created TomBot project.\n**** \nImportant!!!\nEdit settings.py before starting the bot.\n****')
     except FileExistsError:
         print('TomBot project already exists!')
+
+
+def replay_feed(path, speed, symbol):
+    # Like the bot, this reads settings.py (decoder, buffer sizes, ...)
+    from tom_bot.ws.ws_thread import BitMEXWebsocket
+    from tom_bot.ws.feed import replay
+
+    ws = BitMEXWebsocket()
+    ws.symbol = symbol
+    frames, elapsed = replay(ws, path, speed)
+    print('Replayed %d frames in %.2fs (%.0f frames/s).' % (frames, elapsed, frames / elapsed if elapsed else 0))
+    print(ws.ingest.format())
+    print(ws.snapshot())
+    for table, rows in sorted(ws.data.items()):
+        print('%-12s %s' % (table, rows))
+    for book in ws.books.values():
+        print(book)
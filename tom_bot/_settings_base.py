@@ -97,14 +97,115 @@ DRY_RUN = False
 # order amend/replaces are done, you may hit a ratelimit. If so, email BitMEX if you feel you need a higher limit.
 LOOP_INTERVAL = 10#5
 
+# 'interval': tick every LOOP_INTERVAL seconds.
+# 'event': also tick as soon as the websocket reports a fill, a cancel, a position change or a mark price
+# move of EVENT_MARK_PRICE_MOVE (0.002 == 0.2%). LOOP_INTERVAL is then the longest we stay idle.
+LOOP_MODE = 'interval'
+EVENT_MARK_PRICE_MOVE = 0.002
+# Seconds to let a burst of updates settle before an early tick, so one tick covers all of it.
+EVENT_DEBOUNCE = 0.25
+
+# If the websocket connection drops, reconnect (and reload all tables) in place up to this many times in a
+# row before giving up and restarting the bot. Attempts back off exponentially, starting at
+# WS_RECONNECT_BACKOFF seconds and capped at WS_RECONNECT_MAX_BACKOFF.
+WS_RECONNECT_ATTEMPTS = 10
+WS_RECONNECT_BACKOFF = 0.5
+WS_RECONNECT_MAX_BACKOFF = 30
+
 # Wait times between orders / errors
 API_REST_INTERVAL = 1
 API_ERROR_INTERVAL = 10
 TIMEOUT = 12
+# Seconds to wait for a bulk amend before sending it again (see API_RETRIES). None: TIMEOUT.
+AMEND_TIMEOUT = 3
+
+# REST rate limits. Requests are paced client side from the limits BitMEX reports on every response; these
+# are only what to assume until the first one: requests per minute, and order requests per second.
+API_RATELIMIT = 120
+API_RATELIMIT_BURST = 10
+# When fewer requests than this are left, amends of entry orders wait for a later tick; stop losses and take
+# profits are still placed and amended.
+API_RATELIMIT_RESERVE = 10
+
+# Order creates, amends and cancels of a tick are sent concurrently on this many connections (each batch
+# still waits for earlier ones touching the same orders).
+API_REST_WORKERS = 4
+
+# REST requests that fail without an answer (a 503, a timeout, a dropped connection) are retried, each waiting
+# longer than the last: retry n waits between half and all of API_RETRY_BACKOFF * 2^(n-1) seconds, at most
+# API_RETRY_MAX_BACKOFF. How many retries, by verb or by 'VERB endpoint' (e.g. 'GET position'), which wins.
+# POST and PUT aren't retried by default: one that timed out may still have been applied. Bulk amends are:
+# each one gives the order a new clOrdID, so a second copy of an amend that went through is refused. After a
+# timeout, the first retry goes out at once.
+API_RETRIES = {'GET': 3, 'DELETE': 3, 'POST': 0, 'PUT': 0, 'PUT order/bulk': 2}
+API_RETRY_BACKOFF = 0.5
+API_RETRY_MAX_BACKOFF = 8
+# A request refused for the rate limit (429) is sent again once the limit allows, at most this many times.
+API_RATELIMIT_RETRIES = 3
+# After this many failures in a row, REST calls fail at once for API_CIRCUIT_COOLDOWN seconds, and ticks are
+# skipped, rather than waiting on an exchange that is down. Then one request tests whether it is back.
+API_CIRCUIT_FAILURES = 5
+API_CIRCUIT_COOLDOWN = 30
 
 # If we're doing a dry run, use these numbers for BTC balances
 DRY_BTC = 50
 
+# Subscribe to the L2 order book of the traded symbol and keep it in memory. None, 'orderBookL2_25'
+# (top 25 levels per side) or 'orderBookL2' (full depth). When set, tickers use the live top of book
+# and market_depth() returns the book.
+ORDERBOOK_TABLE = None
+
+# Instrument updates to subscribe to. None: only the symbols we watch (SYMBOL and CONTRACTS). A list adds
+# more symbols, e.g. ['.BXBT'] for an index. 'all': every instrument on the exchange (much more traffic).
+WS_INSTRUMENTS = None
+
+# Quote table to subscribe to: 'quote' (every change of the top of book), a binned table ('quoteBin1m',
+# 'quoteBin5m', ...: one quote per symbol per bin, far less traffic) or None for no quotes.
+WS_QUOTE_TABLE = 'quote'
+
+# Ask the server to compress websocket frames (permessage-deflate). Only the 'asyncio' WS_CLIENT supports
+# it; the threaded client's library doesn't, so there this does nothing.
+WS_COMPRESSION = True
+
+# JSON parser for websocket frames: 'auto' (fastest installed), 'json', 'orjson' or 'ujson'.
+# orjson / ujson are optional; `pip install orjson` for the fastest decoding.
+WS_DECODER = 'auto'
+
+# How many of the most recent trades and quotes to keep in memory. These are held in fixed-size
+# buffers, so memory use doesn't grow past this.
+TRADE_BUFFER_LEN = 10000
+QUOTE_BUFFER_LEN = 10000
+
+# Keep order, position, margin and instrument rows as compact records holding only the fields the bot
+# reads (see ws/records.py for the lists), instead of full dicts. They still read like dicts. To keep more
+# fields, list them per table, e.g. {'position': ['riskLimit', 'deleveragePercentile']}.
+WS_COMPACT_ROWS = True
+WS_ROW_FIELDS = {}
+
+# Orders that have ended (filled, canceled, ...) and executions trimmed from the execution table are moved
+# to an archive that keeps the last WS_ARCHIVE_LEN of each in memory, queryable by ID (and the last
+# WS_ARCHIVE_LEN filled orders, for filled_orders). With WS_ARCHIVE_DIR set, they are also appended to
+# orders.jsonl.gz / executions.jsonl.gz in that directory, for the full history, from a writer thread.
+WS_ARCHIVE_LEN = 5000
+WS_ARCHIVE_DIR = None
+
+# Websocket client: 'thread' runs the socket on its own thread. 'asyncio' runs it, and the run loop, on one
+# asyncio event loop (needs `pip install websockets`).
+WS_CLIENT = 'thread'
+
+# Append every raw websocket frame, with its receive time, to this gzip file (e.g. 'feed.log.gz'), for
+# replaying later with `tombot replay`. None to not record.
+WS_RECORD_FILE = None
+
+# Log websocket ingest stats (messages per table, exchange-to-receive lag, decode and apply times) every
+# this many seconds. None to not log them; BitMEXWebsocket.stats() has them either way.
+WS_STATS_INTERVAL = 300
+
+# Log REST request stats (latency, status codes, retries, bytes and rate limit per endpoint, and the ticks
+# that spent the longest in requests) every this many seconds. None to not log them; BitMEX.rest_stats()
+# has them either way.
+REST_STATS_INTERVAL = 300
+
 # Available levels: logging.(DEBUG|INFO|WARN|ERROR)
 LOG_LEVEL = logging.INFO
 
@@ -126,4 +227,6 @@ WATCHED_FILES = [join('market_maker', 'market_maker.py'), join('market_maker', '
 ########################################################################################################################
 
 # Specify the contracts that you hold. These will be used in portfolio calculations.
+# Their quotes, trades, orders and executions (and L2 book, if ORDERBOOK_TABLE is set) stream in over the
+# same websocket connection as SYMBOL's, each kept separately per symbol.
 CONTRACTS = ['XBTUSD']
@@ -1,6 +1,7 @@
 from requests.auth import AuthBase
 import time
-from market_maker.auth.APIKeyAuth import generate_signature
+import hashlib
+import hmac
 
 
 class APIKeyAuthWithExpires(AuthBase):
@@ -11,6 +12,8 @@ class APIKeyAuthWithExpires(AuthBase):
         """Init with Key & Secret."""
         self.apiKey = apiKey
         self.apiSecret = apiSecret
+        # Keyed once: every signature starts from a copy of this instead of re-deriving the HMAC pads.
+        self.hmac = hmac.new(apiSecret.encode('utf8'), digestmod=hashlib.sha256)
 
     def __call__(self, r):
         """
@@ -20,9 +23,19 @@ class APIKeyAuthWithExpires(AuthBase):
         For more details, see https://www.bitmex.com/app/apiKeys
         """
         # modify and return the request
-        expires = int(round(time.time()) + 5)  # 5s grace period in case of clock skew
-        r.headers['api-expires'] = str(expires)
-        r.headers['api-key'] = self.apiKey
-        r.headers['api-signature'] = generate_signature(self.apiSecret, r.method, r.url, expires, r.body or '')
-
+        body = r.body or b''
+        r.headers.update(self.headers(r.method, r.path_url, body if isinstance(body, bytes) else body.encode('utf8')))
         return r
+
+    def headers(self, verb, path, body=b''):
+        """The auth headers for a request. path is relative with its query string ('/api/v1/order?...'),
+        and body the exact bytes that will be sent."""
+        expires = str(int(round(time.time()) + 5))  # 5s grace period in case of clock skew
+        return {'api-expires': expires, 'api-key': self.apiKey, 'api-signature': self.sign(verb, path, expires, body)}
+
+    def sign(self, verb, path, expires, body=b''):
+        """HMAC_SHA256(secret, verb + path + expires + body), hex encoded. See APIKeyAuth.generate_signature."""
+        mac = self.hmac.copy()
+        mac.update((verb + path + str(expires)).encode('utf8'))
+        mac.update(body)
+        return mac.hexdigest()
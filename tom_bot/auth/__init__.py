@@ -1,3 +1,3 @@
-from market_maker.auth.AccessTokenAuth import *
-from market_maker.auth.APIKeyAuth import *
-from market_maker.auth.APIKeyAuthWithExpires import *
+from tom_bot.auth.AccessTokenAuth import *
+from tom_bot.auth.APIKeyAuth import *
+from tom_bot.auth.APIKeyAuthWithExpires import *
@@ -1,17 +1,31 @@
 """BitMEX API Connector."""
 from __future__ import absolute_import
 import requests
+import sys
 import time
 import datetime
 import json
 import base64
+import logging
 import uuid
-from market_maker.auth import APIKeyAuthWithExpires
-from market_maker.utils import constants, errors, log
-from market_maker.ws.ws_thread import BitMEXWebsocket
+from collections import OrderedDict
+from future.standard_library import hooks
+with hooks():  # Python 2/3 compat
+    from urllib.parse import urlencode, urlsplit
+from tom_bot.utils import constants, log
+from tom_bot.auth.APIKeyAuthWithExpires import APIKeyAuthWithExpires
+from tom_bot.ws.ws_thread import BitMEXWebsocket
+from tom_bot.ws.ws_asyncio import AsyncBitMEXWebsocket
+from tom_bot.utils import clordid, errors
+from tom_bot.rest.ratelimit import RateLimiter
+from tom_bot.rest.retry import CircuitBreaker, RetryPolicy
+from tom_bot.rest.stats import RequestStats
 
 logger = log.setup_custom_logger('root')
 
+# Replaced clOrdIDs remembered, for amends made before the websocket has caught up with earlier ones
+CHAINED_KEPT = 500
+
 
 # https://www.bitmex.com/api/explorer/
 class BitMEX(object):
@@ -19,7 +33,9 @@ class BitMEX(object):
     """BitMEX API Connector."""
 
     def __init__(self, base_url=None, symbol=None, apiKey=None, apiSecret=None,
-                 orderIDPrefix='mm_bitmex_', shouldWSAuth=True, postOnly=False, timeout=7):
+                 orderIDPrefix='mm_bitmex_', shouldWSAuth=True, postOnly=False, timeout=7, symbols=None,
+                 wsClient='thread', rateLimit=120, rateLimitBurst=10, retryPolicy=None, circuitBreaker=None,
+                 statsInterval=None, amendTimeout=None):
         """Init connector."""
         self.base_url = base_url
         self.symbol = symbol
@@ -33,7 +49,23 @@ class BitMEX(object):
         if len(orderIDPrefix) > 13:
             raise ValueError("settings.ORDERID_PREFIX must be at most 13 characters long!")
         self.orderIDPrefix = orderIDPrefix
-        self.retries = 0  # initialize counter
+        # Signing: the key material is set up once, and requests are signed with the path as sent
+        self.auth = APIKeyAuthWithExpires(apiKey, apiSecret)
+        urlParts = urlsplit(base_url)
+        self.origin = urlParts.scheme + '://' + urlParts.netloc
+        self.base_path = urlParts.path
+        # Requests are paced against the exchange's rate limits, as reported on every response
+        self.ratelimit = RateLimiter(rateLimit, rateLimitBurst)
+        # Failed requests are retried with backoff; during an outage, calls fail at once instead
+        self.retry_policy = retryPolicy or RetryPolicy()
+        self.circuit = circuitBreaker or CircuitBreaker()
+        # Every request is timed and counted per endpoint, and tagged with the tick that sent it
+        self.request_stats = RequestStats()
+        self.statsInterval = statsInterval
+        self.traced_tick = None
+        # Amends are sent by origClOrdID, giving the order a new clOrdID each time (see amend_bulk_orders)
+        self.amendTimeout = amendTimeout
+        self.chained = OrderedDict()  # replaced clOrdID -> the one our amend gave the order
 
         # Prepare HTTPS session
         self.session = requests.Session()
@@ -41,10 +73,18 @@ class BitMEX(object):
         self.session.headers.update({'user-agent': 'liquidbot-' + constants.VERSION})
         self.session.headers.update({'content-type': 'application/json'})
         self.session.headers.update({'accept': 'application/json'})
-
-        # Create websocket for streaming data
-        self.ws = BitMEXWebsocket()
-        self.ws.connect(base_url, symbol, shouldAuth=shouldWSAuth)
+        # Proxies, verify and the CA bundle from the environment (HTTPS_PROXY, REQUESTS_CA_BUNDLE, ...), merged as
+        # Session.request would; looked up once, as every request goes to the same host
+        self.send_settings = self.session.merge_environment_settings(base_url, {}, None, None, None)
+
+        # Create websocket for streaming data: on its own thread, or on an asyncio event loop
+        if wsClient == 'asyncio':
+            self.ws = AsyncBitMEXWebsocket()
+        elif wsClient == 'thread':
+            self.ws = BitMEXWebsocket()
+        else:
+            raise ValueError("Unknown websocket client %r, expected 'thread' or 'asyncio'." % wsClient)
+        self.ws.connect(base_url, symbol, shouldAuth=shouldWSAuth, symbols=symbols)
 
         self.timeout = timeout
 
@@ -73,23 +113,34 @@ class BitMEX(object):
             query['filter'] = json.dumps(filter)
         return self._curl_bitmex(path='instrument', query=query, verb='GET')
 
+    def snapshot(self):
+        """Consistent, read-only view of instruments, positions, margin and orders. See ws.snapshot.Snapshot."""
+        return self.ws.snapshot()
+
     def market_depth(self, symbol):
         """Get market depth / orderbook."""
         return self.ws.market_depth(symbol)
 
-    def recent_trades(self):
-        """Get recent trades.
+    def add_listener(self, callback, tables=None, symbols=None):
+        """Be called back when realtime data changes. See BitMEXWebsocket.add_listener."""
+        return self.ws.add_listener(callback, tables, symbols)
+
+    def recent_trades(self, symbol=None):
+        """Get recent trades of a symbol (default: self.symbol).
 
         Returns
         -------
-        A list of dicts:
-              {u'amount': 60,
-               u'date': 1306775375,
-               u'price': 8.7401099999999996,
-               u'tid': u'93842'},
-
+        A list of dicts, oldest first:
+              {'timestamp': '2020-11-03T12:34:56.789Z',
+               'symbol': 'XBTUSD',
+               'side': 'Buy',
+               'size': 60,
+               'price': 8740.5},
+
+        Only these fields are kept (see ws.ringbuffer.TradeBuffer); tickDirection, trdMatchID, grossValue,
+        homeNotional and foreignNotional are not. Use ws.trades() for windows and aggregates.
         """
-        return self.ws.recent_trades()
+        return self.ws.recent_trades(symbol)
 
     #
     # Authentication required methods
@@ -163,24 +214,64 @@ class BitMEX(object):
 
     @authentication_required
     def amend_bulk_orders(self, orders):
-        """Amend multiple orders."""
+        """Amend multiple orders. Each amend moves its order to a new clOrdID, naming the order by its current
+        one (origClOrdID) rather than its orderID: sent a second time, an amend that went through finds no
+        order by that name, so amends can be retried after a timeout (see _amended_orders)."""
+        amends = [self._chain_amend(order) for order in orders]
+        # Orders we can't give a new clOrdID (placed by hand) are amended by orderID, and not retried
+        retrySafe = all('origClOrdID' in amend for amend in amends)
         # Note rethrow; if this fails, we want to catch it and re-tick
-        return self._curl_bitmex(path='order/bulk', postdict={'orders': orders}, verb='PUT', rethrow_errors=True)
+        result = self._curl_bitmex(path='order/bulk', postdict={'orders': amends}, verb='PUT', rethrow_errors=True,
+                                   timeout=self.amendTimeout, max_retries=None if retrySafe else 0)
+        for amend in amends:
+            if 'origClOrdID' in amend:
+                self.chained[amend['origClOrdID']] = amend['clOrdID']
+        while len(self.chained) > CHAINED_KEPT:
+            self.chained.popitem(last=False)
+        return result
+
+    def _chain_amend(self, order):
+        """A copy of the amend `order` (by orderID, or already by origClOrdID) that names the order by its
+        current clOrdID and gives it a new one: the same key with a new nonce (see utils.clordid)."""
+        amend = dict(order)
+        if 'clOrdID' in amend:
+            # The caller picked the new clOrdID
+            return amend
+        current = amend.pop('origClOrdID', None)
+        if current is None:
+            current = next((o['clOrdID'] for o in self.ws.all_orders() if o['orderID'] == amend.get('orderID')), None)
+        # Our amends can be confirmed before the websocket has the new clOrdID
+        while current in self.chained:
+            current = self.chained[current]
+        tag = clordid.decode(current)
+        if tag is not None:
+            new = clordid.with_nonce(tag.key)
+        elif current and current.startswith(self.orderIDPrefix):
+            new = self.orderIDPrefix + base64.b64encode(uuid.uuid4().bytes).decode('utf8').rstrip('=\n')
+        else:
+            return amend
+        amend.pop('orderID', None)
+        amend['origClOrdID'] = current
+        amend['clOrdID'] = new
+        return amend
 
     @authentication_required
     def create_bulk_orders(self, orders):
-        """Create multiple orders."""
+        """Create multiple orders. An order whose clOrdID is a key (see utils.clordid) gets a nonce appended."""
         for order in orders:
-            order['clOrdID'] = self.orderIDPrefix + base64.b64encode(uuid.uuid4().bytes).decode('utf8').rstrip('=\n')
+            if order.get('clOrdID'):
+                order['clOrdID'] = clordid.with_nonce(order['clOrdID'])
+            else:
+                order['clOrdID'] = self.orderIDPrefix + base64.b64encode(uuid.uuid4().bytes).decode('utf8').rstrip('=\n')
             order['symbol'] = self.symbol
             if self.postOnly:
                 order['execInst'] = 'ParticipateDoNotInitiate'
         return self._curl_bitmex(path='order/bulk', postdict={'orders': orders}, verb='POST')
 
     @authentication_required
-    def open_orders(self):
-        """Get open orders."""
-        return self.ws.open_orders(self.orderIDPrefix)
+    def open_orders(self, symbol=None):
+        """Get our open orders in `symbol` (ours by default)."""
+        return [o for o in self.ws.open_orders(symbol or self.symbol) if self._is_ours(o)]
 
     @authentication_required
     def http_open_orders(self):
@@ -194,8 +285,56 @@ class BitMEX(object):
             },
             verb="GET"
         )
-        # Only return orders that start with our clOrdID prefix.
-        return [o for o in orders if str(o['clOrdID']).startswith(self.orderIDPrefix)]
+        # Only return orders we placed
+        return [o for o in orders if self._is_ours(o)]
+
+    def _is_ours(self, order):
+        """Whether we placed the order: its clOrdID is tagged (see utils.clordid) or starts with our prefix."""
+        clOrdID = str(order['clOrdID'])
+        return clordid.decode(clOrdID) is not None or clOrdID.startswith(self.orderIDPrefix)
+
+    @authentication_required
+    def executed_orders(self, symbol=None):
+        """Executions received on the websocket."""
+        return self.ws.executed_orders(symbol)
+
+    @authentication_required
+    def all_orders(self):
+        """Orders received on the websocket."""
+        return self.ws.all_orders()
+
+    @authentication_required
+    def filled_orders(self):
+        """Orders filled in this run."""
+        return self.ws.filled_orders()
+
+    @authentication_required
+    def fills(self):
+        """Our fills per symbol, kept from the execution stream. See ws.fills.FillLedger."""
+        return self.ws.fills
+
+    @authentication_required
+    def filled_orders_hist(self):
+        """Trade history via HTTP, newest first."""
+        return self.filled_orders_hist_count(100)
+
+    @authentication_required
+    def last_filled_orders_hist(self):
+        """The last execution in the trade history via HTTP, as a list of (at most) one."""
+        return self.filled_orders_hist_count(1)
+
+    @authentication_required
+    def filled_orders_hist_count(self, count, symbol=None):
+        """The last `count` executions in the trade history via HTTP, newest first."""
+        query = {'count': count, 'reverse': 'true'}
+        if symbol is not None:
+            query['symbol'] = symbol
+        return self._curl_bitmex(path='execution/tradeHistory', query=query, verb='GET')
+
+    @authentication_required
+    def filled_orders_hist_count_symbol(self, symbol, count):
+        """The last `count` executions in symbol in the trade history via HTTP, newest first."""
+        return self.filled_orders_hist_count(count, symbol)
 
     @authentication_required
     def cancel(self, orderID):
@@ -217,9 +356,45 @@ class BitMEX(object):
         }
         return self._curl_bitmex(path=path, postdict=postdict, verb="POST", max_retries=0)
 
+    def rate_limit_remaining(self):
+        """Requests we can send right now without waiting on the rate limit."""
+        return self.ratelimit.remaining()
+
+    def rate_limit(self):
+        """Rate limit state: limit, remaining, burst remaining, time blocked, ... See rest.ratelimit."""
+        return self.ratelimit.snapshot()
+
+    def trace_tick(self, tick):
+        """Tag the requests sent from now on (by any thread) with `tick`, in the REST stats and the log."""
+        self.traced_tick = tick
+
+    def rest_stats(self):
+        """REST stats (latency, status codes, retries, bytes and rate limit per endpoint, and the requests
+        of recent ticks) since they were last logged. See rest.stats.RequestStats.snapshot."""
+        return self.request_stats.snapshot()
+
+    def tick_requests(self, tick):
+        """The requests tagged with `tick`: count, seconds spent in them, and seconds per endpoint."""
+        return self.request_stats.tick(tick)
+
+    def api_available(self):
+        """False while the circuit breaker is open: REST calls would fail at once."""
+        return not self.circuit.is_open()
+
+    def _prepare_request(self, verb, path, query=None, postdict=None):
+        """A signed, ready to send request. The body is serialized once; the session prepares the request
+        (adding its headers, cookies and hooks) and the auth signs the URL and bytes it will send."""
+        path = self.base_path + path
+        if query:
+            path += '?' + urlencode(query, doseq=True)
+        body = json.dumps(postdict, separators=(',', ':')).encode('utf8') if postdict is not None else None
+        # With an auth, the session doesn't look for one in ~/.netrc on every request
+        return self.session.prepare_request(requests.Request(verb, self.origin + path, data=body, auth=self.auth))
+
     def _curl_bitmex(self, path, query=None, postdict=None, timeout=None, verb=None, rethrow_errors=False,
                      max_retries=None):
-        """Send a request to BitMEX Servers."""
+        """Send a request to BitMEX Servers. Requests the exchange couldn't handle are retried here (see
+        rest.retry.RetryPolicy), each call counting its own retries."""
         # Handle URL
         url = self.base_url + path
 
@@ -231,132 +406,187 @@ class BitMEX(object):
             verb = 'POST' if postdict else 'GET'
 
         # By default don't retry POST or PUT. Retrying GET/DELETE is okay because they are idempotent.
-        # In the future we could allow retrying PUT, so long as 'leavesQty' is not used (not idempotent),
-        # or you could change the clOrdID (set {"clOrdID": "new", "origClOrdID": "old"}) so that an amend
-        # can't erroneously be applied twice.
+        # Bulk amends are retried: they change the clOrdID (set {"clOrdID": "new", "origClOrdID": "old"}),
+        # so an amend can't erroneously be applied twice. See amend_bulk_orders.
         if max_retries is None:
-            max_retries = 0 if verb in ['POST', 'PUT'] else 3
-
-        # Auth: API Key/Secret
-        auth = APIKeyAuthWithExpires(self.apiKey, self.apiSecret)
+            max_retries = self.retry_policy.attempts(verb, path)
 
         def exit_or_throw(e):
+            # Doesn't exit anymore: the error is raised as an errors.APIError, and the loop skips the tick
             if rethrow_errors:
                 raise e
-            else:
-                exit(1)
-
-        def retry():
-            self.retries += 1
-            if self.retries > max_retries:
-                raise Exception("Max retries on %s (%s) hit, raising." % (path, json.dumps(postdict or '')))
-            return self._curl_bitmex(path, query, postdict, timeout, verb, rethrow_errors, max_retries)
-
-        # Make the request
-        response = None
-        try:
-            logger.info("sending req to %s: %s" % (url, json.dumps(postdict or query or '')))
-            req = requests.Request(verb, url, json=postdict, auth=auth, params=query)
-            prepped = self.session.prepare_request(req)
-            response = self.session.send(prepped, timeout=timeout)
-            # Make non-200s throw
-            response.raise_for_status()
-
-        except requests.exceptions.HTTPError as e:
-            if response is None:
-                raise e
-
-            # 401 - Auth error. This is fatal.
-            if response.status_code == 401:
-                logger.error("API Key or Secret incorrect, please check and restart.")
-                logger.error("Error: " + response.text)
-                if postdict:
-                    logger.error(postdict)
-                # Always exit, even if rethrow_errors, because this is fatal
-                exit(1)
-
-            # 404, can be thrown if order canceled or does not exist.
-            elif response.status_code == 404:
-                if verb == 'DELETE':
-                    logger.error("Order not found: %s" % postdict['orderID'])
-                    return
-                logger.error("Unable to contact the BitMEX API (404). " +
-                                  "Request: %s \n %s" % (url, json.dumps(postdict)))
+            raise errors.APIError("%s %s failed: %s" % (verb, path, e)) from e
+
+        attempt = 0
+        ratelimited = 0
+        while True:
+            # During an outage, fail at once rather than wait on every call
+            if not self.circuit.allow():
+                raise errors.CircuitOpenError("BitMEX API unavailable, not sending requests for %.1f more seconds. "
+                                              "Request: %s %s" % (self.circuit.retry_in(), verb, path))
+
+            # Make the request
+            response = None
+            try:
+                # Waits here if we are out of requests; signed after, so the signature doesn't expire meanwhile
+                self.ratelimit.acquire(verb)
+                tick = self.traced_tick
+                prepped = None
+                sent = time.time()
+                try:
+                    prepped = self._prepare_request(verb, path, query, postdict)
+                    if logger.isEnabledFor(logging.INFO):
+                        logger.info("sending req to %s (tick %s): %s", prepped.url, tick,
+                                    prepped.body.decode('utf8') if prepped.body else '')
+                    sent = time.time()
+                    response = self.session.send(prepped, timeout=timeout, **self.send_settings)
+                finally:
+                    self.ratelimit.update(response, verb)
+                    if response is None or response.status_code >= 500 or response.status_code == 429:
+                        self.circuit.failure()
+                    else:
+                        self.circuit.success()
+                    self._record_request(verb, path, prepped, response, time.time() - sent, attempt > 0, tick)
+                # Make non-200s throw
+                response.raise_for_status()
+
+            except requests.exceptions.HTTPError as e:
+                if response is None:
+                    raise e
+
+                # A retried amend that finds no order by its origClOrdID: an earlier attempt went through (it
+                # changed the clOrdID) and only its response was lost. Answer with the amended orders.
+                if attempt > 0 and verb == 'PUT' and response.status_code in (400, 404):
+                    amended = self._amended_orders(postdict)
+                    if amended is not None:
+                        return amended
+
+                # 401 - Auth error. This is fatal.
+                if response.status_code == 401:
+                    logger.error("API Key or Secret incorrect, please check and restart.")
+                    logger.error("Error: " + response.text)
+                    if postdict:
+                        logger.error(postdict)
+                    # Always raised, even if rethrow_errors, because this is fatal
+                    raise errors.AuthenticationError("API Key or Secret incorrect: %s" % response.text) from e
+
+                # 404, can be thrown if order canceled or does not exist.
+                elif response.status_code == 404:
+                    if verb == 'DELETE':
+                        logger.error("Order not found: %s" % postdict['orderID'])
+                        return
+                    logger.error("Unable to contact the BitMEX API (404). " +
+                                      "Request: %s \n %s" % (url, json.dumps(postdict)))
+                    exit_or_throw(e)
+
+                # 429, ratelimit. The request wasn't processed, so it is safe to send again (even a POST or PUT),
+                # once the rate limiter lets requests through; a few times, and each counts as a failure for the
+                # circuit breaker. Open orders stay as they are: stop losses and take profits keep protecting the
+                # position while we wait.
+                elif response.status_code == 429:
+                    ratelimited += 1
+                    if ratelimited > self.retry_policy.ratelimited:
+                        raise errors.APIUnavailableError("Still ratelimited after %d tries on %s (%s), raising." %
+                                                         (ratelimited, path, json.dumps(postdict or '')))
+                    logger.error("Ratelimited on current request. Waiting %.1f seconds, then trying again. Try fewer " %
+                                 self.ratelimit.blocked_for() +
+                                 "order pairs or contact support@bitmex.com to raise your limits. " +
+                                 "Request: %s \n %s" % (url, json.dumps(postdict)))
+                    continue
+
+                # 503 - BitMEX temporary downtime, likely due to a deploy. Try again
+                elif response.status_code == 503:
+                    logger.warning("Unable to contact the BitMEX API (503), retrying. " +
+                                        "Request: %s \n %s" % (url, json.dumps(postdict)))
+                    attempt = self._backoff(attempt, max_retries, path, postdict)
+                    continue
+
+                elif response.status_code == 400:
+                    error = response.json()['error']
+                    message = error['message'].lower() if error else ''
+
+                    # Duplicate clOrdID: that's fine, probably a deploy, go get the order(s) and return it
+                    if 'duplicate clordid' in message:
+                        orders = postdict['orders'] if 'orders' in postdict else postdict
+
+                        IDs = json.dumps({'clOrdID': [order['clOrdID'] for order in orders]})
+                        orderResults = self._curl_bitmex('/order', query={'filter': IDs}, verb='GET')
+
+                        for i, order in enumerate(orderResults):
+                            if (
+                                    order['orderQty'] != abs(postdict['orderQty']) or
+                                    order['side'] != ('Buy' if postdict['orderQty'] > 0 else 'Sell') or
+                                    order['price'] != postdict['price'] or
+                                    order['symbol'] != postdict['symbol']):
+                                raise Exception('Attempted to recover from duplicate clOrdID, but order returned from API ' +
+                                                'did not match POST.\nPOST data: %s\nReturned order: %s' % (
+                                                    json.dumps(orders[i]), json.dumps(order)))
+                        # All good
+                        return orderResults
+
+                    elif 'insufficient available balance' in message:
+                        logger.error('Account out of funds. The message: %s' % error['message'])
+                        raise errors.InsufficientFundsError(error['message']) from e
+
+
+                # If we haven't returned or re-raised yet, we get here.
+                logger.error("Unhandled Error: %s: %s" % (e, response.text))
+                logger.error("Endpoint was: %s %s: %s" % (verb, path, json.dumps(postdict)))
                 exit_or_throw(e)
 
-            # 429, ratelimit; cancel orders & wait until X-RateLimit-Reset
-            elif response.status_code == 429:
-                logger.error("Ratelimited on current request. Sleeping, then trying again. Try fewer " +
-                                  "order pairs or contact support@bitmex.com to raise your limits. " +
-                                  "Request: %s \n %s" % (url, json.dumps(postdict)))
-
-                # Figure out how long we need to wait.
-                ratelimit_reset = response.headers['X-RateLimit-Reset']
-                to_sleep = int(ratelimit_reset) - int(time.time())
-                reset_str = datetime.datetime.fromtimestamp(int(ratelimit_reset)).strftime('%X')
-
-                # We're ratelimited, and we may be waiting for a long time. Cancel orders.
-                logger.warning("Canceling all known orders in the meantime.")
-                self.cancel([o['orderID'] for o in self.open_orders()])
-
-                logger.error("Your ratelimit will reset at %s. Sleeping for %d seconds." % (reset_str, to_sleep))
-                time.sleep(to_sleep)
-
-                # Retry the request.
-                return retry()
+            except requests.exceptions.Timeout as e:
+                # Timeout, re-run this request. The first time at once: the timeout was the wait.
+                logger.warning("Timed out on request: %s (%s), retrying..." % (path, json.dumps(postdict or '')))
+                attempt = self._backoff(attempt, max_retries, path, postdict, wait=attempt > 0)
+                continue
 
-            # 503 - BitMEX temporary downtime, likely due to a deploy. Try again
-            elif response.status_code == 503:
-                logger.warning("Unable to contact the BitMEX API (503), retrying. " +
+            except requests.exceptions.ConnectionError as e:
+                logger.warning("Unable to contact the BitMEX API (%s). Please check the URL. Retrying. " % e +
                                     "Request: %s \n %s" % (url, json.dumps(postdict)))
-                time.sleep(3)
-                return retry()
-
-            elif response.status_code == 400:
-                error = response.json()['error']
-                message = error['message'].lower() if error else ''
-
-                # Duplicate clOrdID: that's fine, probably a deploy, go get the order(s) and return it
-                if 'duplicate clordid' in message:
-                    orders = postdict['orders'] if 'orders' in postdict else postdict
-
-                    IDs = json.dumps({'clOrdID': [order['clOrdID'] for order in orders]})
-                    orderResults = self._curl_bitmex('/order', query={'filter': IDs}, verb='GET')
-
-                    for i, order in enumerate(orderResults):
-                        if (
-                                order['orderQty'] != abs(postdict['orderQty']) or
-                                order['side'] != ('Buy' if postdict['orderQty'] > 0 else 'Sell') or
-                                order['price'] != postdict['price'] or
-                                order['symbol'] != postdict['symbol']):
-                            raise Exception('Attempted to recover from duplicate clOrdID, but order returned from API ' +
-                                            'did not match POST.\nPOST data: %s\nReturned order: %s' % (
-                                                json.dumps(orders[i]), json.dumps(order)))
-                    # All good
-                    return orderResults
-
-                elif 'insufficient available balance' in message:
-                    logger.error('Account out of funds. The message: %s' % error['message'])
-                    exit_or_throw(Exception('Insufficient Funds'))
-
-
-            # If we haven't returned or re-raised yet, we get here.
-            logger.error("Unhandled Error: %s: %s" % (e, response.text))
-            logger.error("Endpoint was: %s %s: %s" % (verb, path, json.dumps(postdict)))
-            exit_or_throw(e)
-
-        except requests.exceptions.Timeout as e:
-            # Timeout, re-run this request
-            logger.warning("Timed out on request: %s (%s), retrying..." % (path, json.dumps(postdict or '')))
-            return retry()
-
-        except requests.exceptions.ConnectionError as e:
-            logger.warning("Unable to contact the BitMEX API (%s). Please check the URL. Retrying. " +
-                                "Request: %s %s \n %s" % (e, url, json.dumps(postdict)))
-            time.sleep(1)
-            return retry()
-
-        # Reset retry counter on success
-        self.retries = 0
-
-        return response.json()
+                attempt = self._backoff(attempt, max_retries, path, postdict)
+                continue
+
+            return response.json()
+
+    def _record_request(self, verb, path, prepped, response, latency, retry, tick):
+        """Add a request to the REST stats, and log them every statsInterval seconds."""
+        if response is not None:
+            status = response.status_code
+        else:
+            error = sys.exc_info()[1]
+            status = 'timeout' if isinstance(error, requests.exceptions.Timeout) else 'error'
+        remaining = response.headers.get('X-RateLimit-Remaining') if response is not None else None
+        self.request_stats.record(verb, path.lstrip('/'), status, latency,
+                                  len(prepped.body) if prepped is not None and prepped.body else 0,
+                                  len(response.content) if response is not None else 0,
+                                  retry, int(remaining) if remaining is not None else None, tick)
+        if self.statsInterval and time.time() - self.request_stats.since >= self.statsInterval:
+            stats, self.request_stats = self.request_stats, RequestStats()
+            logger.info(stats.format())
+
+    def _amended_orders(self, postdict):
+        """The orders of an amend by origClOrdID, if they all have its new clOrdIDs (it was applied);
+        otherwise None."""
+        amends = postdict['orders'] if 'orders' in postdict else [postdict]
+        if not all(amend.get('origClOrdID') and amend.get('clOrdID') for amend in amends):
+            return None
+        IDs = json.dumps({'clOrdID': [amend['clOrdID'] for amend in amends]})
+        byClOrdID = {order['clOrdID']: order for order in self._curl_bitmex('order', query={'filter': IDs}, verb='GET')}
+        if len(byClOrdID) != len(amends):
+            return None
+        logger.info("Amend was applied by an earlier attempt: %s" % ', '.join(byClOrdID))
+        orders = [byClOrdID[amend['clOrdID']] for amend in amends]
+        return orders if 'orders' in postdict else orders[0]
+
+    def _backoff(self, attempt, max_retries, path, postdict, wait=True):
+        """Wait before retrying a failed request, longer after each failure (unless not `wait`). Returns the
+        retry's number; raises once there are no retries left, or the circuit breaker has opened meanwhile."""
+        attempt += 1
+        if attempt > max_retries:
+            raise errors.APIUnavailableError("Max retries on %s (%s) hit, raising." % (path, json.dumps(postdict or '')))
+        if self.circuit.is_open():
+            raise errors.CircuitOpenError("BitMEX API unavailable, not retrying %s for %.1f seconds." %
+                                          (path, self.circuit.retry_in()))
+        if wait:
+            time.sleep(self.retry_policy.delay(attempt))
+        return attempt
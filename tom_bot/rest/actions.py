@@ -0,0 +1,80 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+
+# Order actions (creates, amends, cancels) sent concurrently, in order per order.
+#
+# A tick's amend, create and cancel batches are independent requests, but sent one after the other each
+# waits a full round trip for the previous one. OrderActionQueue runs them on a small thread pool (the REST
+# session keeps a connection per worker) and returns a Future per batch, so a tick pays for its slowest
+# request rather than the sum of them.
+#
+# Actions touching the same order must still reach the exchange in the order they were submitted (an amend
+# after the create it amends, a cancel after a pending amend). Each batch is submitted with the keys of the
+# orders it touches (orderID, or clOrdID for orders not created yet); a batch starts only once every earlier
+# batch sharing a key has finished, whether it succeeded or not. Unrelated batches start right away, unless
+# they are submitted to run `after` other batches: a tick's creates wait for its cancels, which free the
+# margin they need.
+
+class OrderActionQueue(object):
+
+    def __init__(self, workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='order-actions')
+        self.lock = threading.Lock()
+        self.pending = {}     # key -> Future of the last batch submitted touching it
+        self.futures = set()  # batches submitted since the last join()
+
+    def __repr__(self):
+        return 'OrderActionQueue(%d pending)' % sum(1 for f in list(self.futures) if not f.done())
+
+    def submit(self, keys, fn, *args, after=()):
+        '''Run fn(*args) once the earlier batches touching any of `keys`, and the `after` Futures, are done.
+        Returns its Future.'''
+        future = Future()
+        with self.lock:
+            after = set(after) | set(self.pending[key] for key in keys if key in self.pending)
+            for key in keys:
+                self.pending[key] = future
+            self.futures.add(future)
+        future.add_done_callback(lambda f: self.__forget(f, keys))
+
+        if not after:
+            self.executor.submit(self.__run, future, fn, args)
+            return future
+        waiting = [len(after)]
+
+        def on_done(_):
+            with self.lock:
+                waiting[0] -= 1
+                ready = waiting[0] == 0
+            if ready:
+                self.executor.submit(self.__run, future, fn, args)
+        for earlier in after:
+            earlier.add_done_callback(on_done)
+        return future
+
+    def join(self, timeout=None):
+        '''Wait for every batch submitted since the last join(), finished or not, so their errors can be
+        checked. Returns the (done, not done) sets of their Futures.'''
+        with self.lock:
+            futures, self.futures = self.futures, set()
+        return wait(futures, timeout)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def __run(self, future, fn, args):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def __forget(self, future, keys):
+        with self.lock:
+            for key in keys:
+                if self.pending.get(key) is future:
+                    del self.pending[key]
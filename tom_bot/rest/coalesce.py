@@ -0,0 +1,131 @@
+from collections import OrderedDict
+
+from tom_bot.utils import clordid
+
+
+# The order actions of one tick, collected before anything is sent and reduced to the fewest requests.
+#
+# The strategy asks for actions as it goes (cancel the entries, amend this stop, create that take profit);
+# sent as asked, they can cost several requests and even undo each other: an amend of an order canceled a
+# moment earlier fails with 'Invalid ordStatus' and forces a re-tick. TickActions records them instead and,
+# on flush(), sends at most one bulk cancel, one bulk amend and one bulk create:
+#   - an amend that leaves an order as it is, is dropped; two amends of one order are merged
+#   - an amend of an order that is being canceled is dropped, as is a second cancel of it
+#   - a cancel and a create of the same kind of order (same clOrdID key, type and side) become one amend
+#     of the open order, or nothing if it already is what the create asks for
+#   - a second create with the same key replaces the first
+
+# Fields an amend can change, and the open order field each is compared with. orderQty is compared with
+# leavesQty, as converge_orders does when deciding what to amend.
+AMENDED_FIELDS = (('price', 'price'), ('stopPx', 'stopPx'), ('orderQty', 'leavesQty'))
+
+
+class TickActions(object):
+
+    def __init__(self, open_orders=()):
+        self.open = {o['orderID']: o for o in open_orders}
+        self.cancels = OrderedDict()  # orderID -> open order
+        self.amends = OrderedDict()   # orderID -> amend
+        self.creates = OrderedDict()  # clOrdID key (or id() of an untagged order) -> order
+        self.coalesced = 0            # actions asked for that won't be sent
+        self.sent = {}                # kind -> the orders of the last flush()
+
+    def __repr__(self):
+        return 'TickActions(cancel=%d, amend=%d, create=%d, coalesced=%d)' % (
+            len(self.cancels), len(self.amends), len(self.creates), self.coalesced)
+
+    def __len__(self):
+        return len(self.cancels) + len(self.amends) + len(self.creates)
+
+    def cancel(self, orders):
+        for order in orders:
+            orderID = order['orderID']
+            if orderID in self.cancels:
+                self.coalesced += 1
+                continue
+            if self.amends.pop(orderID, None) is not None:
+                self.coalesced += 1
+            self.cancels[orderID] = self.open.get(orderID, order)
+
+    def amend(self, amends):
+        for amend in amends:
+            orderID = amend['orderID']
+            if orderID in self.cancels:
+                self.coalesced += 1
+                continue
+            merged = self.amends.pop(orderID, None)
+            if merged is not None:
+                self.coalesced += 1
+                merged.update(amend)
+            else:
+                merged = dict(amend)
+            if self.__unchanged(merged):
+                self.coalesced += 1
+            else:
+                self.amends[orderID] = merged
+
+    def create(self, orders):
+        for order in orders:
+            key = order.get('clOrdID') or id(order)
+            if self.creates.pop(key, None) is not None:
+                self.coalesced += 1
+            self.creates[key] = order
+
+    def plan(self):
+        '''The (cancels, amends, creates) to send, after turning cancel + create pairs into amends.'''
+        canceled = {}
+        for orderID, order in self.cancels.items():
+            tag = clordid.decode(order.get('clOrdID'))
+            if tag is not None:
+                canceled.setdefault(tag.key, []).append(orderID)
+
+        cancels = OrderedDict(self.cancels)
+        amends = OrderedDict(self.amends)
+        creates = []
+        for key, order in self.creates.items():
+            reuse = None
+            for orderID in canceled.get(key, ()):
+                existing = cancels.get(orderID)
+                if existing is not None and existing.get('ordType') == order.get('ordType') and \
+                        existing.get('side') == order.get('side'):
+                    reuse = orderID
+                    break
+            if reuse is None:
+                creates.append(order)
+                continue
+            # Keep the open order and move it to what the create asks for
+            del cancels[reuse]
+            self.coalesced += 2
+            amend = {'orderID': reuse, 'origClOrdID': existing['clOrdID'], 'ordType': order['ordType'],
+                     'side': order['side']}
+            for field, _ in AMENDED_FIELDS:
+                if field in order:
+                    amend[field] = order[field]
+            if not self.__unchanged(amend):
+                amends[reuse] = amend
+                self.coalesced -= 1
+        return list(cancels.values()), list(amends.values()), creates
+
+    def flush(self, exchange):
+        '''Send the tick's actions through the exchange's order action queue, one bulk request per kind. The
+        creates go out once the cancels are done, as the margin they need may be held by the canceled orders.
+        Returns their Futures by kind ('cancel', 'amend', 'create'), for the kinds sent.'''
+        cancels, amends, creates = self.plan()
+        self.sent = {'cancel': cancels, 'amend': amends, 'create': creates}
+        futures = {}
+        if cancels:
+            futures['cancel'] = exchange.submit_cancel(cancels)
+        if amends:
+            futures['amend'] = exchange.submit_amend(amends)
+        if creates:
+            futures['create'] = exchange.submit_create(creates, after=[futures['cancel']] if cancels else ())
+        self.cancels.clear()
+        self.amends.clear()
+        self.creates.clear()
+        return futures
+
+    def __unchanged(self, amend):
+        existing = self.open.get(amend['orderID'])
+        if existing is None:
+            return False
+        return all(amend[field] == existing.get(current) for field, current in AMENDED_FIELDS if field in amend)
@@ -0,0 +1,157 @@
+import threading
+import time
+
+
+# Client-side view of the BitMEX REST rate limits, so requests are paced before the exchange says no.
+#
+# BitMEX keeps a token bucket per account: `limit` requests, refilled continuously over a minute, plus a
+# short burst bucket (10 per second) for order placement, amends and cancels. Every response says where the
+# minute bucket stands (X-RateLimit-Limit / -Remaining / -Reset) and order responses carry the burst bucket
+# (X-RateLimit-Remaining-1s). RateLimiter mirrors both: acquire() before a request takes a token, waiting
+# for the refill when there is none, and update() with the response resets the estimate to what the
+# exchange reports, less the requests still in flight (which it hasn't counted yet when it answers).
+#
+# A 429 blocks new requests until the exchange's Retry-After (or the reset time) instead of retrying into
+# it. remaining() is the budget the strategy can check before spending requests on optional work.
+
+
+class TokenBucket(object):
+    '''`capacity` tokens, refilled at `rate` per second.'''
+
+    __slots__ = ('capacity', 'rate', 'tokens', 'stamp')
+
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate = capacity / float(period)
+        self.tokens = float(capacity)
+        self.stamp = time.time()
+
+    def __repr__(self):
+        return 'TokenBucket(%.1f/%d, %.2f/s)' % (self.tokens, self.capacity, self.rate)
+
+    def refill(self, now):
+        if now > self.stamp:
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def wait(self, cost=1):
+        '''Seconds until `cost` tokens are available (as of the last refill).'''
+        return 0 if self.tokens >= cost else (cost - self.tokens) / self.rate
+
+    def reset(self, capacity, tokens, period, now):
+        self.capacity = capacity
+        self.rate = capacity / float(period)
+        self.tokens = float(max(min(tokens, capacity), 0))
+        self.stamp = now
+
+
+class RateLimiter(object):
+
+    PERIOD = 60       # seconds the minute bucket takes to refill from empty
+    BURST_PERIOD = 1  # and the burst bucket
+
+    # Verbs that count against the burst bucket: order placement, amends and cancels
+    ORDER_VERBS = frozenset(['POST', 'PUT', 'DELETE'])
+
+    def __init__(self, limit=120, burst=10):
+        self.lock = threading.Lock()
+        self.minute = TokenBucket(limit, self.PERIOD)
+        self.burst = TokenBucket(burst, self.BURST_PERIOD) if burst else None
+        self.in_flight = 0
+        self.in_flight_orders = 0
+        self.blocked_until = 0    # set by a 429: nothing goes out before this (epoch seconds)
+        self.reset_at = None      # X-RateLimit-Reset of the last response: when the minute bucket is full again
+        self.waited = 0.0         # seconds spent waiting for tokens, since start
+        self.throttled = 0        # 429s received, since start
+
+    def __repr__(self):
+        return 'RateLimiter(minute=%r, burst=%r, in_flight=%d)' % (self.minute, self.burst, self.in_flight)
+
+    def acquire(self, verb='GET', block=True):
+        '''Take a token for a request, waiting for one if needed. With block=False, return False instead of
+        waiting. Every acquire must be followed by an update() (or update(None) if no response came).'''
+        order = self.burst is not None and verb in self.ORDER_VERBS
+        while True:
+            with self.lock:
+                now = time.time()
+                self.minute.refill(now)
+                wait = max(self.blocked_until - now, self.minute.wait())
+                if order:
+                    self.burst.refill(now)
+                    wait = max(wait, self.burst.wait())
+                if wait <= 0:
+                    self.minute.tokens -= 1
+                    self.in_flight += 1
+                    if order:
+                        self.burst.tokens -= 1
+                        self.in_flight_orders += 1
+                    return True
+                if not block:
+                    return False
+                self.waited += wait
+            time.sleep(wait)
+
+    def update(self, response, verb='GET'):
+        '''Take the exchange's word for the remaining budget from a response (None: the request failed
+        without one, just release it).'''
+        order = self.burst is not None and verb in self.ORDER_VERBS
+        with self.lock:
+            self.in_flight -= 1
+            if order:
+                self.in_flight_orders -= 1
+            if response is None:
+                return
+            now = time.time()
+            headers = response.headers
+            remaining = headers.get('X-RateLimit-Remaining')
+            if remaining is not None:
+                limit = int(headers.get('X-RateLimit-Limit', self.minute.capacity))
+                self.minute.reset(limit, int(remaining) - self.in_flight, self.PERIOD, now)
+            reset = headers.get('X-RateLimit-Reset')
+            if reset is not None:
+                self.reset_at = float(reset)
+            remaining_1s = headers.get('X-RateLimit-Remaining-1s')
+            if remaining_1s is not None and self.burst is not None:
+                self.burst.reset(self.burst.capacity, int(remaining_1s) - self.in_flight_orders,
+                                 self.BURST_PERIOD, now)
+            if response.status_code == 429:
+                self.throttled += 1
+                retry_after = headers.get('Retry-After')
+                if retry_after is not None:
+                    until = now + float(retry_after)
+                elif self.reset_at is not None:
+                    until = self.reset_at
+                else:
+                    until = now + 1 / self.minute.rate
+                self.blocked_until = max(self.blocked_until, until)
+                self.minute.reset(self.minute.capacity, 0, self.PERIOD, now)
+
+    def remaining(self):
+        '''Requests that can go out now without waiting.'''
+        with self.lock:
+            now = time.time()
+            if self.blocked_until > now:
+                return 0
+            self.minute.refill(now)
+            return int(self.minute.tokens)
+
+    def blocked_for(self):
+        '''Seconds until requests may go out again after a 429 (0 when not blocked).'''
+        return max(self.blocked_until - time.time(), 0)
+
+    def snapshot(self):
+        with self.lock:
+            now = time.time()
+            self.minute.refill(now)
+            if self.burst is not None:
+                self.burst.refill(now)
+            return {
+                'limit': self.minute.capacity,
+                'remaining': int(self.minute.tokens),
+                'burst_remaining': int(self.burst.tokens) if self.burst is not None else None,
+                'in_flight': self.in_flight,
+                'reset_at': self.reset_at,
+                'blocked_for': max(self.blocked_until - now, 0),
+                'waited': self.waited,
+                'throttled': self.throttled,
+            }
@@ -0,0 +1,111 @@
+import random
+import threading
+import time
+
+
+# When and how a failed REST request is sent again, and when to stop trying for a while.
+#
+# A request that fails without an answer from the exchange (a 503 while it's overloaded or deploying, a
+# timeout, a dropped connection) may be retried. RetryPolicy says how many times, per verb or per endpoint
+# ('GET' or 'GET position'), and how long to wait before each retry: exponential backoff with jitter, so
+# the first retry comes quickly and clients that failed together don't all come back at the same moment.
+# Each call keeps its own count; nothing is shared between calls or threads.
+#
+# A request refused with a 429 (rate limited) wasn't processed, so even a POST or PUT may be sent again once
+# the rate limiter lets it through; but only `ratelimited` more times, so a call can't wait on the limit forever.
+#
+# During an outage every call would still go through all its retries, stalling each tick for seconds.
+# CircuitBreaker counts failures (including 429s) across calls: after `failures` in a row it opens, and calls fail at once
+# (errors.CircuitOpenError) for `cooldown` seconds, so the strategy skips its ticks instead of waiting.
+# Then a single request is let through: if the exchange answers, the breaker closes again; if not, it
+# stays open for another cooldown.
+
+
+class RetryPolicy(object):
+
+    # Idempotent requests may be retried. A POST or PUT that timed out may still have been applied, so
+    # those are not retried unless the caller knows better; bulk amends are made safe to send twice (see
+    # BitMEX.amend_bulk_orders).
+    RETRIES = {'GET': 3, 'DELETE': 3, 'POST': 0, 'PUT': 0, 'PUT order/bulk': 2}
+
+    def __init__(self, retries=None, backoff=0.5, max_backoff=8, ratelimited=3):
+        self.retries = dict(self.RETRIES)
+        self.retries.update(retries or {})
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.ratelimited = ratelimited  # times a request is sent again after a 429
+
+    def __repr__(self):
+        return 'RetryPolicy(%r, backoff=%s, max_backoff=%s, ratelimited=%s)' % (
+            self.retries, self.backoff, self.max_backoff, self.ratelimited)
+
+    def attempts(self, verb, path):
+        '''How many times a failed `verb` request to `path` may be retried.'''
+        endpoint = '%s %s' % (verb, path.lstrip('/'))
+        if endpoint in self.retries:
+            return self.retries[endpoint]
+        return self.retries.get(verb, 0)
+
+    def delay(self, attempt):
+        '''Seconds to wait before retry number `attempt` (from 1): between half and all of the backoff.'''
+        backoff = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+
+class CircuitBreaker(object):
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'  # cooled down, one request is testing the exchange
+
+    def __init__(self, failures=5, cooldown=30):
+        self.lock = threading.Lock()
+        self.threshold = failures
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0     # in a row
+        self.opened_at = 0
+        self.trips = 0        # times opened, since start
+
+    def __repr__(self):
+        return 'CircuitBreaker(%s, %d failures)' % (self.state, self.failures)
+
+    def allow(self):
+        '''Whether a request may go out now. Every allowed request must be followed by success() or
+        failure(), so a half-open breaker knows how its test went.'''
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() >= self.opened_at + self.cooldown:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def success(self):
+        '''The exchange answered (whatever it said).'''
+        with self.lock:
+            self.failures = 0
+            self.state = self.CLOSED
+
+    def failure(self):
+        '''The exchange couldn't be reached, couldn't handle the request (5xx) or refused it for the rate
+        limit (429).'''
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+                self.state = self.OPEN
+                self.opened_at = time.time()
+                self.trips += 1
+
+    def is_open(self):
+        '''True while calls fail at once (including while a test request is out).'''
+        with self.lock:
+            return self.state == self.HALF_OPEN or \
+                (self.state == self.OPEN and time.time() < self.opened_at + self.cooldown)
+
+    def retry_in(self):
+        '''Seconds until a test request is let through (0 when not open).'''
+        with self.lock:
+            if self.state != self.OPEN:
+                return 0
+            return max(self.opened_at + self.cooldown - time.time(), 0)
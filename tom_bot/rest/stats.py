@@ -0,0 +1,139 @@
+import threading
+import time
+from collections import OrderedDict
+
+from tom_bot.ws.stats import Histogram
+
+
+# REST request instrumentation: what each endpoint costs, and which requests made a tick slow.
+#
+# BitMEX._curl_bitmex records every request it sends (each retry is a request of its own), per
+# (verb, endpoint): the latency from sending to the full response, the status code (or 'timeout' /
+# 'error' when no response came), whether it was a retry, the bytes sent and received, and the rate limit
+# the response reports (the last and lowest X-RateLimit-Remaining). Latencies go into the same fixed-bucket
+# histograms as the websocket ingest stats.
+#
+# Requests are also tagged with the tick that sent them (see BitMEX.trace_tick): the last TICKS_KEPT ticks
+# keep their request count and time spent in requests, per endpoint. Requests of a tick run concurrently on
+# the order action workers, so a tick's request time can add up to more than the tick took.
+#
+# Requests are recorded from several threads (the run loop, the order action workers), under a lock.
+
+TICKS_KEPT = 50
+
+
+class EndpointStats(object):
+    '''Counters of one (verb, endpoint).'''
+
+    __slots__ = ('requests', 'retries', 'statuses', 'latency', 'bytes_sent', 'bytes_received',
+                 'ratelimit_remaining', 'ratelimit_low')
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.statuses = {}     # status code, 'timeout' or 'error' -> count
+        self.latency = Histogram()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.ratelimit_remaining = None  # X-RateLimit-Remaining of the last response
+        self.ratelimit_low = None        # and the lowest one seen
+
+    def summary(self):
+        return {'requests': self.requests, 'retries': self.retries, 'statuses': dict(self.statuses),
+                'latency': self.latency.summary(), 'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received, 'ratelimit_remaining': self.ratelimit_remaining,
+                'ratelimit_low': self.ratelimit_low}
+
+
+class RequestStats(object):
+    '''REST counters and histograms since `since` (epoch seconds).'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.since = time.time()
+        self.endpoints = {}        # (verb, endpoint) -> EndpointStats
+        self.ticks = OrderedDict()  # tick -> {'requests', 'seconds', 'endpoints': {"VERB endpoint": seconds}}
+
+    def __repr__(self):
+        return 'RequestStats(%d requests in %.0fs)' % (sum(e.requests for e in self.endpoints.values()),
+                                                       time.time() - self.since)
+
+    def record(self, verb, endpoint, status, latency_s, sent, received, retry=False, ratelimit_remaining=None,
+               tick=None):
+        key = (verb, endpoint)
+        with self.lock:
+            stats = self.endpoints.get(key)
+            if stats is None:
+                stats = self.endpoints[key] = EndpointStats()
+            stats.requests += 1
+            if retry:
+                stats.retries += 1
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            stats.latency.add(latency_s)
+            stats.bytes_sent += sent
+            stats.bytes_received += received
+            if ratelimit_remaining is not None:
+                stats.ratelimit_remaining = ratelimit_remaining
+                if stats.ratelimit_low is None or ratelimit_remaining < stats.ratelimit_low:
+                    stats.ratelimit_low = ratelimit_remaining
+            if tick is not None:
+                self.__add_to_tick(tick, '%s %s' % key, latency_s)
+
+    def tick(self, tick):
+        '''Requests of `tick` so far: {'requests', 'seconds', 'endpoints'}, or None if it sent none (or is
+        no longer kept).'''
+        with self.lock:
+            traced = self.ticks.get(tick)
+            if traced is None:
+                return None
+            return dict(traced, endpoints=dict(traced['endpoints']))
+
+    def snapshot(self):
+        '''The stats as plain dicts (per "VERB endpoint" and per tick), e.g. for logging or a status page.'''
+        with self.lock:
+            elapsed = max(time.time() - self.since, 1e-9)
+            requests = sum(e.requests for e in self.endpoints.values())
+            return {
+                'since': self.since,
+                'seconds': elapsed,
+                'requests': requests,
+                'retries': sum(e.retries for e in self.endpoints.values()),
+                'per_minute': requests * 60 / elapsed,
+                'endpoints': {'%s %s' % key: e.summary() for key, e in self.endpoints.items()},
+                'ticks': OrderedDict((tick, dict(t, endpoints=dict(t['endpoints'])))
+                                     for tick, t in self.ticks.items()),
+            }
+
+    def format(self):
+        '''A compact multi-line summary for the log.'''
+        snap = self.snapshot()
+        lines = ['REST: %d requests (%d retries) in %.0fs: %.1f requests/min' %
+                 (snap['requests'], snap['retries'], snap['seconds'], snap['per_minute'])]
+        for key, e in sorted(snap['endpoints'].items()):
+            latency = e['latency']
+            lines.append('  %-28s %5d reqs %3d retries  p50 %s p99 %s max %s  %s  %.0f/%.0f KB out/in%s' %
+                         (key, e['requests'], e['retries'], _ms(latency.get('p50')), _ms(latency.get('p99')),
+                          _ms(latency.get('max')),
+                          ' '.join('%s:%d' % kv for kv in sorted(e['statuses'].items(), key=lambda kv: str(kv[0]))),
+                          e['bytes_sent'] / 1024.0, e['bytes_received'] / 1024.0,
+                          '  ratelimit low %d' % e['ratelimit_low'] if e['ratelimit_low'] is not None else ''))
+        slowest = sorted(snap['ticks'].items(), key=lambda kv: kv[1]['seconds'], reverse=True)[:3]
+        for tick, t in slowest:
+            endpoint, seconds = max(t['endpoints'].items(), key=lambda kv: kv[1])
+            lines.append('  tick %-6s %3d reqs in %s, most in %s (%s)' %
+                         (tick, t['requests'], _ms(t['seconds']), endpoint, _ms(seconds)))
+        return '\n'.join(lines)
+
+    def __add_to_tick(self, tick, endpoint, latency_s):
+        traced = self.ticks.get(tick)
+        if traced is None:
+            traced = self.ticks[tick] = {'requests': 0, 'seconds': 0.0, 'endpoints': {}}
+            while len(self.ticks) > TICKS_KEPT:
+                self.ticks.popitem(last=False)
+        traced['requests'] += 1
+        traced['seconds'] += latency_s
+        traced['endpoints'][endpoint] = traced['endpoints'].get(endpoint, 0.0) + latency_s
+
+
+def _ms(seconds):
+    return '%.2fms' % (seconds * 1000) if seconds is not None else '-'
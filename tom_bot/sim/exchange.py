@@ -0,0 +1,493 @@
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+from tom_bot.utils.timestamps import epoch_to_iso
+
+
+# A small, in-memory stand-in for the BitMEX exchange, for load testing the bot offline (see sim/server.py).
+#
+# Each symbol is an inverse contract (like XBTUSD: 1 contract = 1 USD, settled in XBt) whose price walks
+# randomly one tick at a time. Every market step publishes a quote, an instrument update, now and then a
+# trade, and the changed levels of a 25-level L2 book, then matches the account's resting orders against
+# the new prices: limit orders fill when the market reaches their price, stops trigger when the last price
+# crosses their stopPx and fill at it. Orders always fill in full. Positions, realised and unrealised PnL
+# and the margin follow the fills, well enough for the bot's arithmetic, not for accounting.
+#
+# State changes are published as websocket messages (table, action, rows) to the subscribers; the REST
+# methods raise ExchangeError with the HTTP status and message the real API would answer with.
+
+XBt = 100000000
+BOOK_DEPTH = 25
+TERMINAL = frozenset(['Filled', 'Canceled', 'Rejected'])
+
+# What the websocket partials name as each table's keys
+KEYS = {
+    'trade': [], 'quote': [], 'instrument': ['symbol'], 'order': ['orderID'], 'execution': ['execID'],
+    'position': ['account', 'symbol', 'currency'], 'margin': ['account', 'currency'],
+    'orderBookL2_25': ['symbol', 'id', 'side'], 'orderBookL2': ['symbol', 'id', 'side'],
+}
+
+
+# Fields every order update carries, whatever changed
+KEYED = frozenset(['orderID', 'account', 'symbol'])
+
+
+class ExchangeError(Exception):
+
+    def __init__(self, status, message):
+        super(ExchangeError, self).__init__(message)
+        self.status = status
+        self.message = message
+
+
+class Market(object):
+    '''The random walk of one symbol's price, in ticks.'''
+
+    def __init__(self, symbol, price, tick_size, volatility):
+        self.symbol = symbol
+        self.tick_size = tick_size
+        self.volatility = volatility  # largest move per step, in ticks
+        self.bid_tick = int(round(price / tick_size))
+        self.last = price
+        self.book = {}                # (side, price) -> size
+
+    @property
+    def bid(self):
+        return self.bid_tick * self.tick_size
+
+    @property
+    def ask(self):
+        return (self.bid_tick + 1) * self.tick_size
+
+    def step(self):
+        self.bid_tick = max(self.bid_tick + random.randint(-self.volatility, self.volatility), 2)
+
+    def levels(self):
+        '''The book the current prices imply: BOOK_DEPTH levels a side, with made-up sizes.'''
+        book = {}
+        for i in range(BOOK_DEPTH):
+            book[('Buy', (self.bid_tick - i) * self.tick_size)] = 1000 * (i + 1) + random.randint(0, 100)
+            book[('Sell', (self.bid_tick + 1 + i) * self.tick_size)] = 1000 * (i + 1) + random.randint(0, 100)
+        return book
+
+    def level_id(self, price):
+        return 8800000000 - int(round(price * 100))
+
+
+class Exchange(object):
+
+    # Terminal orders and executions kept for queries and partials
+    HISTORY = 1000
+    TRADES = 100
+
+    def __init__(self, symbols=('XBTUSD',), price=10000.0, tick_size=0.5, volatility=1, trade_ratio=0.2,
+                 balance=1.0, account=1):
+        self.lock = threading.RLock()
+        self.subscribers = []
+        self.account = account
+        self.trade_ratio = trade_ratio
+        self.markets = OrderedDict((s, Market(s, price, tick_size, volatility)) for s in symbols)
+        self.orders = OrderedDict()          # orderID -> order, open ones and the last HISTORY terminal ones
+        self.clOrdIDs = {}                   # clOrdID -> orderID
+        self.executions = deque(maxlen=self.HISTORY)
+        self.trades = {s: deque(maxlen=self.TRADES) for s in symbols}
+        self.quotes = {}
+        self.instruments = OrderedDict()
+        self.positions = OrderedDict()
+        now = epoch_to_iso(time.time())
+        for symbol, market in self.markets.items():
+            market.book = market.levels()
+            self.instruments[symbol] = {
+                'symbol': symbol, 'rootSymbol': symbol[:3], 'state': 'Open', 'typ': 'FFWCSX',
+                'quoteCurrency': 'USD', 'settlCurrency': 'XBt', 'tickSize': tick_size, 'lotSize': 1,
+                'multiplier': -XBt, 'isQuanto': False, 'isInverse': True, 'initMargin': 0.01, 'maintMargin': 0.005,
+                'underlyingToSettleMultiplier': -XBt, 'quoteToSettleMultiplier': None, 'maxOrderQty': 10000000,
+                'maxPrice': 1000000, 'fundingRate': 0.0001, 'indicativeFundingRate': 0.0001,
+                'indicativeSettlePrice': market.last, 'markMethod': 'FairPrice', 'markPrice': market.last,
+                'fairPrice': market.last, 'lastPrice': market.last, 'bidPrice': market.bid, 'askPrice': market.ask,
+                'midPrice': (market.bid + market.ask) / 2, 'volume': 0, 'volume24h': 0, 'openInterest': 0,
+                'timestamp': now}
+            self.quotes[symbol] = self.__quote(market, now)
+            self.positions[symbol] = {
+                'account': account, 'symbol': symbol, 'currency': 'XBt', 'leverage': 1, 'crossMargin': False,
+                'isOpen': False, 'currentQty': 0, 'markPrice': market.last, 'lastPrice': market.last,
+                'homeNotional': 0, 'foreignNotional': 0, 'posMargin': 0, 'maintMargin': 0, 'initMargin': 0,
+                'grossOpenCost': 0, 'openOrderBuyQty': 0, 'openOrderSellQty': 0, 'realisedPnl': 0,
+                'realisedGrossPnl': 0, 'unrealisedPnl': 0, 'unrealisedPnlPcnt': 0, 'unrealisedRoePcnt': 0,
+                'avgCostPrice': None, 'avgEntryPrice': None, 'breakEvenPrice': None, 'liquidationPrice': None,
+                'bankruptPrice': None, 'timestamp': now}
+        self.margin = {
+            'account': account, 'currency': 'XBt', 'amount': int(balance * XBt), 'walletBalance': int(balance * XBt),
+            'marginBalance': int(balance * XBt), 'availableMargin': int(balance * XBt),
+            'withdrawableMargin': int(balance * XBt), 'excessMargin': int(balance * XBt), 'initMargin': 0,
+            'maintMargin': 0, 'marginUsedPcnt': 0, 'marginLeverage': 0, 'riskValue': 0, 'realisedPnl': 0,
+            'unrealisedPnl': 0, 'timestamp': now}
+
+    def __repr__(self):
+        return 'Exchange(%s, %d open orders)' % (', '.join(self.markets), len(self.open_orders()))
+
+    #
+    # Websocket side
+    #
+
+    def subscribe(self, callback, images):
+        '''Call callback(table, action, rows) on every change from now on. Returns the partial image of each
+        (table, symbol) in `images` (symbol None for the whole table), taken atomically with subscribing,
+        so nothing is missed or seen twice in between.'''
+        with self.lock:
+            self.subscribers.append(callback)
+            return [(table, symbol, self.image(table, symbol)) for table, symbol in images]
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def image(self, table, symbol=None):
+        if table == 'trade':
+            rows = [t for s in self.trades for t in self.trades[s]]
+        elif table.startswith('quote'):
+            rows = list(self.quotes.values())
+        elif table == 'instrument':
+            rows = list(self.instruments.values())
+        elif table == 'order':
+            rows = self.open_orders()
+        elif table == 'execution':
+            rows = list(self.executions)
+        elif table == 'position':
+            rows = list(self.positions.values())
+        elif table == 'margin':
+            rows = [self.margin]
+        elif table in ('orderBookL2', 'orderBookL2_25'):
+            rows = [self.__level(market, side, price, size)
+                    for market in self.markets.values() for (side, price), size in sorted(market.book.items())]
+        else:
+            raise ExchangeError(400, 'Unknown table: %s' % table)
+        if symbol is not None:
+            rows = [r for r in rows if r.get('symbol') == symbol]
+        return [dict(r) for r in rows]
+
+    def publish(self, table, action, rows):
+        if not rows:
+            return
+        for callback in list(self.subscribers):
+            callback(table, action, rows)
+
+    #
+    # Market
+    #
+
+    def step(self, symbol):
+        '''Move the market one step: new prices, a quote, maybe a trade, the book, then match orders.'''
+        with self.lock:
+            market = self.markets[symbol]
+            market.step()
+            now = time.time()
+            ts = epoch_to_iso(now)
+            if random.random() < self.trade_ratio:
+                side = random.choice(('Buy', 'Sell'))
+                market.last = market.ask if side == 'Buy' else market.bid
+                size = random.randint(1, 50) * 100
+                trade = {'timestamp': ts, 'symbol': symbol, 'side': side, 'size': size, 'price': market.last,
+                         'tickDirection': 'PlusTick' if side == 'Buy' else 'MinusTick',
+                         'trdMatchID': str(uuid.uuid4()), 'grossValue': int(size * XBt / market.last),
+                         'homeNotional': size / market.last, 'foreignNotional': size}
+                self.trades[symbol].append(trade)
+                self.publish('trade', 'insert', [trade])
+            quote = self.quotes[symbol] = self.__quote(market, ts)
+            self.publish('quote', 'insert', [quote])
+
+            instrument = self.instruments[symbol]
+            changes = {'symbol': symbol, 'bidPrice': market.bid, 'askPrice': market.ask,
+                       'midPrice': (market.bid + market.ask) / 2, 'lastPrice': market.last,
+                       'markPrice': market.last, 'fairPrice': market.last, 'indicativeSettlePrice': market.last,
+                       'timestamp': ts}
+            instrument.update(changes)
+            self.publish('instrument', 'update', [changes])
+            self.__book(market)
+            self.__match(symbol, now)
+            self.__mark(symbol, ts)
+
+    def __quote(self, market, ts):
+        return {'timestamp': ts, 'symbol': market.symbol, 'bidSize': market.book.get(('Buy', market.bid), 1000),
+                'bidPrice': market.bid, 'askPrice': market.ask,
+                'askSize': market.book.get(('Sell', market.ask), 1000)}
+
+    def __level(self, market, side, price, size):
+        return {'symbol': market.symbol, 'id': market.level_id(price), 'side': side, 'size': size, 'price': price}
+
+    def __book(self, market):
+        old, new = market.book, market.levels()
+        market.book = new
+        deletes = [{'symbol': market.symbol, 'id': market.level_id(p), 'side': s} for s, p in old if (s, p) not in new]
+        inserts = [self.__level(market, s, p, size) for (s, p), size in new.items() if (s, p) not in old]
+        updates = [{'symbol': market.symbol, 'id': market.level_id(p), 'side': s, 'size': size}
+                   for (s, p), size in new.items() if (s, p) in old and old[(s, p)] != size]
+        for table in ('orderBookL2_25', 'orderBookL2'):
+            self.publish(table, 'delete', deletes)
+            self.publish(table, 'insert', inserts)
+            self.publish(table, 'update', updates)
+
+    #
+    # Orders
+    #
+
+    def open_orders(self, symbol=None):
+        return [o for o in self.orders.values()
+                if o['ordStatus'] not in TERMINAL and (symbol is None or o['symbol'] == symbol)]
+
+    def create(self, orders):
+        with self.lock:
+            for order in orders:
+                if order.get('symbol') not in self.markets:
+                    raise ExchangeError(400, 'Invalid symbol')
+                if order.get('clOrdID') and order['clOrdID'] in self.clOrdIDs:
+                    raise ExchangeError(400, 'Duplicate clOrdID')
+            now = time.time()
+            created = [self.__new_order(order, now) for order in orders]
+            self.publish('order', 'insert', [dict(o) for o in created])
+            for order in created:
+                # Post-only orders that would take liquidity are canceled rather than filled
+                if order['ordType'] == 'Limit' and 'ParticipateDoNotInitiate' in order['execInst'] and \
+                        self.__crosses(order):
+                    self.__finish(order, 'Canceled', now,
+                                  'Canceled: Order had execInst of ParticipateDoNotInitiate')
+            self.__match(None, now)
+            return [dict(o) for o in created]
+
+    def amend(self, amends):
+        with self.lock:
+            found = [(self.__find(a), a) for a in amends]
+            for order, amend in found:
+                if order['ordStatus'] in TERMINAL:
+                    raise ExchangeError(400, 'Invalid ordStatus')
+                clOrdID = amend.get('clOrdID')
+                if clOrdID and clOrdID != order['clOrdID'] and clOrdID in self.clOrdIDs:
+                    raise ExchangeError(400, 'Duplicate clOrdID')
+            now = time.time()
+            ts = epoch_to_iso(now)
+            changes = []
+            for order, amend in found:
+                change = {'orderID': order['orderID'], 'account': self.account, 'symbol': order['symbol']}
+                for field in ('price', 'stopPx', 'orderQty'):
+                    if amend.get(field) is not None:
+                        change[field] = amend[field]
+                if amend.get('leavesQty') is not None:
+                    change['orderQty'] = order['cumQty'] + amend['leavesQty']
+                if 'orderQty' in change:
+                    change['leavesQty'] = change['orderQty'] - order['cumQty']
+                if amend.get('clOrdID') and amend.get('clOrdID') != order['clOrdID']:
+                    self.clOrdIDs[amend['clOrdID']] = order['orderID']
+                    change['clOrdID'] = amend['clOrdID']
+                change['text'] = amend.get('text', 'Amended: ' + ' '.join(sorted(k for k in change if k not in KEYED)))
+                change['timestamp'] = change['transactTime'] = ts
+                order.update(change)
+                changes.append(change)
+            self.publish('order', 'update', changes)
+            self.__match(None, now)
+            return [dict(order) for order, _ in found]
+
+    def cancel(self, orderIDs=(), clOrdIDs=(), text=None):
+        with self.lock:
+            now = time.time()
+            result = []
+            for ref in [{'orderID': i} for i in orderIDs] + [{'clOrdID': c} for c in clOrdIDs]:
+                order = self.__find(ref)
+                if order['ordStatus'] in TERMINAL:
+                    row = dict(order)
+                    row['error'] = 'Unable to cancel order due to existing state: %s' % order['ordStatus']
+                    result.append(row)
+                    continue
+                self.__finish(order, 'Canceled', now, text or 'Canceled: Cancel from www.bitmex.com')
+                result.append(dict(order))
+            return result
+
+    def query_orders(self, filter=None, count=100, reverse=False, symbol=None):
+        with self.lock:
+            orders = list(self.orders.values())
+        if symbol:
+            orders = [o for o in orders if o['symbol'] == symbol]
+        for field, value in (filter or {}).items():
+            if field == 'open':
+                orders = [o for o in orders if (o['ordStatus'] not in TERMINAL) == bool(value)]
+            elif field == 'ordStatus.isTerminated':
+                orders = [o for o in orders if (o['ordStatus'] in TERMINAL) == bool(value)]
+            else:
+                values = value if isinstance(value, list) else [value]
+                orders = [o for o in orders if o.get(field) in values]
+        if reverse:
+            orders.reverse()
+        return [dict(o) for o in orders[:count]]
+
+    def trade_history(self, symbol=None, count=100, reverse=False):
+        with self.lock:
+            rows = [e for e in self.executions if symbol is None or e['symbol'] == symbol]
+        if reverse:
+            rows.reverse()
+        return [dict(e) for e in rows[:count]]
+
+    def set_leverage(self, symbol, leverage):
+        with self.lock:
+            if symbol not in self.positions:
+                raise ExchangeError(400, 'Invalid symbol')
+            position = self.positions[symbol]
+            position['leverage'] = leverage
+            position['crossMargin'] = leverage == 0
+            self.publish('position', 'update', [{'account': self.account, 'symbol': symbol, 'currency': 'XBt',
+                                                 'leverage': leverage, 'crossMargin': leverage == 0}])
+            return dict(position)
+
+    def __find(self, ref):
+        clOrdID = ref.get('origClOrdID') or ref.get('clOrdID')
+        orderID = ref.get('orderID') or self.clOrdIDs.get(clOrdID)
+        order = self.orders.get(orderID)
+        # A clOrdID names an order only until an amend gives it another one
+        if order is None or (not ref.get('orderID') and order['clOrdID'] != clOrdID):
+            raise ExchangeError(404, 'Not Found')
+        return order
+
+    def __new_order(self, order, now):
+        ts = epoch_to_iso(now)
+        qty = order.get('orderQty') or 0
+        side = order.get('side') or ('Buy' if qty > 0 else 'Sell')
+        qty = abs(qty)
+        ordType = order.get('ordType') or ('Stop' if order.get('stopPx') else 'Limit' if order.get('price') else 'Market')
+        row = {
+            'orderID': str(uuid.uuid4()), 'clOrdID': order.get('clOrdID') or '', 'clOrdLinkID': '',
+            'account': self.account, 'symbol': order['symbol'], 'side': side, 'orderQty': qty,
+            'price': order.get('price'), 'displayQty': None, 'stopPx': order.get('stopPx'), 'pegOffsetValue': None,
+            'pegPriceType': '', 'currency': 'USD', 'settlCurrency': 'XBt', 'ordType': ordType,
+            'timeInForce': 'GoodTillCancel', 'execInst': order.get('execInst') or '', 'contingencyType': '',
+            'ordStatus': 'New', 'triggered': '', 'workingIndicator': ordType == 'Limit', 'ordRejReason': '',
+            'leavesQty': qty, 'cumQty': 0, 'avgPx': None, 'text': order.get('text') or 'Submitted via API.',
+            'transactTime': ts, 'timestamp': ts}
+        self.orders[row['orderID']] = row
+        if row['clOrdID']:
+            self.clOrdIDs[row['clOrdID']] = row['orderID']
+        return row
+
+    def __crosses(self, order):
+        market = self.markets[order['symbol']]
+        return order['price'] >= market.ask if order['side'] == 'Buy' else order['price'] <= market.bid
+
+    def __match(self, symbol, now):
+        for order in self.open_orders(symbol):
+            market = self.markets[order['symbol']]
+            if order['ordType'] == 'Limit':
+                if self.__crosses(order):
+                    # At the limit price or better: an order that crosses the spread takes the touch
+                    price = min(order['price'], market.ask) if order['side'] == 'Buy' else max(order['price'], market.bid)
+                    self.__fill(order, price, now)
+            elif order['ordType'] == 'Market':
+                self.__fill(order, market.ask if order['side'] == 'Buy' else market.bid, now)
+            elif order['ordType'] == 'Stop':
+                if (order['side'] == 'Buy' and market.last >= order['stopPx']) or \
+                        (order['side'] == 'Sell' and market.last <= order['stopPx']):
+                    self.__fill(order, market.last, now)
+
+    def __fill(self, order, price, now):
+        position = self.positions[order['symbol']]
+        qty = order['leavesQty'] if order['side'] == 'Buy' else -order['leavesQty']
+        if 'ReduceOnly' in order['execInst'] and (position['currentQty'] == 0 or
+                                                  (qty > 0) == (position['currentQty'] > 0)):
+            self.__finish(order, 'Canceled', now, 'Canceled: ReduceOnly order would have increased the position')
+            return
+        ts = epoch_to_iso(now)
+        order.update({'ordStatus': 'Filled', 'cumQty': order['orderQty'], 'leavesQty': 0, 'avgPx': price,
+                      'workingIndicator': False, 'triggered': 'StopOrderTriggered' if order['stopPx'] else '',
+                      'timestamp': ts, 'transactTime': ts})
+        execution = dict(order)
+        execution.update({'execID': str(uuid.uuid4()), 'execType': 'Trade', 'lastQty': abs(qty), 'lastPx': price,
+                          'lastLiquidityInd': 'AddedLiquidity' if order['ordType'] == 'Limit' else 'RemovedLiquidity',
+                          'execCost': int(qty * XBt / price), 'execComm': 0, 'commission': 0})
+        self.executions.append(execution)
+        self.__trim()
+        self.publish('execution', 'insert', [dict(execution)])
+        self.publish('order', 'update', [{'orderID': order['orderID'], 'account': self.account,
+                                          'symbol': order['symbol'], 'ordStatus': 'Filled', 'leavesQty': 0,
+                                          'cumQty': order['cumQty'], 'avgPx': price, 'workingIndicator': False,
+                                          'triggered': order['triggered'], 'timestamp': ts, 'transactTime': ts}])
+        self.__move_position(position, qty, price)
+
+    def __finish(self, order, status, now, text):
+        ts = epoch_to_iso(now)
+        order.update({'ordStatus': status, 'leavesQty': 0, 'workingIndicator': False, 'text': text,
+                      'timestamp': ts, 'transactTime': ts})
+        self.__trim()
+        self.publish('order', 'update', [{'orderID': order['orderID'], 'account': self.account,
+                                          'symbol': order['symbol'], 'ordStatus': status, 'leavesQty': 0,
+                                          'workingIndicator': False, 'text': text, 'timestamp': ts,
+                                          'transactTime': ts}])
+
+    def __trim(self):
+        terminal = [i for i, o in self.orders.items() if o['ordStatus'] in TERMINAL]
+        for orderID in terminal[:max(len(terminal) - self.HISTORY, 0)]:
+            self.clOrdIDs.pop(self.orders.pop(orderID)['clOrdID'], None)
+
+    #
+    # Position and margin
+    #
+
+    def __move_position(self, position, qty, price):
+        current = position['currentQty']
+        avg = position['avgEntryPrice']
+        realised = 0
+        if current == 0 or (current > 0) == (qty > 0):
+            # Opening or adding: the entry price averages in 1/price, as for any inverse contract
+            total = current + qty
+            avg = total / (current / avg + qty / price) if current else price
+        else:
+            closed = min(abs(qty), abs(current)) * (1 if current > 0 else -1)
+            realised = int(round(closed * (1 / avg - 1 / price) * XBt))
+            total = current + qty
+            if total == 0:
+                avg = None
+            elif (total > 0) != (current > 0):
+                avg = price  # flipped: the rest is a new position at this price
+        position.update({'currentQty': total, 'avgEntryPrice': avg, 'avgCostPrice': avg, 'breakEvenPrice': avg,
+                         'isOpen': total != 0, 'realisedPnl': position['realisedPnl'] + realised,
+                         'realisedGrossPnl': position['realisedGrossPnl'] + realised})
+        self.margin['walletBalance'] += realised
+        self.margin['amount'] += realised
+        self.margin['realisedPnl'] += realised
+
+    def __mark(self, symbol, ts):
+        '''Re-mark the position and the margin at the current price and publish them.'''
+        position = self.positions[symbol]
+        mark = self.markets[symbol].last
+        qty = position['currentQty']
+        avg = position['avgEntryPrice']
+        leverage = position['leverage'] or 100
+        unrealised = int(round(qty * (1 / avg - 1 / mark) * XBt)) if qty else 0
+        posMargin = int(abs(qty) / avg * XBt / leverage) if qty else 0
+        orders = self.open_orders(symbol)
+        openCost = sum(int(o['leavesQty'] * XBt / (o['price'] or o['stopPx'])) for o in orders
+                       if o['price'] or o['stopPx'])
+        changes = {'account': self.account, 'symbol': symbol, 'currency': 'XBt', 'markPrice': mark, 'lastPrice': mark,
+                   'homeNotional': qty / mark, 'foreignNotional': -qty, 'unrealisedPnl': unrealised,
+                   'unrealisedPnlPcnt': unrealised / (abs(qty) / avg * XBt) if qty else 0,
+                   'unrealisedRoePcnt': unrealised / posMargin if posMargin else 0,
+                   'posMargin': posMargin, 'initMargin': posMargin, 'maintMargin': posMargin // 2,
+                   'grossOpenCost': openCost,
+                   'openOrderBuyQty': sum(o['leavesQty'] for o in orders if o['side'] == 'Buy'),
+                   'openOrderSellQty': sum(o['leavesQty'] for o in orders if o['side'] == 'Sell'),
+                   'currentQty': qty, 'avgEntryPrice': avg, 'avgCostPrice': avg, 'breakEvenPrice': avg,
+                   'isOpen': qty != 0, 'realisedPnl': position['realisedPnl'], 'timestamp': ts}
+        position.update(changes)
+        self.publish('position', 'update', [changes])
+
+        margin = self.margin
+        unrealised = sum(p['unrealisedPnl'] for p in self.positions.values())
+        used = sum(p['posMargin'] for p in self.positions.values())
+        balance = margin['walletBalance'] + unrealised
+        changes = {'account': self.account, 'currency': 'XBt', 'amount': margin['amount'],
+                   'walletBalance': margin['walletBalance'], 'unrealisedPnl': unrealised,
+                   'marginBalance': balance, 'availableMargin': balance - used, 'withdrawableMargin': balance - used,
+                   'excessMargin': balance - used, 'initMargin': used, 'maintMargin': used // 2,
+                   'marginUsedPcnt': used / balance if balance else 0, 'realisedPnl': margin['realisedPnl'],
+                   'timestamp': ts}
+        margin.update(changes)
+        self.publish('margin', 'update', [changes])
@@ -0,0 +1,426 @@
+import base64
+import hashlib
+import json
+import logging
+import queue
+import random
+import socket
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from tom_bot.auth.APIKeyAuth import generate_signature
+from tom_bot.rest.ratelimit import TokenBucket
+from tom_bot.sim.exchange import Exchange, ExchangeError, KEYS
+from tom_bot.utils.timestamps import epoch_to_iso
+
+
+# A local stand-in for BitMEX's REST API and realtime websocket, on one port, for load tests and benchmarks
+# without the network. Point the bot at it with BASE_URL = 'http://127.0.0.1:<port>/api/v1/', or run it with
+# `tombot serve`.
+#
+# REST: order (GET, POST, PUT, DELETE), order/bulk (POST, PUT), order/all (DELETE), position/leverage,
+# position/isolate, instrument and execution/tradeHistory, on the in-memory Exchange (sim/exchange.py).
+# Requests must be signed like APIKeyAuth.generate_signature does, with the configured key and secret.
+# Every response carries X-RateLimit-* headers from a token bucket per key, and exhausting it gets a 429,
+# as on BitMEX. On top of that, `latency` (plus up to `jitter`) delays each response, and `errors` makes a
+# share of requests fail, e.g. {429: 0.01, 503: 0.02}.
+#
+# Websocket: /realtime?subscribe=..., authenticated with the api-expires/api-signature/api-key headers
+# for the private tables. It sends the welcome, the subscription acks and a partial per subscription, then
+# the inserts, updates and deletes the Exchange publishes. A market thread steps every symbol `rate` times
+# a second. The websocket protocol is implemented here (RFC 6455, no extensions), so nothing beyond the
+# standard library is needed.
+
+logger = logging.getLogger('sim')
+
+PRIVATE_TABLES = frozenset(['order', 'execution', 'position', 'margin'])
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+class SimServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), api_key='key', api_secret='secret', exchange=None, rate=10.0,
+                 latency=0.0, jitter=0.0, errors=None, rate_limit=120, burst=10):
+        ThreadingHTTPServer.__init__(self, address, Handler)
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.exchange = exchange or Exchange()
+        self.rate = rate
+        self.latency = latency
+        self.jitter = jitter
+        self.errors = dict(errors or {})
+        self.limits = {'minute': TokenBucket(rate_limit, 60), 'burst': TokenBucket(burst, 1)} if rate_limit else None
+        self.limits_lock = threading.Lock()
+        self.requests = 0
+        self.stopped = threading.Event()
+        self.market = threading.Thread(target=self.run_market, name='sim-market')
+        self.market.daemon = True
+
+    @property
+    def base_url(self):
+        return 'http://%s:%d/api/v1/' % self.server_address[:2]
+
+    def start(self):
+        '''Serve and run the market in background threads.'''
+        self.market.start()
+        thread = threading.Thread(target=self.serve_forever, name='sim-http')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.shutdown()
+        self.server_close()
+
+    def run_market(self):
+        '''Step every symbol `rate` times a second, catching up in bursts if a step runs late.'''
+        interval = 1.0 / self.rate if self.rate else None
+        next_step = time.time()
+        while not self.stopped.is_set():
+            if interval is None:
+                self.stopped.wait(1)
+                continue
+            for symbol in self.exchange.markets:
+                self.exchange.step(symbol)
+            next_step += interval
+            delay = next_step - time.time()
+            if delay > 0:
+                self.stopped.wait(delay)
+            elif delay < -1:
+                next_step = time.time()  # more than a second behind: drop the backlog rather than spin
+
+    def take(self, verb):
+        '''Take a request from the rate limit. Returns (headers, allowed).'''
+        if self.limits is None:
+            return {}, True
+        with self.limits_lock:
+            now = time.time()
+            minute, burst = self.limits['minute'], self.limits['burst']
+            minute.refill(now)
+            burst.refill(now)
+            order = verb != 'GET'
+            allowed = minute.tokens >= 1 and (not order or burst.tokens >= 1)
+            if allowed:
+                minute.tokens -= 1
+                if order:
+                    burst.tokens -= 1
+            headers = {'X-RateLimit-Limit': str(minute.capacity), 'X-RateLimit-Remaining': str(int(minute.tokens)),
+                       'X-RateLimit-Reset': str(int(now + (minute.capacity - minute.tokens) / minute.rate))}
+            if order:
+                headers['X-RateLimit-Remaining-1s'] = str(int(burst.tokens))
+            if not allowed:
+                headers['Retry-After'] = str(max(int(round(minute.wait() if minute.tokens < 1 else burst.wait())), 1))
+            return headers, allowed
+
+    def check_signature(self, verb, path, headers, body=''):
+        if headers.get('api-key') != self.api_key:
+            return 'Invalid API Key.'
+        expires = headers.get('api-expires')
+        if expires is None or int(expires) < time.time():
+            return 'This request has expired - `expires` is in the past.'
+        if generate_signature(self.api_secret, verb, path, expires, body) != headers.get('api-signature'):
+            return 'Signature not valid.'
+        return None
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'bitmex-sim'
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def do_GET(self):
+        if self.path.startswith('/realtime'):
+            return self.realtime()
+        self.rest('GET')
+
+    def do_POST(self):
+        self.rest('POST')
+
+    def do_PUT(self):
+        self.rest('PUT')
+
+    def do_DELETE(self):
+        self.rest('DELETE')
+
+    #
+    # REST
+    #
+
+    def rest(self, verb):
+        server = self.server
+        server.requests += 1
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf8') if length else ''
+        delay = server.latency + random.random() * server.jitter
+        if delay:
+            time.sleep(delay)
+
+        headers, allowed = server.take(verb)
+        if not allowed:
+            return self.reply(429, {'error': {'message': 'Rate limit exceeded, retry in 1 seconds.',
+                                              'name': 'RateLimitError'}}, headers)
+        for status, share in server.errors.items():
+            if random.random() < share:
+                if status == 429:
+                    headers['Retry-After'] = '1'
+                return self.reply(status, {'error': {'message': 'Injected error.', 'name': 'HTTPError'}}, headers)
+
+        error = server.check_signature(verb, self.path, self.headers, body)
+        if error is not None:
+            return self.reply(401, {'error': {'message': error, 'name': 'HTTPError'}}, headers)
+
+        url = urlsplit(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        try:
+            params = dict(query, **json.loads(body)) if body else query
+            result = self.route(verb, url.path, params)
+        except ExchangeError as e:
+            return self.reply(e.status, {'error': {'message': e.message, 'name': 'HTTPError'}}, headers)
+        except (ValueError, KeyError, TypeError) as e:
+            return self.reply(400, {'error': {'message': 'Invalid request: %s' % e, 'name': 'ValidationError'}}, headers)
+        self.reply(200, result, headers)
+
+    def route(self, verb, path, params):
+        exchange = self.server.exchange
+        endpoint = path[len('/api/v1/'):] if path.startswith('/api/v1/') else path.lstrip('/')
+        filter = params.get('filter')
+        if isinstance(filter, str):
+            filter = json.loads(filter)
+        count = int(params.get('count', 100))
+        reverse = str(params.get('reverse', 'false')).lower() == 'true'
+
+        if endpoint == 'order' and verb == 'GET':
+            return exchange.query_orders(filter, count, reverse, params.get('symbol'))
+        if endpoint == 'order' and verb == 'POST':
+            return exchange.create([params])[0]
+        if endpoint == 'order/bulk' and verb == 'POST':
+            return exchange.create(params['orders'])
+        if endpoint == 'order' and verb == 'PUT':
+            return exchange.amend([params])[0]
+        if endpoint == 'order/bulk' and verb == 'PUT':
+            return exchange.amend(params['orders'])
+        if endpoint == 'order' and verb == 'DELETE':
+            return exchange.cancel(_list(params.get('orderID')), _list(params.get('clOrdID')), params.get('text'))
+        if endpoint == 'order/all' and verb == 'DELETE':
+            orders = exchange.open_orders(params.get('symbol'))
+            return exchange.cancel([o['orderID'] for o in orders], text=params.get('text'))
+        if endpoint in ('position/leverage', 'position/isolate') and verb == 'POST':
+            return exchange.set_leverage(params['symbol'], float(params.get('leverage', 0)))
+        if endpoint == 'instrument' and verb == 'GET':
+            rows = exchange.image('instrument', params.get('symbol'))
+            for field, value in (filter or {}).items():
+                rows = [r for r in rows if r.get(field) == value]
+            return rows[:count]
+        if endpoint == 'execution/tradeHistory' and verb == 'GET':
+            return exchange.trade_history(params.get('symbol'), count, reverse)
+        raise ExchangeError(404, 'Not Found')
+
+    def reply(self, status, result, headers=None):
+        body = json.dumps(result).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    #
+    # Websocket
+    #
+
+    def realtime(self):
+        server = self.server
+        key = self.headers.get('Sec-WebSocket-Key')
+        if key is None or 'websocket' not in (self.headers.get('Upgrade') or '').lower():
+            return self.reply(400, {'error': {'message': 'Expected a websocket upgrade.', 'name': 'HTTPError'}})
+        # The signature covers '/realtime' alone, not the subscriptions
+        authenticated = 'api-signature' in self.headers and \
+            server.check_signature('GET', '/realtime', self.headers) is None
+
+        self.send_response(101, 'Switching Protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode('ascii')).digest()).decode('ascii')
+        self.send_header('Sec-WebSocket-Accept', accept)
+        self.end_headers()
+        self.close_connection = True
+
+        session = WebsocketSession(self.connection, self.rfile, server.exchange, authenticated)
+        query = parse_qs(urlsplit(self.path).query)
+        subscriptions = [s for arg in query.get('subscribe', []) for s in arg.split(',') if s]
+        session.run(subscriptions)
+
+
+class WebsocketSession(object):
+    '''One realtime connection: its subscriptions, and a queue of frames for it to send.'''
+
+    # Frames queued for a client that isn't reading them before it is disconnected
+    MAX_QUEUE = 100000
+
+    def __init__(self, sock, rfile, exchange, authenticated):
+        self.sock = sock
+        self.rfile = rfile
+        self.exchange = exchange
+        self.authenticated = authenticated
+        self.topics = {}         # table -> set of symbols, or None for every symbol
+        self.quote_table = None  # the quote table asked for (quote, quoteBin1m, ...): published quotes go out as it
+        self.frames = queue.Queue()
+        self.closed = threading.Event()
+        self.write_lock = threading.Lock()
+
+    def run(self, subscriptions):
+        self.send_text({'info': 'Welcome to the BitMEX Realtime API.', 'version': 'sim',
+                        'timestamp': epoch_to_iso(time.time()), 'docs': 'https://www.bitmex.com/app/wsAPI',
+                        'limit': {'remaining': 39}})
+        images = []
+        for subscription in subscriptions:
+            table, _, symbol = subscription.partition(':')
+            if table not in KEYS and not table.startswith('quote'):
+                self.send_text({'success': False, 'error': 'Unknown table: %s' % table, 'status': 400,
+                                'request': {'op': 'subscribe', 'args': [subscription]}})
+                continue
+            if table in PRIVATE_TABLES and not self.authenticated:
+                self.send_text({'status': 401, 'error': 'Not authenticated.',
+                                'request': {'op': 'subscribe', 'args': [subscription]}})
+                continue
+            if table.startswith('quote'):
+                self.quote_table = table
+            symbols = self.topics.setdefault(table, set()) if symbol else None
+            if symbol:
+                if symbols is not None:
+                    symbols.add(symbol)
+            else:
+                self.topics[table] = None
+            images.append((table, symbol or None))
+            self.send_text({'success': True, 'subscribe': subscription,
+                            'request': {'op': 'subscribe', 'args': [subscription]}})
+
+        reader = threading.Thread(target=self.read, name='sim-ws-reader')
+        reader.daemon = True
+        reader.start()
+        try:
+            for table, symbol, rows in self.exchange.subscribe(self.on_publish,
+                                                               [('quote' if t.startswith('quote') else t, s)
+                                                                for t, s in images]):
+                message = {'table': self.quote_table if table == 'quote' else table, 'action': 'partial',
+                           'keys': KEYS.get(table, []), 'types': {}, 'foreignKeys': {}, 'attributes': {},
+                           'filter': {'symbol': symbol} if symbol else {}, 'data': rows}
+                if table in PRIVATE_TABLES:
+                    message['filter']['account'] = self.exchange.account
+                self.send_text(message)
+            while not self.closed.is_set():
+                try:
+                    frame = self.frames.get(timeout=1)
+                except queue.Empty:
+                    continue
+                self.send_frame(*frame)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.exchange.unsubscribe(self.on_publish)
+            self.closed.set()
+
+    def on_publish(self, table, action, rows):
+        if table == 'quote':
+            table = self.quote_table
+        if table not in self.topics:
+            return
+        symbols = self.topics[table]
+        if symbols is not None:
+            rows = [r for r in rows if r.get('symbol') in symbols]
+            if not rows:
+                return
+        if self.frames.qsize() > self.MAX_QUEUE:
+            logger.warning('Websocket client is too slow, disconnecting it.')
+            self.closed.set()
+            return
+        self.frames.put((0x1, json.dumps({'table': table, 'action': action, 'data': rows}).encode('utf8')))
+
+    def read(self):
+        '''Read the client's frames: answer pings and 'ping' messages, stop on close.'''
+        try:
+            while not self.closed.is_set():
+                opcode, payload = self.read_frame()
+                if opcode == 0x8:
+                    self.frames.put((0x8, payload[:2]))
+                    break
+                elif opcode == 0x9:
+                    self.frames.put((0xA, payload))
+                elif opcode == 0x1 and payload == b'ping':
+                    self.frames.put((0x1, b'pong'))
+        except (OSError, ValueError, struct.error):
+            pass
+        self.closed.set()
+
+    def read_frame(self):
+        head = self.rfile.read(2)
+        if len(head) < 2:
+            raise ValueError('connection closed')
+        opcode = head[0] & 0x0F
+        masked = head[1] & 0x80
+        length = head[1] & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', self.rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self.rfile.read(8))[0]
+        mask = self.rfile.read(4) if masked else None
+        payload = self.rfile.read(length)
+        if mask:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return opcode, payload
+
+    def send_text(self, message):
+        self.send_frame(0x1, json.dumps(message).encode('utf8'))
+
+    def send_frame(self, opcode, payload):
+        length = len(payload)
+        if length < 126:
+            head = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 65536:
+            head = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            head = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        with self.write_lock:
+            self.sock.sendall(head + payload)
+        if opcode == 0x8:
+            self.closed.set()
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def _list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def serve(port=8765, host='127.0.0.1', symbols=('XBTUSD',), rate=10.0, latency=0.0, jitter=0.0, errors=None,
+          rate_limit=120, api_key=None, api_secret=None):
+    '''Run the stand-in until interrupted (`tombot serve`).'''
+    if api_key is None or api_secret is None:
+        from tom_bot.settings import settings
+        api_key = api_key or settings.API_KEY
+        api_secret = api_secret or settings.API_SECRET
+    server = SimServer((host, port), api_key, api_secret, Exchange(symbols), rate=rate, latency=latency,
+                       jitter=jitter, errors=errors, rate_limit=rate_limit)
+    server.start()
+    print('BitMEX stand-in on %s (BASE_URL), %s at %g steps/s. Ctrl-C to stop.' %
+          (server.base_url, ', '.join(symbols), rate))
+    try:
+        while True:
+            time.sleep(60)
+            print('%d REST requests, %r' % (server.requests, server.exchange))
+    except KeyboardInterrupt:
+        server.stop()
@@ -8,12 +8,17 @@ import random
 import requests
 import atexit
 import signal
+import threading
+import asyncio
 import pandas as pd
 import numpy as np
-from builtins import any as b_any
 from tom_bot import bitmex
 from tom_bot.settings import settings
-from tom_bot.utils import log, constants, errors, math, plot_utiles, telegram_bot, poscals
+from tom_bot.utils import log, constants, errors, math, plot_utiles, telegram_bot, poscals, clordid
+from tom_bot.ws.registry import OrderRegistry
+from tom_bot.rest.actions import OrderActionQueue
+from tom_bot.rest.coalesce import TickActions
+from tom_bot.rest.retry import CircuitBreaker, RetryPolicy
 from btmex_data import get_bitmex_data
 
 # Used for reloading the bot - saves modified times of key files
@@ -37,9 +42,22 @@ class ExchangeInterface:
         self.bitmex = bitmex.BitMEX(base_url=settings.BASE_URL, symbol=self.symbol,
                                     apiKey=settings.API_KEY, apiSecret=settings.API_SECRET,
                                     orderIDPrefix=settings.ORDERID_PREFIX, postOnly=settings.POST_ONLY,
-                                    timeout=settings.TIMEOUT)
+                                    timeout=settings.TIMEOUT, symbols=settings.CONTRACTS,
+                                    wsClient=settings.WS_CLIENT, rateLimit=settings.API_RATELIMIT,
+                                    rateLimitBurst=settings.API_RATELIMIT_BURST,
+                                    retryPolicy=RetryPolicy(settings.API_RETRIES, settings.API_RETRY_BACKOFF,
+                                                            settings.API_RETRY_MAX_BACKOFF,
+                                                            settings.API_RATELIMIT_RETRIES),
+                                    circuitBreaker=CircuitBreaker(settings.API_CIRCUIT_FAILURES,
+                                                                  settings.API_CIRCUIT_COOLDOWN),
+                                    statsInterval=settings.REST_STATS_INTERVAL,
+                                    amendTimeout=settings.AMEND_TIMEOUT)
+
+        # Creates, amends and cancels go out concurrently, in order per order
+        self.actions = OrderActionQueue(settings.API_REST_WORKERS)
 
         self.bitmex.isolate_margin(self.symbol, settings.LEVERAGE)
+        self.seed_fills()
 
     def cancel_order(self, order):
         tickLog = self.get_instrument()['tickLog']
@@ -47,7 +65,6 @@ class ExchangeInterface:
         while True:
             try:
                 self.bitmex.cancel(order['orderID'])
-                sleep(settings.API_REST_INTERVAL)
             except ValueError as e:
                 logger.info(e)
                 sleep(settings.API_ERROR_INTERVAL)
@@ -71,9 +88,10 @@ class ExchangeInterface:
             orderstocancel = []
             for order in orders:
                 #if order['ordType'] != 'Stop':  # We dont want the Stop Loss or Take Profit orders to be canceled
-                if ('SBuy' in order['clOrdID']) or ('SSell' in order['clOrdID']):
+                role = clordid.role_of(order['clOrdID'])
+                if role == clordid.STOP_ENTRY:
                     orderstocancel.append(order)
-                elif (order['ordType'] != 'Stop') and ('Tp' not in order['clOrdID']):
+                elif (order['ordType'] != 'Stop') and (role != clordid.TP):
                     orderstocancel.append(order)
                     #logger.info("Canceling: %s %d @ %.*f" % (order['side'], order['orderQty'], tickLog, order['price']))
             if len(orderstocancel):
@@ -98,15 +116,15 @@ class ExchangeInterface:
             else:
                 raise NotImplementedError("Unknown future type; not quanto or inverse: %s" % instrument['symbol'])
 
-            if instrument['underlyingToSettleMultiplier'] is None:
-                multiplier = float(instrument['multiplier']) / float(instrument['quoteToSettleMultiplier'])
-            else:
-                multiplier = float(instrument['multiplier']) / float(instrument['underlyingToSettleMultiplier'])
+            if instrument.get('settleMultiplier') is None:
+                logger.warning("%s has no underlyingToSettleMultiplier or quoteToSettleMultiplier, "
+                               "leaving it out of the portfolio delta." % symbol)
+                continue
 
             portfolio[symbol] = {
                 "currentQty": float(position['currentQty']),
                 "futureType": future_type,
-                "multiplier": multiplier,
+                "multiplier": instrument['settleMultiplier'],
                 "markPrice": float(instrument['markPrice']),
                 "spot": float(instrument['indicativeSettlePrice'])
             }
@@ -157,6 +175,12 @@ class ExchangeInterface:
             return []
         return self.bitmex.open_orders(symbol)
 
+    def get_order_registry(self):
+        """Open orders indexed by role and trend, see ws.registry.OrderRegistry."""
+        if self.dry_run:
+            return OrderRegistry()
+        return self.bitmex.snapshot().registry
+
     def get_highest_buy(self, symbol):
         buys = [o for o in self.get_orders(symbol) if o['side'] == 'Buy']
         if not len(buys):
@@ -176,15 +200,43 @@ class ExchangeInterface:
             symbol = self.symbol
         return self.bitmex.position(symbol)
 
+    def snapshot(self):
+        """Instrument, position, margin and order state as of a single websocket message."""
+        return self.bitmex.snapshot()
+
     def get_ticker(self, symbol=None):
         if symbol is None:
             symbol = self.symbol
         return self.bitmex.ticker_data(symbol)
 
+    def get_best_prices(self, symbol=None):
+        """Best bid and ask; from the live L2 book when settings.ORDERBOOK_TABLE is set, else the instrument."""
+        ticker = self.get_ticker(symbol)
+        return ticker['buy'], ticker['sell']
+
+    def get_book(self, symbol=None):
+        """The L2 OrderBook for the symbol, or None if the book is not subscribed."""
+        if symbol is None:
+            symbol = self.symbol
+        try:
+            return self.bitmex.market_depth(symbol)
+        except NotImplementedError:
+            return None
+
+    def add_listener(self, callback, tables=None, symbol=None):
+        """Be called back (on the websocket thread) when realtime data for the symbol changes."""
+        if symbol is None:
+            symbol = self.symbol
+        return self.bitmex.add_listener(callback, tables, [symbol])
+
     def is_open(self):
         """Check that websockets are still open."""
         return not self.bitmex.ws.exited
 
+    def is_resyncing(self):
+        """True while the websocket is reconnecting and reloading its data; it is stale until then."""
+        return self.bitmex.ws.resyncing
+
     def check_market_open(self):
         instrument = self.get_instrument()
         if instrument["state"] != "Open" and instrument["state"] != "Closed":
@@ -197,6 +249,30 @@ class ExchangeInterface:
         if instrument['midPrice'] is None:
             raise errors.MarketEmptyError("Orderbook is empty, cannot quote")
 
+    def trace_tick(self, tick):
+        """Tag REST requests from now on with `tick` (see BitMEX.rest_stats)."""
+        self.bitmex.trace_tick(tick)
+
+    def rest_stats(self):
+        return self.bitmex.rest_stats()
+
+    def tick_requests(self, tick):
+        if self.dry_run:
+            return None
+        return self.bitmex.tick_requests(tick)
+
+    def api_available(self):
+        """False during a REST outage, while calls fail at once (see rest.retry.CircuitBreaker)."""
+        if self.dry_run:
+            return True
+        return self.bitmex.api_available()
+
+    def rate_limit_remaining(self):
+        """REST requests left before we have to wait on the rate limit."""
+        if self.dry_run:
+            return settings.API_RATELIMIT
+        return self.bitmex.rate_limit_remaining()
+
     def amend_bulk_orders(self, orders):
         if self.dry_run:
             return orders
@@ -215,9 +291,30 @@ class ExchangeInterface:
         else:
             return self.bitmex.cancel([order['orderID'] for order in orders])
 
-    def get_trades(self):
+    # The same, through the order action queue: they return a Future at once, and run concurrently with
+    # batches touching other orders (and that they don't run `after`). See rest.actions.OrderActionQueue.
+
+    def submit_amend(self, orders):
+        return self.actions.submit([o['orderID'] for o in orders], self.amend_bulk_orders, orders)
+
+    def submit_create(self, orders, after=()):
+        return self.actions.submit([o['clOrdID'] for o in orders if o.get('clOrdID')], self.create_bulk_orders, orders,
+                                   after=after)
+
+    def submit_cancel(self, orders):
+        return self.actions.submit([o['orderID'] for o in orders], self.cancel_bulk_orders, orders)
+
+    def wait_for_actions(self, *handled):
+        """Wait for every submitted order action; raises the first one's error, if any failed (other than
+        the `handled` ones, whose errors the caller deals with)."""
+        done, _ = self.actions.join()
+        for future in done:
+            if future not in handled:
+                future.result()
+
+    def get_trades(self, symbol=None):
         # Executed trades from people
-        return self.bitmex.recent_trades()
+        return self.bitmex.recent_trades(symbol)
 
     def executed_orders(self):
         # Executed trades from people
@@ -256,6 +353,33 @@ class ExchangeInterface:
             last = False
         return last
 
+    def seed_fills(self, count=100):
+        """Load the recent trade history of every symbol we watch into the fill ledger (once, at startup)."""
+        symbols = [self.symbol] + [s for s in settings.CONTRACTS if s != self.symbol]
+        history = []
+        for symbol in symbols:
+            history.extend(self.bitmex.filled_orders_hist_count_symbol(symbol, count))
+        self.bitmex.fills().seed(history)
+
+    # Fill ledger: kept from the execution stream, so these cost no REST call. See ws.fills.FillLedger.
+
+    def last_fill(self, symbol=None, tagged=True):
+        """Last fill in symbol (of an order the bot placed, with tagged), or None."""
+        return self.bitmex.fills().last(symbol or self.symbol, tagged)
+
+    def entry_fill(self, symbol=None, *roles):
+        """Last fill in symbol of an entry order (or of one of `roles`), or None."""
+        if roles:
+            return self.bitmex.fills().entry(symbol or self.symbol, roles)
+        return self.bitmex.fills().entry(symbol or self.symbol)
+
+    def fills_since_entry(self, symbol=None):
+        return self.bitmex.fills().since_entry(symbol or self.symbol)
+
+    def recent_fills(self, symbol=None, count=20):
+        """Latest fills in symbol, newest first."""
+        return self.bitmex.fills().recent(symbol or self.symbol, count)
+
 
 class OrderManager:
     def __init__(self):
@@ -272,6 +396,7 @@ class OrderManager:
         self.instrument = self.exchange.get_instrument()
         self.starting_qty = self.exchange.get_delta()
         self.running_qty = self.starting_qty
+        self.ticks = 0  # ticks run, scheduled and early; REST requests are tagged with it
         self.reset()
 
     def reset(self):
@@ -290,7 +415,8 @@ class OrderManager:
         self.running_qty = self.exchange.get_delta()
         tickLog = self.exchange.get_instrument()['tickLog']
         self.start_XBt = margin["marginBalance"]
-        self.f_orders = self.exchange.last_filled_orders_hist()  # Gets last filled trade
+        last_fill = self.exchange.last_fill(tagged=False)  # Gets last filled trade
+        self.f_orders = [last_fill] if last_fill else []
         self.filled_df = self.update_last_filled(self.f_orders)
 
         logger.info("Current XBT Balance: %.6f" % XBt_to_XBT(self.start_XBt))
@@ -422,11 +548,14 @@ class OrderManager:
 
 
     def position_printer(self):
-
-        self.account_margin = self.exchange.get_margin()['amount']  # Total Account Marg in (XBt)
-        self.available_margin = self.exchange.get_margin()['availableMargin']  # Available Margin Balance (XBt)
-        self.fundingrate = self.exchange.get_instrument()['fundingRate']
-        self.wspos = self.exchange.get_position()
+        # Read everything from one snapshot so margin, position and instrument agree with each other
+        snap = self.exchange.snapshot()
+        instrument = snap.instrument(self.exchange.symbol)
+        margin = snap.funds()
+        self.account_margin = margin['amount']  # Total Account Marg in (XBt)
+        self.available_margin = margin['availableMargin']  # Available Margin Balance (XBt)
+        self.fundingrate = instrument['fundingRate']
+        self.wspos = snap.position(self.exchange.symbol)
         self.leverage = self.wspos['leverage']
         self.pos_margin = self.wspos['posMargin']  # Position Margin (XBt)
         self.pos_maint_margin = self.wspos['maintMargin']  # Maintenance margin XBt (este es el que sale en bitmex)
@@ -443,7 +572,7 @@ class OrderManager:
         self.pos_lastprice = self.wspos['lastPrice']
         self.pos_avgentry = self.wspos['avgEntryPrice']
         self.pos_beven = self.wspos['breakEvenPrice']
-        self.volume = self.exchange.get_instrument()['volume']
+        self.volume = instrument['volume']
 
     def messenger(self, wake_up_time):
         # Sending message to telegram bot
@@ -480,17 +609,15 @@ class OrderManager:
 
     def cancel_limit_orders(self):
         """ Cancel limit orders on the other side after entering a position (not the tp or SL orders) """
-        existing_orders = self.exchange.get_orders(self.exchange.symbol)
-        cancel_orders = []
-        for order in existing_orders:
-            # Not cancelling the breakout orders
-            if ('SSell' not in order['clOrdID'].split(' ')[0]) and ('SBuy' not in order['clOrdID'].split(' ')[0]):
-                if ('Tp' not in order['clOrdID'].split(' ')[0]) and ('SL' not in order['clOrdID'].split(' ')[0]):
-                    cancel_orders.append(order)
+        registry = self.exchange.get_order_registry()
+        # Not cancelling the breakout orders: entries, and orders that aren't ours
+        cancel_orders = registry.role(self.exchange.symbol, clordid.ENTRY) + \
+            list(registry.untagged.get(self.exchange.symbol, ()))
         if len(cancel_orders)>0:
             logger.info(f"Cancelling existing limit orders")
             #print(cancel_orders)
-            self.exchange.cancel_bulk_orders(cancel_orders)
+            # Sent with this tick's amends and creates, by converge_orders
+            self.tick_actions.cancel(cancel_orders)
 
     def place_orders(self, wake_up_time=10):
         """Create order items for use in convergence."""
@@ -505,23 +632,25 @@ class OrderManager:
         logger.info(f"Current open position: {np.round(100 * self.pos_margin / self.account_margin, 1)}% of account")
         buy_orders = []
         sell_orders = []
+        # Everything this tick wants done to orders, sent at the end of converge_orders
+        self.tick_actions = TickActions(self.exchange.get_orders(self.exchange.symbol))
         if self.current_position: # There is an open position already
             logger.info('Already in a trade')
             # Get last filled trade for specified symbol and with a clorID != ''
-            last_forder = self.exchange.last_filled_orders_hist_symbol(symbol=self.exchange.symbol, count=20)
+            last_forder = self.exchange.last_fill()
             if last_forder:
-                self.f_orders = [self.exchange.last_filled_orders_hist_symbol(symbol=self.exchange.symbol, count=20)]
+                self.f_orders = [last_forder]
             else:
                 self.f_orders = []
             self.update_last_filled(self.f_orders)
 
             trend = 'None'
             if self.f_orders[-1]['clOrdID'] != '':
-                trend = self.f_orders[-1]['clOrdID'].split(' ')[-2] #Last filled trade trend name
+                last_tag = clordid.decode(self.f_orders[-1]['clOrdID'])
+                trend = last_tag.trend if last_tag is not None else 'None' #Last filled trade trend name
             else:
                 if self.f_orders[-1]['text'] == 'Funding':
-                    lorders = pd.DataFrame(self.exchange.filled_orders_hist_count(4))
-                    lorders = self.exchange.filled_orders_hist_count_symbol(symbol=self.exchange.symbol, count=20)
+                    lorders = self.exchange.recent_fills(count=20)
                     filled_order_last = next((forder for forder in lorders if forder['clOrdID'] == ''), False)
                     if filled_order_last:
                         self.f_order = [filled_order_last]
@@ -573,24 +702,23 @@ class OrderManager:
         trail_percen = 0.003
         for forder in self.f_orders:
             entry_side = forder['side']
-            clorid = forder['clOrdID']
-            if clorid == '':
+            filled = clordid.decode(forder['clOrdID'])
+            if filled is None:
                 trend_name = 'None'
                 id_ident = 'None'
             else:
-                trend_name = forder['clOrdID'].split(' ')[-2]
-                id_ident = forder['clOrdID'].split(' ')[-1]
+                trend_name = filled.trend
+                id_ident = filled.nonce
+            took_profit = filled is not None and filled.role == clordid.TP
 
-            if 'Tp' not in clorid: # We have not taken any profits yet, we can assume pos_size is all we entered with
+            if not took_profit: # We have not taken any profits yet, we can assume pos_size is all we entered with
                 #####Ver como manejo esto del porcentaje de la posicion para los TP!!!!!
                 self.entry_pos_size = forder['orderQty']
             else:
                 self.entry_pos_size = 'None'
         if self.entry_pos_size == 'None':
             # We try to find the initial order position in the order history
-            #last_20 = pd.DataFrame(self.exchange.filled_orders_hist_count_symbol(symbol=self.exchange.symbol, count=20))
-            last_20 = self.exchange.filled_orders_hist_count_symbol(symbol=self.exchange.symbol, count=20)
-            filled_order_last = next((forder for forder in last_20 if 'SBuy' in forder or 'SSell' in forder), False)
+            filled_order_last = self.exchange.entry_fill(None, clordid.STOP_ENTRY)
             if filled_order_last:
                 self.entry_pos_size = filled_order_last['orderQty']
             else:
@@ -634,18 +762,14 @@ class OrderManager:
         tp_order_half = False
         tp_order_tquart = False
         # Take profit orders
-        if ('Tp' not in clorid) and ('qrt' not in clorid):
-            # Tp has not been reached we place the order
+        if not took_profit:
+            # Tp has not been reached we place the orders
             exit_pl_quart, exit_plwf = poscals.exit_price_pl(pos_size, entry_price, pl_quart, leverage)
-            tp_order_quart = self.prepare_tp_by_price(pos_size_quart, tp_side, exit_pl_quart, 'qrt ' + trend_name)
-        if ('Tp' not in clorid) and ('hl' not in clorid):
-            # Tp has not been reached we place the order
+            tp_order_quart = self.prepare_tp_by_price(pos_size_quart, tp_side, exit_pl_quart, trend_name, 'qrt')
             exit_pl_half, exit_plwf = poscals.exit_price_pl(pos_size, entry_price, pl_half, leverage)
-            tp_order_half = self.prepare_tp_by_price(pos_size_half, tp_side, exit_pl_half, 'hl ' + trend_name)
-        if ('Tp' not in clorid) and ('q3rt' not in clorid):
-            # Tp has not been reached we place the order
+            tp_order_half = self.prepare_tp_by_price(pos_size_half, tp_side, exit_pl_half, trend_name, 'hl')
             exit_pl_tquart, exit_plwf = poscals.exit_price_pl(pos_size, entry_price, pl_tquart, leverage)
-            tp_order_tquart = self.prepare_tp_by_price(pos_size_tquart, tp_side, exit_pl_tquart, 'q3rt ' + trend_name)
+            tp_order_tquart = self.prepare_tp_by_price(pos_size_tquart, tp_side, exit_pl_tquart, trend_name, 'q3rt')
 
         exit_sl_half, exit_plwf = poscals.exit_price_pl(pos_size, entry_price, pl_half, leverage)
         exit_sl_final, exit_plwf = poscals.exit_price_pl(pos_size, entry_price, pl_final, leverage)
@@ -661,7 +785,7 @@ class OrderManager:
             sl_order = self.prepare_sl_by_price(pos_size, tp_side, sl_price, trend_name)
         else:
             # If Tp at 3quart (15%) has been reached we set a trailing stop loss at x% from last bid/ask
-            if ('Tp' in clorid) and ('q3rt' in clorid):
+            if took_profit and filled.leg == 'q3rt':
                 # We just keep up with trail stop up to 20% of wins
                 if tp_side == 'Buy' and exit_sl_final_close <= mark_price:
                     sl_order = self.prepare_sl_by_price(pos_size, tp_side, exit_sl_final, trend_name)
@@ -741,8 +865,9 @@ class OrderManager:
                 percen_entry = 1 + tp_sign*trend_percen
                 percen_exit  = 1 + tp_sign*(-trend_percen-0.01)
                 sl_per = tp_sign*(-sl_percen)
-                trend_name = forder['clOrdID'].split(' ')[-2]
-                trend_id = forder['clOrdID'].split(' ')[-1]
+                filled = clordid.decode(forder['clOrdID'])
+                trend_name = filled.trend if filled is not None else 'None'
+                trend_id = filled.nonce if filled is not None else 'None'
                 text_order = entry_side + ' ' + trend_name
                 # Locating the symmetric trendline to calculate the exit price
                 subf = trendlines.loc[trendlines['trend_name'] == tp_pre + '_' + trend_name.split('_')[-1]]
@@ -782,9 +907,9 @@ class OrderManager:
                         pos_size_left = pos_size-pos_size_half
                         # Take profit orders
                         tp_order_half = self.prepare_tp_by_price(pos_size_half, tp_side, exit_pl_half,
-                                                                 ' h ' + trend_name)
+                                                                 trend_name, 'h')
                         tp_order_left = self.prepare_tp_by_price(pos_size_left, tp_side, exit_price,
-                                                                 ' l ' + trend_name)
+                                                                 trend_name, 'l')
                         logger.info(f"PL {100*trade_info['pl_percen']:1.1f}% Placing tp orders at different levels at {exit_price:1.1f} and {exit_pl_half:1.1f}")
 
                         if tp_side == 'Buy':
@@ -849,8 +974,7 @@ class OrderManager:
 
         # Entry price
         entry_price = math.toNearest(row['price_pred'] * percen_entry, self.instrument['tickSize'])
-        bid_price = self.exchange.get_instrument()['bidPrice']
-        ask_price = self.exchange.get_instrument()['askPrice']
+        bid_price, ask_price = self.exchange.get_best_prices()
         # CHECK IF ENTRY PRICE is already on the other side
         if (side == 'Sell') and (entry_price < 0.98 * bid_price):
             # If sell order price is lower than 101% of current bid price do nothing
@@ -919,8 +1043,7 @@ class OrderManager:
             trend_sing = 1
         percen_entry = 1 + trend_sing*settings.BREAK_TREND_PERCEN
         entry_price = row['price_pred'] * percen_entry
-        bid_price = self.exchange.get_instrument()['bidPrice']
-        ask_price = self.exchange.get_instrument()['askPrice']
+        bid_price, ask_price = self.exchange.get_best_prices()
         if (side == 'Sell') and (entry_price > 1.03 * bid_price):
             # If sell order price is lower than 101% of current bid price do nothing
             logger.info(f"Breakout: Current sell order at {entry_price:1.1f} is much higher than bid price {bid_price:1.1f}")
@@ -934,6 +1057,11 @@ class OrderManager:
         if trade_skip:
             return buy_orders, sell_orders
         pos_size = int(entry_price * acc_margin_XBT * settings.BREAK_ORDER_SIZE * settings.LEVERAGE)
+        book = self.exchange.get_book()
+        if book is not None:
+            # The stop entry fills as a market order; show how much currently rests between the touch and entry
+            resting = book.size_to_price('Sell' if side == 'Buy' else 'Buy', entry_price)
+            logger.info(f"Breakout: {resting} contracts resting up to entry {entry_price:1.1f} for a {pos_size} order")
         trade_order = self.prepare_slbuy_by_price(pos_size, side, entry_price, row['trend_name'])
         if side == 'Buy':
             buy_orders.append(trade_order)
@@ -960,18 +1088,20 @@ class OrderManager:
         """Create an order object for the trade btw resistances and supports strategy"""
         # order size = account balnce * X%
         quantity = int(price*XBt_to_XBT(self.exchange.get_margin()['amount'])*settings.BTW_ORDER_SIZE)
-        return {'ordType': 'Limit', 'price': price, 'orderQty': quantity, 'side': side, 'clOrdID': side + ' ' + text}
+        return {'ordType': 'Limit', 'price': price, 'orderQty': quantity, 'side': side,
+                'clOrdID': clordid.key(clordid.ENTRY, text, side)}
 
     def prepare_order_by_price(self, quantity, price, side, text):
         """Create an order object given a price and quantity"""
-        return {'ordType': 'Limit', 'price': price, 'orderQty': quantity, 'side': side, 'clOrdID': side + ' ' + text}
+        return {'ordType': 'Limit', 'price': price, 'orderQty': quantity, 'side': side,
+                'clOrdID': clordid.key(clordid.ENTRY, text, side)}
 
     def prepare_sl_by_price(self, quantity, side, slprice, text):
         # Setting stop loss to open position
         sl_price = math.toNearest(slprice, self.instrument['tickSize'])
         # Close: Close implies ReduceOnly. A Close order will cancel other active limit orders with the same side and symbol if the open quantity exceeds the current position.
         return {'ordType': 'Stop', 'stopPx': sl_price, 'orderQty': quantity, 'side': side, 'execInst': 'ReduceOnly',
-                'clOrdID': 'SL ' + text}
+                'clOrdID': clordid.key(clordid.SL, text)}
 
         # return {'ordType': 'Stop', 'stopPx': sl_price, 'orderQty': quantity, 'side': side, 'execInst': 'ReduceOnly', 'text': 'Stop loss ' + text}
 
@@ -979,13 +1109,13 @@ class OrderManager:
         # Setting stop buy or sell for entering a position
         sl_price = math.toNearest(slprice, self.instrument['tickSize'])
         return {'ordType': 'Stop', 'stopPx': sl_price, 'orderQty': quantity, 'side': side,
-                'clOrdID': 'S'+side + ' ' + text}
+                'clOrdID': clordid.key(clordid.STOP_ENTRY, text, side)}
 
-    def prepare_tp_by_price(self, quantity, side, tpprice, text):
-        # Setting take profit for an existing position
+    def prepare_tp_by_price(self, quantity, side, tpprice, text, leg=None):
+        # Setting take profit for an existing position; leg tells apart the parts of a split take profit
         tp_price = math.toNearest(tpprice, self.instrument['tickSize'])
         return {'ordType': 'Limit', 'price': tp_price, 'orderQty': quantity, 'side': side, 'execInst': 'ReduceOnly',
-                'clOrdID': 'Tp ' + text}
+                'clOrdID': clordid.key(clordid.TP, text, leg=leg)}
 
     def converge_orders(self, buy_orders, sell_orders):
         """Converge the orders we currently have in the book with what we want to be in the book.
@@ -999,38 +1129,37 @@ class OrderManager:
         buys_matched = 0
         sells_matched = 0
         existing_orders = self.exchange.get_orders(self.exchange.symbol) # Existing orders on bmex
+        registry = self.exchange.get_order_registry()
 
-        self.current_position = self.exchange.get_position()['currentQty'] # The current position amount in contracts. (contracts)
-        self.pos_cost = self.exchange.get_position()['grossOpenCost'] # grossOpenCost: The absolute of your open orders for this symbol. (XBt)
-        self.pos_margin = self.exchange.get_position()['posMargin'] # Position Margin (XBt)
-        self.account_margin = self.exchange.get_margin()['amount']  # Total Account Marg in (XBt)
-        self.available_margin = self.exchange.get_margin()['availableMargin'] # Available Margin Balance (XBt)
+        snap = self.exchange.snapshot()
+        position = snap.position(self.exchange.symbol)
+        margin = snap.funds()
+        self.current_position = position['currentQty'] # The current position amount in contracts. (contracts)
+        self.pos_cost = position['grossOpenCost'] # grossOpenCost: The absolute of your open orders for this symbol. (XBt)
+        self.pos_margin = position['posMargin'] # Position Margin (XBt)
+        self.account_margin = margin['amount']  # Total Account Marg in (XBt)
+        self.available_margin = margin['availableMargin'] # Available Margin Balance (XBt)
 
         new_orders = buy_orders + sell_orders
 
-        exist_df = pd.DataFrame(existing_orders)
         if len(existing_orders)>0:
-            exist_text = exist_df['clOrdID'].to_list()
             # If there are open orders we check if some needs to be amended
             for desired_order in new_orders:
                 if desired_order['ordType'] == 'Stop':
                     des_price_text = 'stopPx'
                 else:
                     des_price_text = 'price'
-                # Locating if order text is already inside an existing order
-                #if desired_order['origClOrdID'] in exist_text:
-                if b_any(desired_order['clOrdID'] in x for x in exist_text):
-                    sub_exist_df = exist_df.loc[exist_df['clOrdID'].str.contains(desired_order['clOrdID'])]
-                    sub_exist_df.reset_index(inplace=True)
-
-                    if sub_exist_df is not None:# or (len(sub_exist_df) == 0):
-                        # Found an existing order amending only if price or quanity has changed
-                        if (desired_order[des_price_text] != sub_exist_df[des_price_text][0]) or (desired_order['orderQty'] != sub_exist_df['leavesQty'][0]):
-                            desired_order['orderID'] = sub_exist_df['orderID'][0]
-                            desired_order['clOrdID'] = sub_exist_df['clOrdID'][0]
-                            to_amend.append(
-                                {'orderID': sub_exist_df['orderID'][0], 'ordType': desired_order['ordType'], 'orderQty': desired_order['orderQty'],
-                                 des_price_text: desired_order[des_price_text], 'side': desired_order['side']})
+                # Locating the existing order with the same key (clOrdID without its nonce)
+                existing = registry.get(self.exchange.symbol, desired_order['clOrdID'])
+                if existing is not None:
+                    # Found an existing order amending only if price or quanity has changed
+                    if (desired_order[des_price_text] != existing[des_price_text]) or (desired_order['orderQty'] != existing['leavesQty']):
+                        desired_order['orderID'] = existing['orderID']
+                        desired_order['clOrdID'] = existing['clOrdID']
+                        to_amend.append(
+                            {'orderID': existing['orderID'], 'origClOrdID': existing['clOrdID'],
+                             'ordType': desired_order['ordType'], 'orderQty': desired_order['orderQty'],
+                             des_price_text: desired_order[des_price_text], 'side': desired_order['side']})
                 else:
                     # Order not found in existing, creating
                     to_create.append(desired_order)
@@ -1038,6 +1167,20 @@ class OrderManager:
             # No existing orders all are to create
             to_create.extend(new_orders)
 
+        # Short on requests: only keep the position protected, move the entries once the rate limit refills
+        remaining = self.exchange.rate_limit_remaining()
+        if len(to_amend) > 0 and remaining < settings.API_RATELIMIT_RESERVE:
+            protective = set(o['orderID'] for o in existing_orders
+                             if clordid.role_of(o['clOrdID']) in clordid.PROTECTIVE)
+            deferred = [o for o in to_amend if o['orderID'] not in protective]
+            if deferred:
+                logger.warning("%d requests left in the rate limit, not amending %d entry orders this tick." %
+                               (remaining, len(deferred)))
+                to_amend = [o for o in to_amend if o['orderID'] in protective]
+
+        # Amends, creates and cancels are collected with the tick's other actions, then go out together
+        # through the order action queue, at most one bulk request of each; we wait for all of them at
+        # the end, so the tick costs the slowest request instead of the sum.
         if len(to_amend) > 0:
             print('\n\n +++++++++++ Amending orders +++++++++')
             print(to_amend)
@@ -1060,31 +1203,7 @@ class OrderManager:
                     (amended_order['orderQty'] - reference_order['cumQty']), tickLog, amended_order[des_price_text],
                     tickLog, (amended_order[des_price_text] - reference_order[price_text])
                 ))
-            # This can fail if an order has closed in the time we were processing.
-            # The API will send us `invalid ordStatus`, which means that the order's status (Filled/Canceled)
-            # made it not amendable.
-            # If that happens, we need to catch it and re-tick.
-            try:
-                self.exchange.amend_bulk_orders(to_amend)
-            except requests.exceptions.HTTPError as e:
-                errorObj = e.response.json()
-                if errorObj['error']['message'] == 'Invalid ordStatus':
-                    logger.warn("Amending failed. Waiting for order data to converge and retrying.")
-                    # It's possible, given latency over the internet, that an order fills or cancels
-                    # while the bot is trying to amend it. If that happens, the bot halts the current
-                    # tick, waits 500ms, and starts another. This ensures the new order status
-                    # has been reflected in the data from the websocket.
-                    sleep(1.0)
-                    print('\n\n\n+++++++ Error order to Amend ++++++++')
-                    print(to_amend)
-                    print('\n\n\n+++++++ Existing orders +++++++++++')
-                    print(self.exchange.get_orders(self.exchange.symbol))
-                    print('+++++++++++++++++++++++++++\n\n')
-                    return self.place_orders()
-                else:
-                    logger.error("Unknown error on amend: %s. Exiting" % errorObj)
-                    sys.exit(1)
-
+            self.tick_actions.amend(to_amend)
 
         if len(to_create) > 0:
             logger.info("Creating %d orders:" % (len(to_create)))
@@ -1096,14 +1215,14 @@ class OrderManager:
                 elif 'stopPx' in order:
                     order_price = order['stopPx']
                 logger.info("%4s %d @ %.*f" % (order['side'], order['orderQty'], tickLog, order_price))
-            self.exchange.create_bulk_orders(to_create)
+            self.tick_actions.create(to_create)
 
 
         # Could happen if we exceed a delta limit
         cancel_to = []
         if len(to_cancel) > 0:
             for order in reversed(to_cancel):
-                if (order['ordType'] != 'Stop') or  ('Tp' not in order['clOrdID']):
+                if (order['ordType'] != 'Stop') or (clordid.role_of(order['clOrdID']) != clordid.TP):
                     # Not canceling stop orders nor take profit orders
                     cancel_to.append(order)
         if len(cancel_to) > 0:
@@ -1114,7 +1233,50 @@ class OrderManager:
                 elif order['stopPx']:
                     order_price = order['stopPx']
                 logger.info("%4s %d @ %.*f" % (order['side'], order['leavesQty'], tickLog, order_price))
-            self.exchange.cancel_bulk_orders(cancel_to)
+            self.tick_actions.cancel(cancel_to)
+
+        actions = self.tick_actions
+        futures = actions.flush(self.exchange)
+        if actions.coalesced:
+            logger.info("%d order actions coalesced away this tick." % actions.coalesced)
+        amended = futures.get('amend')
+
+        # This can fail if an order has closed in the time we were processing.
+        # The API will send us `invalid ordStatus`, which means that the order's status (Filled/Canceled)
+        # made it not amendable.
+        # If that happens, we need to catch it and re-tick.
+        if amended is not None:
+            try:
+                amended.result()
+            except requests.exceptions.HTTPError as e:
+                errorObj = e.response.json()
+                if errorObj['error']['message'] == 'Invalid ordStatus':
+                    logger.warn("Amending failed. Waiting for order data to converge and retrying.")
+                    # It's possible, given latency over the internet, that an order fills or cancels
+                    # while the bot is trying to amend it. If that happens, the bot waits for the creates
+                    # and cancels already sent, then 1s, so the new order status has been reflected in the
+                    # data from the websocket. If the amended orders are all still open, only the amends
+                    # are sent again; otherwise the bot starts another tick, as the position may have changed.
+                    self.exchange.wait_for_actions(amended)
+                    sleep(1.0)
+                    sent = actions.sent['amend']
+                    open_ids = set(o['orderID'] for o in self.exchange.get_orders(self.exchange.symbol))
+                    if all(a['orderID'] in open_ids for a in sent):
+                        logger.info("Amended orders are all still open, sending the %d amends again." % len(sent))
+                        try:
+                            self.exchange.amend_bulk_orders(sent)
+                            return
+                        except requests.exceptions.HTTPError:
+                            logger.warn("Amending failed again, starting another tick.")
+                    print('\n\n\n+++++++ Error order to Amend ++++++++')
+                    print(sent)
+                    print('\n\n\n+++++++ Existing orders +++++++++++')
+                    print(self.exchange.get_orders(self.exchange.symbol))
+                    print('+++++++++++++++++++++++++++\n\n')
+                    return self.place_orders()
+                else:
+                    raise errors.APIError("Unknown error on amend: %s" % errorObj) from e
+        self.exchange.wait_for_actions()
 
 
     ###
@@ -1233,38 +1395,184 @@ class OrderManager:
             wallet_df.to_csv(path_trend + 'historic/acc_balance.csv', sep='\t', index=False)
             return wallet_df
 
+    def listen_for_changes(self, event=None):
+        """Set self.data_changed whenever the websocket brings something worth reacting to before the next tick.
+        `event` is a threading.Event by default; the asyncio run loop passes an asyncio.Event."""
+        self.data_changed = event if event is not None else threading.Event()
+        self.event_mark_price = self.exchange.get_instrument()['markPrice']
+
+        def on_change(table, action, rows):
+            if self.is_relevant_change(table, action, rows):
+                self.data_changed.set()
+
+        self.exchange.add_listener(on_change, tables=['order', 'execution', 'position', 'instrument'])
+
+    def is_relevant_change(self, table, action, rows):
+        """Called on the websocket thread for every change; keep it cheap."""
+        if table == 'order':
+            # Fills and cancels. New orders and amends are usually our own doing.
+            return any(row.get('ordStatus') in ('Filled', 'PartiallyFilled', 'Canceled', 'Rejected') for row in rows)
+        if table == 'execution':
+            return any(row.get('execType') == 'Trade' for row in rows)
+        if table == 'position':
+            return any('currentQty' in row for row in rows)
+        if table == 'instrument':
+            for row in rows:
+                mark_price = row.get('markPrice')
+                if mark_price and abs(mark_price / self.event_mark_price - 1) >= settings.EVENT_MARK_PRICE_MOVE:
+                    return True
+        return False
+
+    def wait_for_tick(self):
+        """Wait out the loop interval. In event mode, tick early whenever relevant data changes meanwhile."""
+        if settings.LOOP_MODE != 'event':
+            sleep(settings.LOOP_INTERVAL)
+            return
+        deadline = time.time() + settings.LOOP_INTERVAL
+        self.event_mark_price = self.exchange.get_instrument()['markPrice']
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self.data_changed.wait(remaining):
+                return
+            # Let the burst settle so one tick covers all of it
+            sleep(settings.EVENT_DEBOUNCE)
+            self.data_changed.clear()
+            if time.time() >= deadline:
+                return
+            logger.info("Realtime data changed, ticking early.")
+            self.event_tick()
+
+    def event_tick(self):
+        """A tick between scheduled ones: converge orders only, without the periodic status/REST work."""
+        if not self.check_connection() or self.exchange.is_resyncing() or not self.exchange.api_available():
+            return
+        self.ticks += 1
+        self.exchange.trace_tick(self.ticks)
+        self.event_mark_price = self.exchange.get_instrument()['markPrice']
+        try:
+            self.sanity_check()
+            self.place_orders()
+        except errors.APIUnavailableError as e:
+            logger.warning("BitMEX API unavailable, skipping this tick: %s" % e)
+        except errors.APIError as e:
+            logger.error("BitMEX API error, skipping this tick: %s" % e)
+        self.log_tick_requests()
+        # Don't react again to the order updates our own amends/creates produce. On the asyncio run loop
+        # this runs in an executor thread; wait_for_tick_async does it on the loop instead.
+        if not isinstance(self.data_changed, asyncio.Event):
+            sleep(settings.EVENT_DEBOUNCE)
+            self.data_changed.clear()
+
     def run_loop(self):
+        if settings.WS_CLIENT == 'asyncio':
+            # Run on the websocket's event loop, alongside the feed
+            self.exchange.bitmex.ws.run(self.run_loop_async())
+            return
         self.wakeup_time = 0
+        if settings.LOOP_MODE == 'event':
+            self.listen_for_changes()
         while True:
             sys.stdout.write("-----\n")
             sys.stdout.flush()
 
             self.check_file_change()
             self.last_mark_price = self.exchange.get_instrument()['markPrice']
-            sleep(settings.LOOP_INTERVAL)
-
-            logger.info(f'Wake up time\t{self.wakeup_time}')
-            if (self.wakeup_time % 300 == 0) and (self.wakeup_time != 0): # Updating historical every 5min
-                tfs = ['5m', '1h', '1d']
-                logger.info('Updating historical chart prices')
-                for tf in tfs:
-                    #get_bitmex_data.get_all_bitmex('/anaconda2/envs/bincrypy/lib/python3.7/site-packages/market_maker/historic/','XBTUSD', tf, save=True)
-                    get_bitmex_data.get_all_bitmex('/anaconda2/envs/bincrypy/lib/python3.7/site-packages/market_maker/historic/', self.exchange.symbol, tf, save=True)
-            if (self.wakeup_time % 1800 == 0) and (self.wakeup_time != 0):  # Updating account balance every 30min
-                self.update_wallet()
-
-            # This will restart on very short downtime, but if it's longer,
-            # the MM will crash entirely as it is unable to connect to the WS on boot.
-            if not self.check_connection():
-                logger.error("Realtime data connection unexpectedly closed, restarting.")
-                self.restart()
+            self.wait_for_tick()
+            self.tick()
+
+    def tick(self):
+        self.ticks += 1
+        self.exchange.trace_tick(self.ticks)
+        logger.info(f'Wake up time\t{self.wakeup_time}\ttick {self.ticks}')
+        if (self.wakeup_time % 300 == 0) and (self.wakeup_time != 0): # Updating historical every 5min
+            tfs = ['5m', '1h', '1d']
+            logger.info('Updating historical chart prices')
+            for tf in tfs:
+                #get_bitmex_data.get_all_bitmex('/anaconda2/envs/bincrypy/lib/python3.7/site-packages/market_maker/historic/','XBTUSD', tf, save=True)
+                get_bitmex_data.get_all_bitmex('/anaconda2/envs/bincrypy/lib/python3.7/site-packages/market_maker/historic/', self.exchange.symbol, tf, save=True)
+        if (self.wakeup_time % 1800 == 0) and (self.wakeup_time != 0):  # Updating account balance every 30min
+            self.update_wallet()
+
+        # The websocket reconnects by itself; this only happens once it has given up. This will
+        # restart on very short downtime, but if it's longer, the MM will crash entirely as it is
+        # unable to connect to the WS on boot.
+        if not self.check_connection():
+            logger.error("Realtime data connection unexpectedly closed, restarting.")
+            self.restart()
+        # Short drops are reconnected in place; don't act on stale data meanwhile.
+        if self.exchange.is_resyncing():
+            logger.warning("Realtime data is reconnecting, skipping this tick.")
+            self.wakeup_time += settings.LOOP_INTERVAL
+            return
+        # Same while the REST API is down: orders can't be placed, and waiting on it would stall the loop.
+        if not self.exchange.api_available():
+            logger.warning("BitMEX API unavailable, skipping this tick.")
+            self.wakeup_time += settings.LOOP_INTERVAL
+            return
 
+        try:
             self.sanity_check()  # Ensures health of mm - several cut-out points here
             lm_price = self.print_status()  # Print skew, delta, etc
             if (self.wakeup_time % 30 == 0): # Last marke price from 30seg ago
                 self.last_mark_price = lm_price
             self.place_orders(self.wakeup_time)  # Creates desired orders and converges to existing orders
-            self.wakeup_time += settings.LOOP_INTERVAL
+        except errors.APIUnavailableError as e:
+            logger.warning("BitMEX API unavailable, skipping the rest of this tick: %s" % e)
+        except errors.APIError as e:
+            logger.error("BitMEX API error, skipping the rest of this tick: %s" % e)
+        self.log_tick_requests()
+        self.wakeup_time += settings.LOOP_INTERVAL
+
+    def log_tick_requests(self):
+        traced = self.exchange.tick_requests(self.ticks)
+        if traced:
+            logger.info("Tick %d: %d REST requests, %.0fms in requests (%s)" % (
+                self.ticks, traced['requests'], traced['seconds'] * 1000,
+                ', '.join('%s %.0fms' % (endpoint, seconds * 1000)
+                          for endpoint, seconds in sorted(traced['endpoints'].items(), key=lambda kv: -kv[1]))))
+
+    async def run_loop_async(self):
+        """run_loop as a coroutine on the websocket's event loop (WS_CLIENT = 'asyncio').
+        Waiting is scheduled by the loop; ticks make blocking REST calls, so they run in its executor."""
+        loop = asyncio.get_running_loop()
+        self.wakeup_time = 0
+        if settings.LOOP_MODE == 'event':
+            self.listen_for_changes(asyncio.Event())
+        while True:
+            sys.stdout.write("-----\n")
+            sys.stdout.flush()
+
+            self.check_file_change()
+            self.last_mark_price = self.exchange.get_instrument()['markPrice']
+            await self.wait_for_tick_async()
+            await loop.run_in_executor(None, self.tick)
+
+    async def wait_for_tick_async(self):
+        """wait_for_tick for the asyncio run loop; data_changed is an asyncio.Event set by the feed on this loop."""
+        if settings.LOOP_MODE != 'event':
+            await asyncio.sleep(settings.LOOP_INTERVAL)
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + settings.LOOP_INTERVAL
+        self.event_mark_price = self.exchange.get_instrument()['markPrice']
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            try:
+                await asyncio.wait_for(self.data_changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return
+            # Let the burst settle so one tick covers all of it
+            await asyncio.sleep(settings.EVENT_DEBOUNCE)
+            self.data_changed.clear()
+            if loop.time() >= deadline:
+                return
+            logger.info("Realtime data changed, ticking early.")
+            await loop.run_in_executor(None, self.event_tick)
+            # Don't react again to the order updates our own amends/creates produce
+            await asyncio.sleep(settings.EVENT_DEBOUNCE)
+            self.data_changed.clear()
 
     def restart(self):
         logger.info("Restarting Tom...")
@@ -1302,6 +1610,11 @@ def run():
     # Try/except just keeps ctrl-c from printing an ugly stacktrace
     try:
         om.run_loop()
+    except errors.AuthenticationError as e:
+        # Fatal: the API key or secret is wrong
+        logger.error("Stopping: %s" % e)
+        telegram_bot.telegram_bot_sendtext(f"Tom bot has been closed: {e}")
+        sys.exit(1)
     except (KeyboardInterrupt, SystemExit):
         telegram_bot.telegram_bot_sendtext(f"Tom bot has been closed.")
         sys.exit()
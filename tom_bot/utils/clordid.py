@@ -0,0 +1,113 @@
+import base64
+import os
+import zlib
+from collections import namedtuple
+from functools import lru_cache
+
+# Structured clOrdIDs: what an order is for travels with it in the clOrdID BitMEX echoes on every update.
+#
+# Layout, space separated:  <tag> [<leg>] <trend> <nonce>
+#   tag    'Buy' / 'Sell'    entry at a trendline (limit)
+#          'SBuy' / 'SSell'  stop entry on a breakout
+#          'Tp'              take profit
+#          'SL'              stop loss
+#   leg    which take profit when a position is closed in parts ('qrt', 'hl', 'q3rt', ...); Tp only, optional
+#   trend  trendline name (no spaces)
+#   nonce  '#' and 6 random characters, added when the order is created (see with_nonce), so every clOrdID
+#          is unique
+#
+# Everything before the nonce is the order's key: the bot keeps at most one open order per key, so desired
+# orders are matched to open ones by key. This is the layout the bot has always used (trend = split(' ')[-2]),
+# so orders placed before this module existed decode too.
+#
+# A clOrdID can't be longer than MAX_LEN. key() shortens trend names that would make it longer: the start and
+# end of the name are kept and the middle is replaced by a hash of the whole name, so different trends keep
+# different keys.
+
+ENTRY = 'entry'
+STOP_ENTRY = 'stop_entry'
+TP = 'tp'
+SL = 'sl'
+
+# Orders that protect an open position rather than open one
+PROTECTIVE = frozenset([TP, SL])
+
+# Longest clOrdID BitMEX accepts
+MAX_LEN = 36
+
+NONCE_MARK = '#'
+NONCE_LEN = 1 + 6  # the mark and base64 of 4 random bytes
+
+_ROLE_OF_TAG = {'Buy': ENTRY, 'Sell': ENTRY, 'SBuy': STOP_ENTRY, 'SSell': STOP_ENTRY, 'Tp': TP, 'SL': SL}
+
+
+class OrderTag(namedtuple('OrderTag', 'role side leg trend nonce')):
+    __slots__ = ()
+
+    @property
+    def key(self):
+        return key(self.role, self.trend, self.side, self.leg)
+
+
+def key(role, trend, side=None, leg=None):
+    """The clOrdID of an order, without its nonce. Entries and stop entries need the side. A trend name too
+    long to fit in a clOrdID is shortened (see _fit)."""
+    if role == ENTRY:
+        parts = [side]
+    elif role == STOP_ENTRY:
+        parts = ['S' + side]
+    elif role == TP:
+        parts = ['Tp', leg] if leg else ['Tp']
+    elif role == SL:
+        parts = ['SL']
+    else:
+        raise ValueError("Unknown order role: %r" % role)
+    prefix = ' '.join(parts)
+    # Room for the trend between the prefix and the nonce, each after a space
+    return prefix + ' ' + _fit(str(trend), MAX_LEN - len(prefix) - 2 - NONCE_LEN)
+
+
+def with_nonce(orderKey):
+    """A unique clOrdID for a new order with this key. A key that wasn't built by key() and doesn't leave room
+    for the nonce is built again from its tag, which shortens the trend."""
+    if len(orderKey) + 1 + NONCE_LEN > MAX_LEN:
+        tag = decode(orderKey)
+        if tag is None:
+            raise ValueError("clOrdID %r leaves no room for a nonce in %d characters." % (orderKey, MAX_LEN))
+        orderKey = tag.key
+    return orderKey + ' ' + NONCE_MARK + base64.urlsafe_b64encode(os.urandom(4)).decode('utf8').rstrip('=')
+
+
+@lru_cache(maxsize=4096)
+def decode(clOrdID):
+    """OrderTag for a clOrdID (with or without its nonce), or None if it isn't one of ours (e.g. '' or a manual order)."""
+    tokens = (clOrdID or '').split()
+    role = _ROLE_OF_TAG.get(tokens[0]) if tokens else None
+    if role is None or len(tokens) < 2:
+        return None
+    tag = tokens[0]
+    side = tag if role == ENTRY else tag[1:] if role == STOP_ENTRY else None
+    rest = tokens[1:]
+    # The last token is the nonce if it's marked as one, or if there are more tokens than a key has (nonces
+    # of orders placed before they were marked)
+    nonce = None
+    if len(rest) > 1 and (rest[-1].startswith(NONCE_MARK) or len(rest) > (2 if role == TP else 1)):
+        nonce = rest.pop()
+    if len(rest) > (2 if role == TP else 1):
+        return None
+    leg = rest[0] if len(rest) == 2 else None
+    return OrderTag(role, side, leg, rest[-1], nonce)
+
+
+def role_of(clOrdID):
+    tag = decode(clOrdID)
+    return tag.role if tag is not None else None
+
+
+def _fit(trend, room):
+    """The trend name, or if it's longer than `room`, its start and end around a hash of the whole name."""
+    if len(trend) <= room:
+        return trend
+    digest = '%05x' % (zlib.crc32(trend.encode('utf8')) & 0xfffff)
+    keep = room - len(digest)
+    return trend[:keep - keep // 2] + digest + trend[len(trend) - keep // 2:]
@@ -6,3 +6,15 @@ class MarketClosedError(Exception):
 
 class MarketEmptyError(Exception):
     pass
+
+class APIUnavailableError(Exception):
+    pass
+
+class CircuitOpenError(APIUnavailableError):
+    pass
+
+class APIError(Exception):
+    pass
+
+class InsufficientFundsError(APIError):
+    pass
@@ -7,3 +7,10 @@ def toNearest(num, tickSize):
        Use this after adding/subtracting/multiplying numbers."""
     tickDec = Decimal(str(tickSize))
     return float((Decimal(round(num / tickSize, 0)) * tickDec))
+
+
+def toNearestScaled(num, tickSize, tickInt, tickScale):
+    """Same result as toNearest, using a tick size already expressed as the integer tickInt / tickScale
+       (e.g. 0.5 -> 5 / 10). Dividing two exact integers gives the correctly rounded float without
+       building Decimals, which matters for values rounded on every tick."""
+    return round(num / tickSize) * tickInt / tickScale
@@ -1,5 +1,5 @@
 import numpy as np
-from market_maker.utils import math, constants
+from tom_bot.utils import math, constants
 import logging
 
 
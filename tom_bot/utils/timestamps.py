@@ -0,0 +1,23 @@
+import calendar
+import time
+
+# Epoch seconds at midnight UTC, by 'YYYY-MM-DD'. Realtime rows only ever span a day or two.
+_day_cache = {}
+
+
+def iso_to_epoch(ts):
+    """Seconds since the epoch for a BitMEX timestamp, e.g. '2020-11-03T12:34:56.789Z'.
+       Much cheaper than strptime on every row: the date part is parsed once per day."""
+    day = ts[:10]
+    base = _day_cache.get(day)
+    if base is None:
+        if len(_day_cache) > 16:
+            _day_cache.clear()
+        base = _day_cache[day] = calendar.timegm(time.strptime(day, '%Y-%m-%d'))
+    return base + int(ts[11:13]) * 3600 + int(ts[14:16]) * 60 + float(ts[17:].rstrip('Z'))
+
+
+def epoch_to_iso(epoch):
+    """BitMEX timestamp (millisecond precision, UTC) for seconds since the epoch: the inverse of iso_to_epoch."""
+    ms = int(round(epoch * 1000))
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(ms // 1000)) + '.%03dZ' % (ms % 1000)
@@ -0,0 +1,164 @@
+import json
+import queue
+import threading
+import zlib
+from collections import OrderedDict
+
+
+# Where rows go when they leave the live tables: orders once they are terminal (filled, canceled,
+# rejected) and executions once the execution table is trimmed.
+#
+# The most recent `capacity` rows stay in memory, indexed by their ID, so memory stays flat however long
+# the bot runs. With a path, every archived row is also appended to a gzip file of JSON lines, so the
+# full history survives both the capacity and restarts. Rows are added on the websocket thread; reads
+# from other threads see a consistent copy.
+#
+# The file is written by a thread of its own, so the websocket thread never waits on compression or the
+# disk: rows are queued, and whatever has queued up is written as one gzip member and flushed. The offset
+# of each member is kept per ID (for rows already in the file, indexed when it is opened), so get() for
+# an ID no longer in memory decompresses the one member holding it rather than scanning the file.
+class Archive(object):
+
+    def __init__(self, key, capacity):
+        self.key = key            # the field rows are indexed by, e.g. 'orderID'
+        self.capacity = capacity
+        self.rows = OrderedDict()
+        self.path = None
+        self.file = None
+        self.indexed = threading.Event()  # set once the rows already in the file are in `offsets`
+        self.offsets = {}         # ID -> file offset of the gzip member with its last archived row
+        self.queue = None         # rows waiting to be written, for the writer thread
+        self.writer = None
+        self.archived = 0         # rows archived since start, including those since dropped from memory
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        # Oldest first. Copied in one C-level call, as the websocket thread may be adding rows.
+        return iter(list(self.rows.values()))
+
+    def __repr__(self):
+        return 'Archive(%r, rows=%d, archived=%d%s)' % (self.key, len(self.rows), self.archived,
+                                                        ', path=%r' % self.path if self.path else '')
+
+    def open(self, path):
+        '''Also append archived rows to this file (gzip, one JSON object per line).'''
+        self.path = path
+        self.file = open(path, 'a+b')
+        self.queue = queue.Queue()
+        self.writer = threading.Thread(target=self.__write, name='archive-writer', daemon=True)
+        self.writer.start()
+
+    def close(self):
+        '''Write what is still queued and stop the writer.'''
+        writer, self.writer = self.writer, None
+        if writer is not None:
+            self.queue.put(None)
+            writer.join()
+            self.file.close()
+
+    def add(self, rows):
+        rows = [row for row in rows if row.get(self.key) is not None]
+        for row in rows:
+            self.rows.pop(row[self.key], None)  # archived again (e.g. after a resync): keep the newest
+            self.rows[row[self.key]] = row
+        while len(self.rows) > self.capacity:
+            self.rows.popitem(last=False)
+        self.archived += len(rows)
+        if self.writer is not None and rows:
+            self.queue.put(rows)
+
+    def get(self, id):
+        '''The archived row with this ID, or None. IDs no longer in memory are read from the file.'''
+        row = self.rows.get(id)
+        if row is not None or self.writer is None:
+            return row
+        self.indexed.wait()
+        self.queue.join()  # rows dropped from memory may still be on their way to the file
+        offset = self.offsets.get(id)
+        if offset is None:
+            return None
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            for line in _read_member(f)[1]:
+                if id in line:
+                    candidate = json.loads(line)
+                    if candidate.get(self.key) == id:
+                        row = candidate  # keep going: the last one archived wins
+        return row
+
+    def recent(self, n):
+        '''The n most recently archived rows, newest first.'''
+        rows = list(self.rows.values())
+        return rows[:-n - 1:-1] if n else []
+
+    def __write(self):
+        '''The writer thread: index the file, then append queued rows to it, a gzip member per batch.'''
+        try:
+            self.__index(self.file)
+        finally:
+            self.indexed.set()
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.__append(self.file, [row for rows in batch if rows is not None for row in rows])
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if None in batch:
+                return
+
+    def __append(self, f, rows):
+        if not rows:
+            return
+        f.seek(0, 2)
+        offset = f.tell()
+        lines = ''.join(json.dumps(dict(row), default=str) + '\n' for row in rows)
+        compressor = zlib.compressobj(wbits=31)  # gzip format
+        f.write(compressor.compress(lines.encode('utf8')) + compressor.flush())
+        f.flush()
+        for row in rows:
+            self.offsets[row[self.key]] = offset
+
+    def __index(self, f):
+        '''Index the rows already in the file by the offset of their gzip member.'''
+        offset = 0
+        while offset is not None:
+            f.seek(offset)
+            end, lines = _read_member(f)
+            for line in lines:
+                try:
+                    id = json.loads(line).get(self.key)
+                except ValueError:
+                    continue  # a line cut short when the bot stopped
+                if id is not None:
+                    self.offsets[id] = offset
+            offset = end
+
+
+def _read_member(f, chunk=65536):
+    '''Decompress the gzip member at f's position. Returns (offset just past it, its lines); the offset is
+    None at the end of the file, or if the member is cut short (the bot stopped while writing it).'''
+    start = f.tell()
+    decompressor = zlib.decompressobj(wbits=31)
+    data = []
+    read = 0
+    end = None
+    while end is None:
+        block = f.read(chunk)
+        if not block:
+            break
+        read += len(block)
+        try:
+            data.append(decompressor.decompress(block))
+        except zlib.error:
+            break
+        if decompressor.eof:
+            end = start + read - len(decompressor.unused_data)
+    return end, b''.join(data).decode('utf8', 'replace').splitlines()
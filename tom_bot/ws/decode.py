@@ -0,0 +1,34 @@
+import json
+
+# Optional faster JSON parsers. Neither is required; stdlib json is used when they aren't installed.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+DECODERS = {
+    'json': json.loads,
+    'orjson': orjson.loads if orjson else None,
+    'ujson': ujson.loads if ujson else None,
+}
+
+
+def get_decoder(name='auto'):
+    '''Return a function that turns a raw WS frame (str or bytes) into a dict.
+
+    'auto' picks the fastest parser installed (orjson, then ujson, then json). Asking for a parser
+    that isn't installed raises, rather than silently falling back to a slower one.
+    '''
+    if name == 'auto':
+        return DECODERS['orjson'] or DECODERS['ujson'] or DECODERS['json']
+    if name not in DECODERS:
+        raise ValueError("Unknown WS_DECODER %r, expected one of: auto, %s" % (name, ', '.join(DECODERS)))
+    if DECODERS[name] is None:
+        raise ImportError("WS_DECODER is %r but the %s package is not installed." % (name, name))
+    return DECODERS[name]
@@ -0,0 +1,73 @@
+import gzip
+import time
+
+
+# Recording and replaying the raw websocket feed.
+#
+# A recording is a gzip file with one line per frame: the receive time (epoch seconds) and the frame
+# exactly as it came off the socket, separated by a tab. The recorder only ever appends, so a recording
+# can span restarts (each run adds a gzip member; readers see one continuous stream) and a crash loses
+# at most the unflushed tail. Replaying feeds the frames through BitMEXWebsocket.feed(), the same path
+# live frames take, so throughput and latency can be measured offline and reproducibly.
+class FeedRecorder(object):
+
+    # Flush to disk after this many frames.
+    FLUSH_EVERY = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, 'at')
+        self.frames = 0
+
+    def __repr__(self):
+        return 'FeedRecorder(%r, frames=%d)' % (self.path, self.frames)
+
+    def record(self, frame, recv_ts=None):
+        if isinstance(frame, bytes):
+            frame = frame.decode('utf-8')
+        self.file.write('%.6f\t%s\n' % (time.time() if recv_ts is None else recv_ts, frame))
+        self.frames += 1
+        if self.frames % self.FLUSH_EVERY == 0:
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_feed(path):
+    '''Yield (recv_ts, frame) from a recording. Plain (not gzipped) files are read too, and lines
+    without a timestamp get None.'''
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            if line.startswith('{') or '\t' not in line:
+                yield None, line
+            else:
+                ts, frame = line.split('\t', 1)
+                yield float(ts), frame
+
+
+def replay(ws, path, speed=1.0):
+    '''Feed a recording into a BitMEXWebsocket.
+
+    speed: 1.0 replays with the recorded gaps between frames, N replays N times faster, and None (or 0)
+    replays as fast as frames can be processed. The recorded receive times are passed on, so the lag
+    stats (ws.stats()) are those of the recording.
+    Returns (frames fed, seconds taken).
+    '''
+    start = time.time()
+    first_ts = None
+    frames = 0
+    for ts, frame in read_feed(path):
+        if speed and ts is not None:
+            if first_ts is None:
+                first_ts = ts
+            delay = (ts - first_ts) / speed - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+        ws.feed(frame, ts)
+        frames += 1
+    return frames, time.time() - start
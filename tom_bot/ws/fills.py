@@ -0,0 +1,101 @@
+import threading
+from collections import OrderedDict
+
+from tom_bot.utils import clordid
+
+
+# Our fills per symbol, kept from the execution stream (and seeded once from REST trade history), so the
+# order manager can ask for the last fill, the fill that opened the position and what filled since,
+# without a REST round trip every tick.
+#
+# Only executions that are fills (execType 'Trade') are kept; funding, cancels, amends etc. are not.
+# Each symbol's state is an immutable tuple that is replaced as a whole when a fill arrives, so the
+# trading thread can read it while the websocket thread adds to it.
+class FillLedger(object):
+
+    # Fills kept per symbol, newest last
+    MAX_FILLS = 200
+    # execIDs remembered (all symbols), well past the kept fills, so a fill trimmed from the window and
+    # delivered again doesn't come back as the newest one
+    MAX_SEEN = 10000
+
+    # Roles of the fills that open a position
+    ENTRY_ROLES = (clordid.ENTRY, clordid.STOP_ENTRY)
+
+    def __init__(self):
+        # symbol -> (fills, last tagged fill, last entry fill)
+        self.symbols = {}
+        self.seen = OrderedDict()  # execIDs, so fills delivered again (REST seed, partial after a reconnect) count once
+        self.lock = threading.Lock()  # writers only: the seed (trading thread) and the stream (WS thread)
+
+    def __repr__(self):
+        return 'FillLedger(%s)' % ', '.join('%s=%d' % (s, len(f[0])) for s, f in list(self.symbols.items()))
+
+    def add(self, executions):
+        '''Add executions (WS rows or REST trade history) in the order they happened.'''
+        with self.lock:
+            self.__add(executions)
+
+    def __add(self, executions):
+        for execution in executions:
+            if execution.get('execType') != 'Trade' or execution['execID'] in self.seen:
+                continue
+            fills, tagged, entry = self.symbols.get(execution['symbol'], ((), None, None))
+            # Older than the window: history delivered again, not news
+            if len(fills) >= self.MAX_FILLS and execution['timestamp'] < fills[0]['timestamp']:
+                continue
+            self.__remember(execution['execID'])
+            tag = clordid.decode(execution.get('clOrdID'))
+            if tag is not None:
+                tagged = execution
+                if tag.role in self.ENTRY_ROLES:
+                    entry = execution
+            fills += (execution,)
+            self.symbols[execution['symbol']] = (fills[-self.MAX_FILLS:], tagged, entry)
+
+    def seed(self, executions):
+        '''Add trade history from REST, in any order (it comes newest first), merging it with the fills
+        the stream has already delivered.'''
+        with self.lock:
+            kept = [fill for fills, _, _ in self.symbols.values() for fill in fills]
+            merged = FillLedger()
+            merged.add(sorted(kept + list(executions), key=lambda e: e['timestamp']))
+            self.symbols = merged.symbols
+            for execID in merged.seen:
+                self.__remember(execID)
+
+    def __remember(self, execID):
+        self.seen[execID] = None
+        self.seen.move_to_end(execID)
+        while len(self.seen) > self.MAX_SEEN:
+            self.seen.popitem(last=False)
+
+    def last(self, symbol, tagged=True):
+        '''The last fill in symbol; with tagged, the last one of an order the bot placed. None if there is none.'''
+        fills, last_tagged, _ = self.symbols.get(symbol, ((), None, None))
+        if tagged:
+            return last_tagged
+        return fills[-1] if fills else None
+
+    def entry(self, symbol, roles=ENTRY_ROLES):
+        '''The last fill in symbol of an entry order (any of `roles`), or None.'''
+        fills, _, entry = self.symbols.get(symbol, ((), None, None))
+        if roles == self.ENTRY_ROLES:
+            return entry
+        for fill in reversed(fills):
+            if clordid.role_of(fill.get('clOrdID')) in roles:
+                return fill
+        return None
+
+    def since_entry(self, symbol):
+        '''Fills in symbol after the last entry fill, oldest first (all kept fills if there is no entry).'''
+        fills, _, entry = self.symbols.get(symbol, ((), None, None))
+        for i in range(len(fills) - 1, -1, -1):
+            if fills[i] is entry:
+                return list(fills[i + 1:])
+        return list(fills)
+
+    def recent(self, symbol, count=20):
+        '''Up to count of the latest fills in symbol, newest first (like REST trade history).'''
+        fills = self.symbols.get(symbol, ((), None, None))[0]
+        return list(reversed(fills[-count:]))
@@ -0,0 +1,223 @@
+import numpy as np
+
+
+# Incremental L2 order book for one symbol, fed from the orderBookL2 / orderBookL2_25 tables.
+#
+# Each side is a NumPy array of sizes indexed by price in ticks, so a partial, insert, update or
+# delete is a single array write. The best level of each side is tracked as levels change: it
+# only has to be searched for when the best level itself is emptied, and then only outward from
+# where it was. Reads (top of book, depth, size up to a price) walk the array from the best level
+# and never sort.
+#
+# The array spans at most MAX_TICKS, around the touch. Levels further out (full-depth feeds list orders
+# far from the market) are kept in a dict instead, so one outlier doesn't allocate every tick in between.
+# The best level is always in the array, and the far levels are always behind it: when the touch moves
+# out of the array, the array is moved to span MAX_TICKS around the new touch.
+class BookSide(object):
+
+    # Start with this many ticks of room and grow (doubling) when a level falls outside it, up to MAX_TICKS.
+    INITIAL_TICKS = 4096
+    MAX_TICKS = 1 << 16
+
+    def __init__(self, is_bid):
+        self.is_bid = is_bid
+        self.base = 0  # Tick at index 0
+        self.sizes = np.zeros(0, dtype=np.int64)
+        self.best = -1  # Index of the best level, -1 when the side is empty
+        self.far = {}   # tick -> size of the levels outside the array
+
+    def clear(self):
+        self.sizes[:] = 0
+        self.far = {}
+        self.best = -1
+
+    def _index(self, tick):
+        '''Array index for a tick, growing the array to cover it if needed; None if it would span more than
+        MAX_TICKS.'''
+        i = tick - self.base
+        if 0 <= i < len(self.sizes):
+            return i
+        if not len(self.sizes):
+            room = self.INITIAL_TICKS
+            self.base = tick - room // 2
+            self.sizes = np.zeros(room, dtype=np.int64)
+            return tick - self.base
+        low = min(self.base, tick)
+        high = max(self.base + len(self.sizes), tick + 1)
+        if high - low > self.MAX_TICKS:
+            return None
+        room = min(max(2 * len(self.sizes), 2 * (high - low)), self.MAX_TICKS)
+        new_base = low - (room - (high - low)) // 2
+        sizes = np.zeros(room, dtype=np.int64)
+        offset = self.base - new_base
+        sizes[offset:offset + len(self.sizes)] = self.sizes
+        if self.best >= 0:
+            self.best += offset
+        self.base = new_base
+        self.sizes = sizes
+        return tick - self.base
+
+    def set(self, tick, size):
+        i = self._index(tick)
+        if i is None:
+            if size > 0 and (self.best < 0 or (tick > self.base + self.best if self.is_bid
+                                                else tick < self.base + self.best)):
+                # A new best level outside the array
+                self._move_to(tick)
+                i = tick - self.base
+            else:
+                if size > 0:
+                    self.far[tick] = size
+                else:
+                    self.far.pop(tick, None)
+                return
+        self.sizes[i] = size
+        if size > 0:
+            if self.best < 0 or (i > self.best if self.is_bid else i < self.best):
+                self.best = i
+        elif i == self.best:
+            self.best = self._next_level(i)
+            if self.best < 0 and self.far:
+                self._move_to(max(self.far) if self.is_bid else min(self.far))
+
+    def _move_to(self, tick):
+        '''Make the array span MAX_TICKS around `tick`, moving levels between it and the far levels.'''
+        levels = self.far
+        for i in np.flatnonzero(self.sizes):
+            levels[self.base + int(i)] = int(self.sizes[i])
+        self.base = tick - self.MAX_TICKS // 2
+        self.sizes = np.zeros(self.MAX_TICKS, dtype=np.int64)
+        self.far = {}
+        for t, size in levels.items():
+            if 0 <= t - self.base < self.MAX_TICKS:
+                self.sizes[t - self.base] = size
+            else:
+                self.far[t] = size
+        nz = np.flatnonzero(self.sizes)
+        self.best = (int(nz[-1]) if self.is_bid else int(nz[0])) if len(nz) else -1
+
+    def _next_level(self, i):
+        '''Index of the first non-empty level behind index i (worse price), or -1.'''
+        sizes = self.sizes
+        chunk = 64
+        if self.is_bid:
+            stop = i
+            while stop > 0:
+                start = max(stop - chunk, 0)
+                nz = np.flatnonzero(sizes[start:stop])
+                if len(nz):
+                    return start + int(nz[-1])
+                stop = start
+                chunk *= 4
+        else:
+            start = i + 1
+            while start < len(sizes):
+                stop = min(start + chunk, len(sizes))
+                nz = np.flatnonzero(sizes[start:stop])
+                if len(nz):
+                    return start + int(nz[0])
+                start = stop
+                chunk *= 4
+        return -1
+
+    def levels(self, n):
+        '''Up to n (tick, size) pairs from the best level outward.'''
+        out = []
+        i = self.best
+        while i >= 0 and len(out) < n:
+            out.append((self.base + i, int(self.sizes[i])))
+            if len(out) < n:
+                i = self._next_level(i)
+        if len(out) < n and self.far:
+            out.extend(sorted(self.far.items(), reverse=self.is_bid)[:n - len(out)])
+        return out
+
+    def size_to(self, tick):
+        '''Total size from the best level up to and including the level at `tick`.'''
+        if self.best < 0:
+            return 0
+        i = tick - self.base
+        if self.is_bid:
+            if i > self.best:
+                return 0
+            far = sum(size for t, size in self.far.items() if t >= tick) if i < 0 else 0
+            return int(self.sizes[max(i, 0):self.best + 1].sum()) + far
+        if i < self.best:
+            return 0
+        far = sum(size for t, size in self.far.items() if t <= tick) if i >= len(self.sizes) else 0
+        return int(self.sizes[self.best:min(i, len(self.sizes) - 1) + 1].sum()) + far
+
+
+class OrderBook(object):
+
+    def __init__(self, symbol, tickSize):
+        self.symbol = symbol
+        self.tickSize = tickSize
+        self.bids = BookSide(is_bid=True)
+        self.asks = BookSide(is_bid=False)
+        # (side, id) -> tick. Updates and deletes only carry the level id, not always the price.
+        self.ticks = {}
+
+    def __repr__(self):
+        return 'OrderBook(%s, bid=%s, ask=%s)' % (self.symbol, self.best_bid(), self.best_ask())
+
+    def _side(self, side):
+        return self.bids if side == 'Buy' else self.asks
+
+    def _tick(self, price):
+        return int(round(price / self.tickSize))
+
+    def _price(self, tick):
+        return tick * self.tickSize
+
+    #
+    # Applying WS messages
+    #
+    def apply(self, action, rows):
+        if action == 'partial':
+            self.bids.clear()
+            self.asks.clear()
+            self.ticks = {}
+            action = 'insert'
+        if action in ('insert', 'update'):
+            for row in rows:
+                key = (row['side'], row['id'])
+                if 'price' in row and row['price'] is not None:
+                    tick = self.ticks[key] = self._tick(row['price'])
+                else:
+                    tick = self.ticks.get(key)
+                    if tick is None:
+                        continue  # Update for a level we never saw; nothing to apply it to
+                self._side(row['side']).set(tick, row.get('size') or 0)
+        elif action == 'delete':
+            for row in rows:
+                tick = self.ticks.pop((row['side'], row['id']), None)
+                if tick is not None:
+                    self._side(row['side']).set(tick, 0)
+        else:
+            raise Exception("Unknown action: %s" % action)
+
+    #
+    # Reads
+    #
+    def best_bid(self):
+        '''(price, size) of the best bid, or None if there are no bids.'''
+        levels = self.bids.levels(1)
+        return (self._price(levels[0][0]), levels[0][1]) if levels else None
+
+    def best_ask(self):
+        '''(price, size) of the best ask, or None if there are no asks.'''
+        levels = self.asks.levels(1)
+        return (self._price(levels[0][0]), levels[0][1]) if levels else None
+
+    def depth(self, n=10):
+        '''The top n levels of each side as {'bids': [(price, size), ...], 'asks': [...]}, best first.'''
+        return {
+            'bids': [(self._price(t), s) for t, s in self.bids.levels(n)],
+            'asks': [(self._price(t), s) for t, s in self.asks.levels(n)],
+        }
+
+    def size_to_price(self, side, price):
+        '''Contracts resting between the top of `side` ('Buy' for bids, 'Sell' for asks) and price, inclusive.
+        E.g. size_to_price('Sell', p) is what a buy could fill at p or better.'''
+        return self._side(side).size_to(self._tick(price))
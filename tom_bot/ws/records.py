@@ -0,0 +1,141 @@
+from collections.abc import MutableMapping
+
+
+# Compact rows for the order, position, margin and instrument tables.
+#
+# BitMEX sends every field of a row on the partial (a position has more than 80) while the bot reads a
+# couple of dozen. A Record keeps only its table's FIELDS, in a list indexed through one dict shared by
+# every row of the table, so a row costs one small object and a list of pointers instead of a full
+# dict, updates skip the fields we don't keep, and the copy-on-write update of a snapshot table is a
+# list slice rather than an 80-key dict copy.
+#
+# Records are dict-like (row['price'], row.get(), `in`, iteration, dict(row)), so code written against
+# the plain dict rows keeps working; a field we don't keep reads as missing, like a key a row doesn't
+# have. Keep more with settings.WS_ROW_FIELDS, or turn records off with settings.WS_COMPACT_ROWS.
+
+_MISSING = object()
+
+
+class Record(MutableMapping):
+
+    __slots__ = ('_values',)
+
+    TABLE = None
+    FIELDS = ()
+    INDEX = {}  # field -> position in _values
+
+    def __init__(self, row=()):
+        self._values = [row.get(f, _MISSING) for f in self.FIELDS] if row else [_MISSING] * len(self.FIELDS)
+
+    @classmethod
+    def of(cls, row):
+        '''The row as this record type; a row that already is one is returned as it is.'''
+        return row if type(row) is cls else cls(row)
+
+    def __getitem__(self, field):
+        i = self.INDEX.get(field)
+        if i is not None:
+            value = self._values[i]
+            if value is not _MISSING:
+                return value
+        raise KeyError(field)
+
+    def get(self, field, default=None):
+        i = self.INDEX.get(field)
+        if i is None:
+            return default
+        value = self._values[i]
+        return default if value is _MISSING else value
+
+    def __contains__(self, field):
+        i = self.INDEX.get(field)
+        return i is not None and self._values[i] is not _MISSING
+
+    def __setitem__(self, field, value):
+        i = self.INDEX.get(field)
+        if i is None:
+            raise KeyError("%s rows don't keep %r; add it to settings.WS_ROW_FIELDS['%s']" %
+                           (self.TABLE, field, self.TABLE))
+        self._values[i] = value
+
+    def __delitem__(self, field):
+        if field not in self:
+            raise KeyError(field)
+        self._values[self.INDEX[field]] = _MISSING
+
+    def __iter__(self):
+        return (f for f, v in zip(self.FIELDS, self._values) if v is not _MISSING)
+
+    def __len__(self):
+        return sum(1 for v in self._values if v is not _MISSING)
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, dict(self))
+
+    def update(self, updateData):
+        '''Apply an update message's fields in place. Fields this record doesn't keep are dropped.'''
+        index = self.INDEX
+        values = self._values
+        for field in updateData:
+            if field in index:
+                values[index[field]] = updateData[field]
+
+    def copy(self):
+        record = self.__class__.__new__(self.__class__)
+        record._values = self._values[:]
+        return record
+
+    def updated(self, updateData):
+        '''A copy with an update message applied: copy() and update() in one go, for copy-on-write tables.'''
+        index = self.INDEX
+        values = self._values[:]
+        for field in updateData:
+            if field in index:
+                values[index[field]] = updateData[field]
+        record = self.__class__.__new__(self.__class__)
+        record._values = values
+        return record
+
+
+# Fields kept per table: everything the bot, the websocket and the snapshot read, plus the table keys.
+FIELDS = {
+    'order': (
+        'orderID', 'clOrdID', 'clOrdLinkID', 'account', 'symbol', 'side', 'orderQty', 'price', 'displayQty',
+        'stopPx', 'pegOffsetValue', 'pegPriceType', 'currency', 'settlCurrency', 'ordType', 'timeInForce',
+        'execInst', 'contingencyType', 'ordStatus', 'triggered', 'workingIndicator', 'ordRejReason',
+        'leavesQty', 'cumQty', 'avgPx', 'text', 'transactTime', 'timestamp'),
+    'position': (
+        'account', 'symbol', 'currency', 'leverage', 'crossMargin', 'isOpen', 'currentQty', 'markPrice',
+        'lastPrice', 'homeNotional', 'foreignNotional', 'posMargin', 'maintMargin', 'initMargin',
+        'grossOpenCost', 'openOrderBuyQty', 'openOrderSellQty', 'realisedPnl', 'realisedGrossPnl',
+        'unrealisedPnl', 'unrealisedPnlPcnt', 'unrealisedRoePcnt', 'avgCostPrice', 'avgEntryPrice',
+        'breakEvenPrice', 'liquidationPrice', 'bankruptPrice', 'timestamp'),
+    'margin': (
+        'account', 'currency', 'amount', 'walletBalance', 'marginBalance', 'availableMargin',
+        'withdrawableMargin', 'excessMargin', 'initMargin', 'maintMargin', 'marginUsedPcnt',
+        'marginLeverage', 'riskValue', 'realisedPnl', 'unrealisedPnl', 'timestamp'),
+    'instrument': (
+        'symbol', 'rootSymbol', 'state', 'typ', 'expiry', 'underlying', 'quoteCurrency', 'settlCurrency',
+        'tickSize', 'lotSize', 'multiplier', 'isQuanto', 'isInverse', 'initMargin', 'maintMargin',
+        'underlyingToSettleMultiplier', 'quoteToSettleMultiplier', 'maxOrderQty', 'maxPrice',
+        'fundingRate', 'indicativeFundingRate', 'fundingTimestamp', 'indicativeSettlePrice',
+        'markMethod', 'markPrice', 'fairPrice', 'lastPrice', 'bidPrice', 'askPrice', 'midPrice',
+        'impactBidPrice', 'impactAskPrice', 'volume', 'volume24h', 'openInterest', 'timestamp',
+        # Derived, see ws_thread.add_instrument_fields
+        'tickLog', 'tickScale', 'tickInt', 'settleMultiplier'),
+}
+
+_types = {}
+
+
+def record_type(table, extra=()):
+    '''The Record class for a table's rows, keeping its FIELDS plus `extra`. None for other tables.'''
+    if table not in FIELDS:
+        return None
+    fields = FIELDS[table] + tuple(f for f in extra if f not in FIELDS[table])
+    cls = _types.get((table, fields))
+    if cls is None:
+        name = table[0].upper() + table[1:] + 'Record'
+        cls = _types[(table, fields)] = type(name, (Record,), {
+            '__slots__': (), 'TABLE': table, 'FIELDS': fields, 'INDEX': {f: i for i, f in enumerate(fields)}})
+    return cls
@@ -0,0 +1,61 @@
+from tom_bot.utils import clordid
+
+
+# Open orders indexed by what they are for, from their structured clOrdIDs (see utils.clordid).
+#
+# Built with each Snapshot published after the order table changed, so questions like "the TP orders of
+# trend X" or "every order that doesn't protect the position" are dict lookups for the trading thread
+# rather than string scans over every open order. clOrdIDs are only parsed once each
+# (decode is cached). Like the rest of a snapshot, it never changes once built.
+class OrderRegistry(object):
+
+    __slots__ = ('by_key', 'by_role', 'by_trend', 'untagged')
+
+    def __init__(self, orders=()):
+        by_key = {}
+        by_role = {}
+        by_trend = {}
+        untagged = {}
+        for order in orders:
+            if order['leavesQty'] <= 0:
+                continue
+            symbol = order['symbol']
+            tag = clordid.decode(order['clOrdID'])
+            if tag is None:
+                untagged.setdefault(symbol, []).append(order)
+                continue
+            by_key[(symbol, tag.key)] = order
+            by_role.setdefault((symbol, tag.role), []).append(order)
+            by_trend.setdefault((symbol, tag.trend), []).append(order)
+        self.by_key = by_key
+        self.by_role = {k: tuple(v) for k, v in by_role.items()}
+        self.by_trend = {k: tuple(v) for k, v in by_trend.items()}
+        self.untagged = {k: tuple(v) for k, v in untagged.items()}
+
+    def __repr__(self):
+        return 'OrderRegistry(tagged=%d, untagged=%d)' % (len(self.by_key), sum(map(len, self.untagged.values())))
+
+    def get(self, symbol, key):
+        '''The open order with this key (its clOrdID without the nonce, see clordid.key), or None.'''
+        return self.by_key.get((symbol, key))
+
+    def role(self, symbol, *roles):
+        '''Open orders in symbol with any of these roles.'''
+        orders = []
+        for role in roles:
+            orders.extend(self.by_role.get((symbol, role), ()))
+        return orders
+
+    def trend(self, symbol, trend, *roles):
+        '''Open orders in symbol for a trend, optionally only those with one of `roles`.'''
+        orders = self.by_trend.get((symbol, trend), ())
+        if roles:
+            return [o for o in orders if clordid.role_of(o['clOrdID']) in roles]
+        return list(orders)
+
+    def unprotective(self, symbol):
+        '''Open orders in symbol that don't protect a position: entries, stop entries and orders we didn't tag.'''
+        return self.role(symbol, clordid.ENTRY, clordid.STOP_ENTRY) + list(self.untagged.get(symbol, ()))
+
+
+EMPTY_REGISTRY = OrderRegistry()
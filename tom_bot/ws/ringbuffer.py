@@ -0,0 +1,140 @@
+import numpy as np
+
+from tom_bot.utils.timestamps import epoch_to_iso, iso_to_epoch
+
+
+# Fixed-capacity, column-oriented storage for the append-only streams (trade, quote).
+#
+# Each column is a NumPy array allocated once. Every row is written twice, at position i and at
+# i + capacity, so the newest n rows always sit in one contiguous slice: windows such as "last 50
+# trades" or "trades since t" are returned as views, without copying and without building dicts.
+# Once full, new rows overwrite the oldest ones, so memory stays flat and there is no trim step.
+#
+# It quacks like a ws Table (partial/insert/find/delete/trim) so the websocket can treat it as one.
+class RingBuffer(object):
+
+    # (column name, dtype, function returning the column value for a raw WS row)
+    COLUMNS = ()
+
+    def __init__(self, capacity):
+        self.capacity = int(capacity)
+        self.keys = ()
+        self.columns = {name: np.zeros(2 * self.capacity, dtype=dtype) for name, dtype, _ in self.COLUMNS}
+        self._getters = [(self.columns[name], get) for name, _, get in self.COLUMNS]
+        self._next = 0  # Next write position, in [0, capacity)
+        self.count = 0  # Rows written since creation
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def __iter__(self):
+        '''Yield the stored rows as dicts shaped like the WS rows (only the stored columns), oldest first.
+        For compatibility only; use windows for speed.'''
+        window = self.last()
+        names = list(window)
+        for values in zip(*(window[name] for name in names)):
+            yield self.row({name: value.item() for name, value in zip(names, values)})
+
+    def row(self, values):
+        '''Turn stored column values back into their WS form.'''
+        values['timestamp'] = epoch_to_iso(values['timestamp'])
+        return values
+
+    def __repr__(self):
+        return '%s(capacity=%d, rows=%d)' % (type(self).__name__, self.capacity, len(self))
+
+    #
+    # Writes
+    #
+    def append(self, row):
+        i = self._next
+        j = i + self.capacity
+        for column, get in self._getters:
+            column[i] = column[j] = get(row)
+        self._next = (i + 1) % self.capacity
+        self.count += 1
+
+    def insert(self, rows):
+        # Rows beyond capacity would be overwritten anyway; skip writing them.
+        for row in rows[-self.capacity:]:
+            self.append(row)
+        self.count += max(len(rows) - self.capacity, 0)
+
+    def partial(self, rows, keys):
+        self.insert(rows)
+
+    # Streams are append-only: nothing to find, delete or trim.
+    def find(self, matchData):
+        return None
+
+    def delete(self, matchData):
+        return None
+
+    def trim(self, maxLen):
+        return []  # Fixed capacity: old rows are overwritten, never trimmed
+
+    def clear(self):
+        self._next = 0
+        self.count = 0
+
+    #
+    # Windows (views into the buffer; they are overwritten as new rows arrive, copy them to keep them)
+    #
+    def last(self, n=None):
+        '''Return {column: array} of the newest n rows (all stored rows if n is None), oldest first.'''
+        size = len(self)
+        n = size if n is None else max(min(int(n), size), 0)
+        end = self._next + self.capacity
+        return {name: column[end - n:end] for name, column in self.columns.items()}
+
+    def since(self, t):
+        '''Return {column: array} of the rows with a timestamp (epoch seconds) at or after t.'''
+        ts = self.last()['timestamp']
+        return self.last(len(ts) - np.searchsorted(ts, t, side='left'))
+
+
+def _side(row):
+    return 1 if row['side'] == 'Buy' else -1
+
+
+def _num(field):
+    # Empty books send None for prices/sizes
+    return lambda row: row[field] or 0
+
+
+class TradeBuffer(RingBuffer):
+
+    # side: +1 for a buy (lifted the offer), -1 for a sell
+    COLUMNS = (
+        ('timestamp', np.float64, lambda row: iso_to_epoch(row['timestamp'])),
+        ('price', np.float64, _num('price')),
+        ('size', np.int64, _num('size')),
+        ('side', np.int8, _side),
+    )
+
+    def row(self, values):
+        values = RingBuffer.row(self, values)
+        values['side'] = 'Buy' if values['side'] > 0 else 'Sell'
+        return values
+
+    def vwap(self, n=None, since=None):
+        '''Volume weighted average price over the last n trades, or over the trades since a timestamp.'''
+        window = self.since(since) if since is not None else self.last(n)
+        volume = window['size'].sum()
+        return float(np.dot(window['price'], window['size']) / volume) if volume else None
+
+    def net_volume(self, n=None, since=None):
+        '''Bought minus sold contracts over the window.'''
+        window = self.since(since) if since is not None else self.last(n)
+        return int(np.dot(window['size'], window['side']))
+
+
+class QuoteBuffer(RingBuffer):
+
+    COLUMNS = (
+        ('timestamp', np.float64, lambda row: iso_to_epoch(row['timestamp'])),
+        ('bidPrice', np.float64, _num('bidPrice')),
+        ('bidSize', np.int64, _num('bidSize')),
+        ('askPrice', np.float64, _num('askPrice')),
+        ('askSize', np.int64, _num('askSize')),
+    )
@@ -0,0 +1,61 @@
+from types import MappingProxyType
+
+from tom_bot.ws.registry import EMPTY_REGISTRY
+
+
+# An immutable, versioned view of the account and instrument state held by the websocket.
+#
+# The websocket thread never changes a published row: updates to these tables replace the row
+# (copy-on-write). When a reader asks for a snapshot after messages changed some of the tables, a new
+# Snapshot is published that holds their current state and shares the other parts with the previous
+# one (see BitMEXWebsocket.snapshot); otherwise taking one is a single attribute read. Everything read
+# from a snapshot is consistent as of one message, however long the trading thread holds on to it.
+# Treat the rows as read-only.
+class Snapshot(object):
+
+    __slots__ = ('version', 'instruments', 'positions', 'margin', 'orders', 'registry')
+
+    EMPTY_MAP = MappingProxyType({})
+
+    def __init__(self, version=0, instruments=EMPTY_MAP, positions=EMPTY_MAP, margin=(), orders=(),
+                 registry=EMPTY_REGISTRY):
+        self.version = version          # Count of snapshots published before this one
+        self.instruments = instruments  # symbol -> instrument
+        self.positions = positions      # symbol -> position
+        self.margin = margin            # margin rows
+        self.orders = orders            # order rows, in arrival order
+        self.registry = registry        # open orders by role and trend, see OrderRegistry
+
+    def __repr__(self):
+        return 'Snapshot(version=%d, instruments=%d, positions=%d, orders=%d)' % (
+            self.version, len(self.instruments), len(self.positions), len(self.orders))
+
+    def evolve(self, **changes):
+        '''Return a new snapshot, one version on, with some parts replaced.'''
+        parts = {name: getattr(self, name) for name in self.__slots__}
+        parts.update(changes)
+        parts['version'] = self.version + 1
+        return Snapshot(**parts)
+
+    #
+    # Same semantics as the BitMEXWebsocket data methods
+    #
+    def instrument(self, symbol):
+        instrument = self.instruments.get(symbol)
+        if instrument is None:
+            raise Exception("Unable to find instrument or index with symbol: " + symbol)
+        return instrument
+
+    def position(self, symbol):
+        pos = self.positions.get(symbol)
+        if pos is None:
+            # No position found; stub it
+            return {'avgCostPrice': 0, 'avgEntryPrice': 0, 'currentQty': 0, 'symbol': symbol}
+        return pos
+
+    def funds(self):
+        return self.margin[0]
+
+    def open_orders(self, symbol):
+        # Only open orders (leavesQty > 0) in that symbol
+        return [o for o in self.orders if o['leavesQty'] > 0 and o['symbol'] == symbol]
@@ -0,0 +1,148 @@
+import time
+from bisect import bisect_left
+
+
+# Websocket ingest instrumentation: how far behind the exchange the feed runs and what processing it costs.
+#
+# For every message BitMEXWebsocket records, per (table, action): the message count and bytes, the time to
+# decode the frame and to apply it to the tables, and, for tables whose rows carry the exchange's
+# `timestamp` (LAG_TABLES), the lag from that timestamp to the local receive time. The async client also
+# records how many frames were queued behind the one being processed. Times go into fixed-bucket
+# histograms, so recording is a couple of comparisons and no allocation, and memory doesn't grow.
+#
+# The lag includes any offset between the local clock and the exchange's; keep the clock NTP synced.
+
+
+# Tables whose rows have an exchange `timestamp` that is close to when they were sent
+LAG_TABLES = frozenset(['instrument', 'trade', 'quote'])
+
+
+class Histogram(object):
+    '''Counts of values (seconds) in fixed, roughly logarithmic buckets, from 50us up to 10s.'''
+
+    BOUNDS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+              0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)  # the last bucket is everything above 10s
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+
+    def __repr__(self):
+        return 'Histogram(%s)' % ', '.join('%s=%s' % kv for kv in self.summary().items())
+
+    def add(self, value):
+        self.counts[bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        '''Upper bound of the bucket holding the q-th quantile, or the largest value seen if that is lower.'''
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return min(self.BOUNDS[i], self.max) if i < len(self.BOUNDS) else self.max
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count, 'mean': self.total / self.count, 'p50': self.quantile(0.5),
+                'p99': self.quantile(0.99), 'max': self.max}
+
+
+class IngestStats(object):
+    '''Ingest counters and histograms since `since` (epoch seconds).'''
+
+    def __init__(self):
+        self.since = time.time()
+        self.messages = {}   # (table, action) -> count
+        self.bytes = {}      # (table, action) -> bytes
+        self.wire_bytes = None  # bytes read off the socket (before decompression), when the client counts them
+        self.decode = {}     # (table, action) -> Histogram
+        self.apply = {}      # (table, action) -> Histogram
+        self.lag = {}        # table -> Histogram
+        # Frames waiting behind the one being processed, when the feed is buffered (async client)
+        self.queued_samples = 0
+        self.queued_total = 0
+        self.max_queued = 0
+
+    def __repr__(self):
+        return 'IngestStats(%d messages in %.0fs)' % (sum(self.messages.values()), time.time() - self.since)
+
+    def record(self, table, action, nbytes, decode_s, apply_s, lag_s=None, queued=None):
+        key = (table, action)
+        if key not in self.messages:
+            self.messages[key] = 0
+            self.bytes[key] = 0
+            self.decode[key] = Histogram()
+            self.apply[key] = Histogram()
+        self.messages[key] += 1
+        self.bytes[key] += nbytes
+        self.decode[key].add(decode_s)
+        self.apply[key].add(apply_s)
+        if lag_s is not None:
+            lag = self.lag.get(table)
+            if lag is None:
+                lag = self.lag[table] = Histogram()
+            lag.add(lag_s)
+        if queued is not None:
+            self.queued_samples += 1
+            self.queued_total += queued
+            if queued > self.max_queued:
+                self.max_queued = queued
+
+    def add_wire_bytes(self, nbytes):
+        self.wire_bytes = (self.wire_bytes or 0) + nbytes
+
+    def snapshot(self):
+        '''The stats as plain dicts (per "table:action" and per table), e.g. for logging or a status page.'''
+        elapsed = max(time.time() - self.since, 1e-9)
+        return {
+            'since': self.since,
+            'seconds': elapsed,
+            'messages': sum(self.messages.values()),
+            'bytes': sum(self.bytes.values()),
+            'wire_bytes': self.wire_bytes,
+            'per_second': sum(self.messages.values()) / elapsed,
+            'per_minute': {'messages': sum(self.messages.values()) * 60 / elapsed,
+                           'bytes': sum(self.bytes.values()) * 60 / elapsed,
+                           'wire_bytes': self.wire_bytes * 60 / elapsed if self.wire_bytes is not None else None},
+            'tables': {'%s:%s' % key: {'messages': n, 'bytes': self.bytes[key],
+                                       'decode': self.decode[key].summary(), 'apply': self.apply[key].summary()}
+                       for key, n in self.messages.items()},
+            'lag': {table: h.summary() for table, h in self.lag.items()},
+            'mean_queued': self.queued_total / self.queued_samples if self.queued_samples else None,
+            'max_queued': self.max_queued if self.queued_samples else None,
+        }
+
+    def format(self):
+        '''A compact multi-line summary for the log.'''
+        snap = self.snapshot()
+        per_minute = snap['per_minute']
+        lines = ['WS ingest: %d messages, %.0f KB in %.0fs: %.0f messages/min, %.0f KB/min%s%s' %
+                 (snap['messages'], snap['bytes'] / 1024.0, snap['seconds'], per_minute['messages'],
+                  per_minute['bytes'] / 1024.0,
+                  ' (%.0f KB/min on the wire)' % (per_minute['wire_bytes'] / 1024.0)
+                  if per_minute['wire_bytes'] is not None else '',
+                  ', %.1f frames queued on average, max %d' % (snap['mean_queued'], snap['max_queued'])
+                  if snap['max_queued'] is not None else '')]
+        for table, lag in sorted(snap['lag'].items()):
+            lines.append('  lag %-12s p50 %s p99 %s max %s' % (table, _ms(lag['p50']), _ms(lag['p99']), _ms(lag['max'])))
+        for key, t in sorted(snap['tables'].items()):
+            lines.append('  %-22s %7d msgs  decode p99 %s  apply p99 %s max %s' %
+                         (key, t['messages'], _ms(t['decode']['p99']), _ms(t['apply']['p99']), _ms(t['apply']['max'])))
+        return '\n'.join(lines)
+
+
+def _ms(seconds):
+    return '%.2fms' % (seconds * 1000) if seconds is not None else '-'
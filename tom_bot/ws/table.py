@@ -0,0 +1,190 @@
+from itertools import count, islice
+
+
+# A single realtime table (order, position, instrument, ...).
+#
+# BitMEX tells us on the partial which fields uniquely identify a row (the table's `keys`).
+# Rows are kept in a dict keyed by the tuple of those values, so finding the row an update or
+# delete refers to is one hash lookup instead of a scan over every row and every key.
+# Dicts keep insertion order, so iterating the table still yields rows in arrival order.
+# Tables without keys (trade, quote) are append-only; their rows get a running sequence number.
+#
+# With copy_on_write, updates replace a row with an updated copy instead of changing it in place,
+# so rows handed out earlier (e.g. in a published Snapshot) never change underneath a reader.
+# With a record type (see records.Record), rows are stored as compact records instead of the dicts
+# they arrive as.
+class Table(object):
+
+    def __init__(self, keys=None, copy_on_write=False, record=None):
+        self.keys = tuple(keys or ())
+        self.copy_on_write = copy_on_write
+        self.record = record
+        self.rows = {}
+        self._seq = count()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        # Copy first (a single C-level call, so atomic under the GIL): another thread may be
+        # iterating while the websocket thread inserts or deletes.
+        return iter(list(self.rows.values()))
+
+    def __getitem__(self, i):
+        '''List-style access, e.g. table[0] for the single margin row.'''
+        if i == 0 and self.rows:
+            return next(iter(self.rows.values()))
+        return list(self.rows.values())[i]
+
+    def __repr__(self):
+        return 'Table(keys=%r, rows=%d)' % (self.keys, len(self.rows))
+
+    def key_of(self, row):
+        '''Return the index key for a row (or for the match data of an update/delete).'''
+        if not self.keys:
+            return next(self._seq)
+        return tuple(row[k] for k in self.keys)
+
+    def partial(self, rows, keys):
+        '''Apply a partial. Keys are communicated here; any rows held so far are re-keyed.
+        Returns the rows as stored.'''
+        keys = tuple(keys or ())
+        if keys != self.keys:
+            old = list(self.rows.values())
+            self.keys = keys
+            self.rows = {}
+            self.insert(old)
+        return self.insert(rows)
+
+    def insert(self, rows):
+        '''Add rows. Returns them as stored.'''
+        if self.record is not None:
+            rows = [self.record.of(row) for row in rows]
+        for row in rows:
+            self.rows[self.key_of(row)] = row
+        return rows
+
+    def find(self, matchData):
+        '''Locate a row by the table keys of `matchData`. Returns None if it isn't there.'''
+        if not self.keys:
+            return None
+        try:
+            return self.rows.get(tuple(matchData[k] for k in self.keys))
+        except KeyError:
+            return None
+
+    def update(self, updateData):
+        '''Update a row. Returns the updated row, or None if it isn't known yet.'''
+        item = self.find(updateData)
+        if item is None:
+            return None
+        if self.copy_on_write:
+            if self.record is not None:
+                item = item.updated(updateData)
+            else:
+                item = dict(item)
+                item.update(updateData)
+            self.rows[self.key_of(item)] = item
+        else:
+            item.update(updateData)
+        return item
+
+    def delete(self, matchData):
+        '''Remove a row. Returns the removed row, or None if it wasn't there.'''
+        if not self.keys:
+            return None
+        return self.rows.pop(self.key_of(matchData), None)
+
+    def trim(self, maxLen):
+        '''If the table grew past maxLen, drop the oldest maxLen // 2 rows. Returns the dropped rows.'''
+        if len(self.rows) <= maxLen:
+            return []
+        stale = list(islice(self.rows, maxLen // 2))
+        return [self.rows.pop(key) for key in stale]
+
+    def clear(self):
+        self.rows.clear()
+
+
+# A table split by symbol: one table per symbol, made by `factory` when the symbol's first rows arrive.
+#
+# It takes the same messages as a single table, so the websocket handles it like any other; rows are
+# routed to their symbol's table. Readers ask for the one symbol they care about with part(), which
+# doesn't wade through the other symbols' rows (and, for the trade and quote buffers, keeps each
+# symbol's window and statistics to itself).
+class Partitioned(object):
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.keys = None
+        self.parts = {}
+
+    def __len__(self):
+        return sum(len(table) for table in list(self.parts.values()))
+
+    def __iter__(self):
+        rows = []
+        for table in list(self.parts.values()):
+            rows.extend(table)
+        return iter(rows)
+
+    def __repr__(self):
+        return 'Partitioned(%s)' % ', '.join('%s=%d' % (s, len(t)) for s, t in list(self.parts.items()))
+
+    def part(self, symbol):
+        '''The table for one symbol. Empty (and not kept) if nothing has arrived for it yet.'''
+        table = self.parts.get(symbol)
+        return table if table is not None else self.factory()
+
+    def _split(self, rows):
+        '''Group rows by their symbol's table, creating tables for new symbols.'''
+        bySymbol = {}
+        for row in rows:
+            bySymbol.setdefault(row['symbol'], []).append(row)
+        for symbol, symbolRows in bySymbol.items():
+            table = self.parts.get(symbol)
+            if table is None:
+                table = self.factory()
+                if self.keys is not None:
+                    table.partial([], self.keys)  # A symbol first seen after the partial
+                self.parts[symbol] = table
+            yield table, symbolRows
+
+    def _owner(self, matchData):
+        '''The table holding the row matchData refers to. Updates don't always carry the symbol.'''
+        if 'symbol' in matchData:
+            return self.parts.get(matchData['symbol'])
+        for table in list(self.parts.values()):
+            if table.find(matchData) is not None:
+                return table
+        return None
+
+    def partial(self, rows, keys):
+        self.keys = keys
+        for table, symbolRows in self._split(rows):
+            table.partial(symbolRows, keys)
+
+    def insert(self, rows):
+        for table, symbolRows in self._split(rows):
+            table.insert(symbolRows)
+
+    def find(self, matchData):
+        table = self._owner(matchData)
+        return table.find(matchData) if table is not None else None
+
+    def update(self, updateData):
+        table = self._owner(updateData)
+        return table.update(updateData) if table is not None else None
+
+    def delete(self, matchData):
+        table = self._owner(matchData)
+        return table.delete(matchData) if table is not None else None
+
+    def trim(self, maxLen):
+        dropped = []
+        for table in list(self.parts.values()):
+            dropped.extend(table.trim(maxLen))
+        return dropped
+
+    def clear(self):
+        self.parts = {}
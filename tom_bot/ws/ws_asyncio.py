@@ -0,0 +1,157 @@
+import asyncio
+import threading
+import time
+
+from tom_bot.ws.ws_thread import BitMEXWebsocket
+
+# Optional: only needed when WS_CLIENT = 'asyncio'.
+try:
+    import websockets
+except ImportError:
+    websockets = None
+try:
+    from websockets.asyncio.client import ClientConnection
+except ImportError:
+    ClientConnection = None
+
+
+if ClientConnection is not None:
+    class _CountingConnection(ClientConnection):
+        '''A connection that counts the bytes read off the socket (compressed, framing included).'''
+
+        wire_bytes = 0
+
+        def data_received(self, data):
+            self.wire_bytes += len(data)
+            super(_CountingConnection, self).data_received(data)
+
+
+# The same realtime data API as BitMEXWebsocket (it is one: every message goes through the same
+# feed() path into the same tables, books and snapshots), with the socket run by asyncio.
+#
+# One event loop, in its own thread, reads the socket, applies the messages and runs the change
+# listeners. The order manager's loop can be run on it too (see run() and OrderManager.run_loop_async),
+# so feed processing and ticks are scheduled by the loop instead of competing threads. Blocking REST
+# calls still belong in the loop's executor, not on the loop. Frames are read one at a time and only
+# `websockets`' bounded queue (MAX_QUEUE frames) sits in front of processing, so a slow consumer
+# pushes back on the socket rather than growing an unbounded backlog.
+class AsyncBitMEXWebsocket(BitMEXWebsocket):
+
+    # Frames buffered ahead of processing before reading from the socket pauses.
+    MAX_QUEUE = 1024
+
+    # Seconds to wait for the connection to open and all the partials to arrive.
+    CONNECT_TIMEOUT = 30
+
+    def __init__(self):
+        if websockets is None:
+            raise ImportError("WS_CLIENT is 'asyncio' but the websockets package is not installed.")
+        super(AsyncBitMEXWebsocket, self).__init__()
+        self.loop = None
+        self.task = None
+
+    def connect(self, endpoint="", symbol="XBTN15", shouldAuth=True, symbols=None):
+        '''Start the event loop, connect and wait for all data images, like BitMEXWebsocket.connect.'''
+        self.logger.debug("Connecting WebSocket.")
+        self._prepare(endpoint, symbol, shouldAuth, symbols)
+
+        self.loop = asyncio.new_event_loop()
+        self.wst = threading.Thread(target=self.loop.run_forever)
+        self.wst.daemon = True
+        self.wst.start()
+
+        self.logger.info("Connecting to %s" % self.wsURL)
+        try:
+            self.run(self.__wait_for_images(), timeout=self.CONNECT_TIMEOUT)
+        except Exception as e:
+            self.logger.error("Couldn't connect to WS! Exiting. %s" % (self._error or e))
+            self.exit()
+            raise SystemExit(1)
+        # From here on a dropped connection is re-established in place, see __run.
+        self.synced = True
+        self.logger.info('Got all market data. Starting.')
+
+    def run(self, coroutine, timeout=None):
+        '''Run a coroutine on the websocket's event loop and wait for its result.'''
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def exit(self):
+        super(AsyncBitMEXWebsocket, self).exit()
+        if self.task is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.task.cancel)
+
+    #
+    # Private methods (these run on the event loop)
+    #
+    async def __wait_for_images(self):
+        self.task = asyncio.ensure_future(self.__run())
+        while not self.subscriptions <= self.ready_subscriptions:
+            if self.exited:
+                raise Exception("Connection closed.")
+            await asyncio.sleep(0.1)
+
+    async def __run(self):
+        '''Run the connection, and re-establish it in place whenever it drops.'''
+        while True:
+            try:
+                async with websockets.connect(self.wsURL, ping_interval=self.PING_INTERVAL,
+                                              ping_timeout=self.PING_TIMEOUT, max_queue=self.MAX_QUEUE,
+                                              max_size=None, compression=self.__compression(),
+                                              **self.__connect_args()) as sock:
+                    self.logger.debug("Websocket Opened (compression: %s)." % _negotiated(sock))
+                    wire_bytes = 0
+                    async for frame in sock:
+                        recv_ts = time.time()
+                        if hasattr(sock, 'wire_bytes'):
+                            self.ingest.add_wire_bytes(sock.wire_bytes - wire_bytes)
+                            wire_bytes = sock.wire_bytes
+                        recorder = self.recorder
+                        if recorder is not None:
+                            recorder.record(frame, recv_ts)
+                        self.feed(frame, recv_ts, _queued(sock))
+                self.logger.info('Websocket Closed')
+            except asyncio.CancelledError:
+                return  # exit()
+            except Exception as e:
+                if not self.synced and not self.exited:
+                    self.error(e)
+                    return
+                self.logger.warning("Websocket error: %s" % e)
+
+            delay = self._reconnect_delay()
+            if delay is None:
+                return
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                return
+            if self.exited:
+                return
+            self.reconnect_attempts += 1
+            self.logger.info("Reconnecting to WS (attempt %d)." % self.reconnect_attempts)
+
+    def __connect_args(self):
+        '''Fresh auth headers, and the byte counting connection, as this version of websockets wants them.'''
+        headers = [tuple(part.strip() for part in header.split(':', 1)) for header in self._get_auth()]
+        # websockets 14 renamed extra_headers with its new client
+        if int(websockets.__version__.split('.')[0]) >= 14:
+            return {'additional_headers': headers, 'create_connection': _CountingConnection}
+        return {'extra_headers': headers}
+
+    def __compression(self):
+        return 'deflate' if self.compression else None
+
+
+def _queued(sock):
+    '''Frames websockets has read and is holding for us, or None if this version doesn't tell.'''
+    frames = getattr(getattr(sock, 'recv_messages', None), 'frames', None)  # websockets >= 14 asyncio client
+    if frames is None:
+        frames = getattr(sock, 'messages', None)  # legacy client
+    return len(frames) if frames is not None else None
+
+
+def _negotiated(sock):
+    '''The extensions the server agreed to, e.g. 'permessage-deflate', or 'none'.'''
+    protocol = getattr(sock, 'protocol', None)
+    extensions = getattr(protocol, 'extensions', None) or getattr(sock, 'extensions', None) or []
+    return ', '.join(e.name for e in extensions) or 'none'
@@ -1,3 +1,4 @@
+import os
 import sys
 import websocket
 import threading
@@ -5,13 +6,28 @@ import traceback
 import ssl
 from time import sleep
 import json
+import time
 import decimal
 import logging
-from market_maker.settings import settings
-from market_maker.auth.APIKeyAuth import generate_expires, generate_signature
-from market_maker.utils.log import setup_custom_logger
-from market_maker.utils.math import toNearest
-from market_maker.utils import telegram_bot
+from types import MappingProxyType
+from collections import deque
+from tom_bot.settings import settings
+from tom_bot.auth.APIKeyAuth import generate_expires, generate_signature
+from tom_bot.utils.log import setup_custom_logger
+from tom_bot.utils.math import toNearestScaled
+from tom_bot.utils import telegram_bot
+from tom_bot.ws.table import Table, Partitioned
+from tom_bot.ws.ringbuffer import TradeBuffer, QuoteBuffer
+from tom_bot.ws.orderbook import OrderBook
+from tom_bot.ws.decode import get_decoder
+from tom_bot.ws.snapshot import Snapshot
+from tom_bot.ws.registry import OrderRegistry
+from tom_bot.ws.records import record_type
+from tom_bot.ws.feed import FeedRecorder
+from tom_bot.ws.fills import FillLedger
+from tom_bot.ws.archive import Archive
+from tom_bot.ws.stats import IngestStats, LAG_TABLES
+from tom_bot.utils.timestamps import iso_to_epoch
 from future.utils import iteritems
 from future.standard_library import hooks
 with hooks():  # Python 2/3 compat
@@ -31,56 +47,111 @@ class BitMEXWebsocket():
     # Don't grow a table larger than this amount. Helps cap memory usage.
     MAX_TABLE_LEN = 200
 
+    # Ping the server this often (seconds) so a connection that silently died is noticed, and dropped
+    # if no pong comes back within PING_TIMEOUT.
+    PING_INTERVAL = 15
+    PING_TIMEOUT = 10
+
     def __init__(self):
         self.logger = logging.getLogger('root')
+        self.ws = None
+        self.recorder = None
+        self.decode = get_decoder(settings.WS_DECODER or 'auto')
+        self.__handlers = {
+            'partial': self.__on_partial,
+            'insert': self.__on_insert,
+            'update': self.__on_update,
+            'delete': self.__on_delete,
+        }
+        # Held while a message changes a snapshot table, and while a reader builds a snapshot from them
+        self.__snapshot_lock = threading.Lock()
         self.__reset()
 
     def __del__(self):
         self.exit()
 
-    def connect(self, endpoint="", symbol="XBTN15", shouldAuth=True):
-        '''Connect to the websocket and initialize data stores.'''
+    def connect(self, endpoint="", symbol="XBTN15", shouldAuth=True, symbols=None):
+        '''Connect to the websocket and initialize data stores.
+
+        `symbol` is the default for the per-symbol data methods. Market and order data for any other
+        `symbols` comes down the same connection.
+        '''
 
         self.logger.debug("Connecting WebSocket.")
+        self._prepare(endpoint, symbol, shouldAuth, symbols)
+        self.logger.info("Connecting to %s" % self.wsURL)
+        self.__connect(self.wsURL)
+        self.logger.info('Connected to WS. Waiting for data images, this may take a moment...')
+
+        # Connected. Wait for partials
+        for s in self.symbols:
+            self.__wait_for_symbol(s)
+        if self.shouldAuth:
+            self.__wait_for_account()
+        # From here on a dropped connection is re-established in place, see __run.
+        self.synced = True
+        self.logger.info('Got all market data. Starting.')
+
+    def _prepare(self, endpoint, symbol, shouldAuth, symbols):
+        '''Work out the subscriptions and the URL to connect to, and start recording if asked to.'''
         self.symbol = symbol
+        self.symbols = [symbol] + [s for s in (symbols or []) if s != symbol]
         self.shouldAuth = shouldAuth
 
         # We can subscribe right in the connection querystring, so let's build that.
-        # Subscribe to all pertinent endpoints
-        subscriptions = [sub + ':' + symbol for sub in ["quote", "trade"]]
-        subscriptions += ["instrument"]  # We want all of them
+        # Subscribe to all pertinent endpoints, for every symbol we watch
+        self.quote_table = settings.WS_QUOTE_TABLE
+        subscriptions = self.__symbol_subscriptions(["trade"])
+        if self.quote_table:
+            subscriptions += self.__symbol_subscriptions([self.quote_table])
+        subscriptions += self.__instrument_subscriptions()
+        if settings.ORDERBOOK_TABLE:
+            subscriptions += self.__symbol_subscriptions([settings.ORDERBOOK_TABLE])
         if self.shouldAuth:
-            subscriptions += [sub + ':' + symbol for sub in ["order", "execution"]]
+            subscriptions += self.__symbol_subscriptions(["order", "execution"])
             subscriptions += ["margin", "position"]
 
+        # Connecting (or reconnecting) is complete once each of these has sent its image
+        self.subscriptions = frozenset(subscriptions)
+        # permessage-deflate, for clients that support it (websocket-client doesn't)
+        self.compression = settings.WS_COMPRESSION
+
+        if settings.WS_RECORD_FILE:
+            self.recorder = FeedRecorder(settings.WS_RECORD_FILE)
+            self.logger.info("Recording the websocket feed to %s" % settings.WS_RECORD_FILE)
+        if settings.WS_ARCHIVE_DIR:
+            for table, archive in self.archive.items():
+                archive.open(os.path.join(settings.WS_ARCHIVE_DIR, table + 's.jsonl.gz'))
+
         # Get WS URL and connect.
         urlParts = list(urlparse(endpoint))
         urlParts[0] = urlParts[0].replace('http', 'ws')
         urlParts[2] = "/realtime?subscribe=" + ",".join(subscriptions)
-        wsURL = urlunparse(urlParts)
-        self.logger.info("Connecting to %s" % wsURL)
-        self.__connect(wsURL)
-        self.logger.info('Connected to WS. Waiting for data images, this may take a moment...')
-
-        # Connected. Wait for partials
-        self.__wait_for_symbol(symbol)
-        if self.shouldAuth:
-            self.__wait_for_account()
-        self.logger.info('Got all market data. Starting.')
+        self.wsURL = urlunparse(urlParts)
 
     #
     # Data methods
     #
+    def stats(self):
+        '''Ingest stats (message counts, exchange-to-receive lag, decode and apply times per table and
+        action) since they were last logged, or since connecting. See ws.stats.IngestStats.snapshot.'''
+        return self.ingest.snapshot()
+
+    def snapshot(self):
+        '''Return an immutable Snapshot of instruments, positions, margin and orders as of one message.
+        Use it to read several of these consistently; the methods below each take a fresh one.
+
+        Snapshots are built when read: messages only mark the tables they change, and the first read after
+        that copies those tables (between two messages) into a new Snapshot. So the WS thread doesn't copy a
+        table per message, and a table that changes many times between reads is copied once.'''
+        if self.__changed:
+            with self.__snapshot_lock:
+                self.__publish_changed()
+        return self._snapshot
+
     def get_instrument(self, symbol):
-        instruments = self.data['instrument']
-        matchingInstruments = [i for i in instruments if i['symbol'] == symbol]
-        if len(matchingInstruments) == 0:
-            raise Exception("Unable to find instrument or index with symbol: " + symbol)
-        instrument = matchingInstruments[0]
-        # Turn the 'tickSize' into 'tickLog' for use in rounding
-        # http://stackoverflow.com/a/6190291/832202
-        instrument['tickLog'] = decimal.Decimal(str(instrument['tickSize'])).as_tuple().exponent * -1
-        return instrument
+        # Derived fields (tickLog etc.) are filled in as instrument messages arrive, see add_instrument_fields.
+        return self.snapshot().instrument(symbol)
 
     def get_ticker(self, symbol):
         '''Return a ticker object. Generated from instrument.'''
@@ -95,6 +166,12 @@ class BitMEXWebsocket():
         else:
             bid = instrument['bidPrice'] or instrument['lastPrice']
             ask = instrument['askPrice'] or instrument['lastPrice']
+            # Prefer the live top of book when we hold one
+            book = self.books.get(symbol)
+            if book is not None:
+                best_bid, best_ask = book.best_bid(), book.best_ask()
+                bid = best_bid[0] if best_bid else bid
+                ask = best_ask[0] if best_ask else ask
             ticker = {
                 "last": instrument['lastPrice'],
                 "buy": bid,
@@ -103,14 +180,17 @@ class BitMEXWebsocket():
             }
 
         # The instrument has a tickSize. Use it to round values.
-        return {k: toNearest(float(v or 0), instrument['tickSize']) for k, v in iteritems(ticker)}
+        return {k: toNearestScaled(float(v or 0), instrument['tickSize'], instrument['tickInt'], instrument['tickScale'])
+                for k, v in iteritems(ticker)}
 
     def funds(self):
-        return self.data['margin'][0]
+        return self.snapshot().funds()
 
     def market_depth(self, symbol):
-        raise NotImplementedError('orderBook is not subscribed; use askPrice and bidPrice on instrument')
-        # return self.data['orderBook25'][0]
+        '''Return the L2 OrderBook for a symbol (needs settings.ORDERBOOK_TABLE).'''
+        if symbol not in self.books:
+            raise NotImplementedError('orderBook is not subscribed; use askPrice and bidPrice on instrument')
+        return self.books[symbol]
 
     def open_orders_oldv0(self, clOrdIDPrefix):
         orders = self.data['order']
@@ -123,33 +203,80 @@ class BitMEXWebsocket():
         return [o for o in orders if o['leavesQty'] > 0]
 
     def open_orders(self, symbol):
-        orders = self.data['order']
         # Filter to only open orders (leavesQty > 0) and those that we actually placed in that symbol
-        return [o for o in orders if o['leavesQty'] > 0 and o['symbol']==symbol]
+        return self.snapshot().open_orders(symbol)
 
     def position(self, symbol):
-        positions = self.data['position']
-        pos = [p for p in positions if p['symbol'] == symbol]
-        if len(pos) == 0:
-            # No position found; stub it
-            return {'avgCostPrice': 0, 'avgEntryPrice': 0, 'currentQty': 0, 'symbol': symbol}
-        return pos[0]
-
-    def executed_orders(self):
-        exec_orders = self.data['execution']
+        return self.snapshot().position(symbol)
+
+    def executed_orders(self, symbol=None):
+        '''Executions in `symbol`, or in every symbol we watch if None.'''
+        executions = self.data['execution']
+        exec_orders = list(executions.part(symbol) if symbol is not None else executions)
         return exec_orders
 
     def all_orders(self):
-        orders = self.data['order']
+        orders = list(self.snapshot().orders)
         return orders
 
     def filled_orders(self):
-        orders = self.data['order']
-        # Filter to only filled orders (Filled = Triggered)
-        return [o for o in orders if o['ordStatus'] == 'Filled']
+        '''Orders filled since connecting (Filled = Triggered), oldest first: the last WS_ARCHIVE_LEN of them.'''
+        return list(self.filled)
+
+    def find_order(self, orderID):
+        '''An order by ID: open, or archived once it ended. None if it is unknown (or long gone).'''
+        for order in self.snapshot().orders:
+            if order['orderID'] == orderID:
+                return order
+        return self.archive['order'].get(orderID)
+
+    def find_execution(self, execID):
+        '''An execution by ID, from the execution table or the archive. None if it is unknown.'''
+        for execution in self.data.get('execution', ()):
+            if execution['execID'] == execID:
+                return execution
+        return self.archive['execution'].get(execID)
+
+    def recent_trades(self, symbol=None):
+        symbol = symbol or self.symbol
+        return [dict(row, symbol=symbol) for row in self.trades(symbol)]
+
+    def trades(self, symbol=None):
+        '''The trade buffer (see ringbuffer.TradeBuffer) of `symbol`, default the connected symbol.'''
+        return self.data['trade'].part(symbol or self.symbol)
+
+    def quotes(self, symbol=None):
+        '''The quote buffer (see ringbuffer.QuoteBuffer) of `symbol`, default the connected symbol.
+        With settings.WS_QUOTE_TABLE = 'quoteBin1m' etc., these are the quotes at the end of each bin.'''
+        return self.data[self.quote_table].part(symbol or self.symbol)
+
+    def trade_window(self, n=None, since=None, symbol=None):
+        '''Columns (timestamp, price, size, side) of the last n trades, or of the trades since an epoch time.
+        These are views into the trade buffer, not copies.'''
+        trades = self.trades(symbol)
+        return trades.since(since) if since is not None else trades.last(n)
+
+    def quote_window(self, n=None, since=None, symbol=None):
+        '''Columns (timestamp, bidPrice, bidSize, askPrice, askSize) of the last n quotes, or since an epoch time.'''
+        quotes = self.quotes(symbol)
+        return quotes.since(since) if since is not None else quotes.last(n)
 
-    def recent_trades(self):
-        return self.data['trade']
+    #
+    # Change notifications
+    #
+    def add_listener(self, callback, tables=None, symbols=None):
+        '''Call callback(table, action, rows) whenever a message for one of `tables` (all if None) touching
+        one of `symbols` (any if None) has been applied. Callbacks run on the websocket thread, after the
+        data is updated, so they should be quick (e.g. set an Event). Returns a handle for remove_listener.'''
+        listener = (callback,
+                    frozenset(tables) if tables is not None else None,
+                    frozenset(symbols) if symbols is not None else None)
+        # Swap in a new list so the WS thread never iterates one that is being changed
+        self.listeners = self.listeners + [listener]
+        return listener
+
+    def remove_listener(self, listener):
+        self.listeners = [l for l in self.listeners if l is not listener]
 
     #
     # Lifecycle methods
@@ -160,8 +287,23 @@ class BitMEXWebsocket():
         self.exit()
 
     def exit(self):
+        '''Close the connection for good. Only a connection closed here is not reconnected.'''
         self.exited = True
-        self.ws.close()
+        if self.ws is not None:
+            self.ws.close()
+        recorder, self.recorder = self.recorder, None
+        if recorder is not None:
+            recorder.close()
+        for archive in self.archive.values():
+            archive.close()
+
+    def feed(self, frame, recv_ts=None, queued=None):
+        '''Process a raw frame as if it had just come off the socket, e.g. one replayed from a recording
+        (see ws.feed). Works without connect(); fed frames aren't recorded.
+
+        recv_ts: when the frame was received (epoch seconds), for the lag stats. queued: how many frames
+        are buffered behind this one, if the caller buffers them.'''
+        self.__process(frame, recv_ts, queued)
 
     #
     # Private methods
@@ -171,18 +313,10 @@ class BitMEXWebsocket():
         '''Connect to the websocket in a thread.'''
         self.logger.debug("Starting thread")
 
-        ssl_defaults = ssl.get_default_verify_paths()
-        sslopt_ca_certs = {'ca_certs': ssl_defaults.cafile}
-        self.ws = websocket.WebSocketApp(wsURL,
-                                         on_message=self.__on_message,
-                                         on_close=self.__on_close,
-                                         on_open=self.__on_open,
-                                         on_error=self.__on_error,
-                                         header=self.__get_auth()
-                                         )
+        self.ws = self.__new_app(wsURL)
 
         setup_custom_logger('websocket', log_level=settings.LOG_LEVEL)
-        self.wst = threading.Thread(target=lambda: self.ws.run_forever(sslopt=sslopt_ca_certs))
+        self.wst = threading.Thread(target=self.__run)
         self.wst.daemon = True
         self.wst.start()
         self.logger.info("Started thread")
@@ -199,7 +333,91 @@ class BitMEXWebsocket():
             self.exit()
             sys.exit(1)
 
-    def __get_auth(self):
+    def __new_app(self, wsURL):
+        '''A WebSocketApp for wsURL. Auth headers expire, so every (re)connect gets fresh ones.'''
+        return websocket.WebSocketApp(wsURL,
+                                      on_message=self.__on_message,
+                                      on_close=self.__on_close,
+                                      on_open=self.__on_open,
+                                      on_error=self.__on_error,
+                                      header=self._get_auth()
+                                      )
+
+    def __run(self):
+        '''WS thread: run the connection, and re-establish it in place whenever it drops.'''
+        ssl_defaults = ssl.get_default_verify_paths()
+        sslopt_ca_certs = {'ca_certs': ssl_defaults.cafile}
+        while True:
+            self.ws.run_forever(sslopt=sslopt_ca_certs, ping_interval=self.PING_INTERVAL,
+                                ping_timeout=self.PING_TIMEOUT)
+            delay = self._reconnect_delay()
+            if delay is None:
+                return
+            sleep(delay)
+            if self.exited:
+                return
+            self.reconnect_attempts += 1
+            self.logger.info("Reconnecting to WS (attempt %d)." % self.reconnect_attempts)
+            self.ws = self.__new_app(self.wsURL)
+
+    def _reconnect_delay(self):
+        '''Called when the connection has closed. Returns how long to wait before reconnecting, or None
+        if we shouldn't.'''
+        if self.exited:
+            return None  # Closed by exit()
+        if not self.synced:
+            self.exit()  # Dropped before we ever got going; left to connect() as before
+            return None
+        if not self.resyncing:
+            self.logger.warning("Websocket connection dropped. Reconnecting.")
+            self.__begin_resync()
+        if self.reconnect_attempts >= settings.WS_RECONNECT_ATTEMPTS:
+            telegram_bot.telegram_bot_sendtext("Websocket couldn't reconnect, restarting.")
+            self.error("Unable to reconnect to WS after %d attempts." % self.reconnect_attempts)
+            return None
+        return min(settings.WS_RECONNECT_BACKOFF * 2 ** self.reconnect_attempts, settings.WS_RECONNECT_MAX_BACKOFF)
+
+    def __begin_resync(self):
+        '''Start building a fresh copy of every table from the partials the next connection sends.
+
+        Until all of them are in, readers keep seeing the state from before the drop (it stops updating
+        and `resyncing` is set); __finish_resync then swaps the new tables in at once.
+        '''
+        with self.__snapshot_lock:
+            # What arrived before the drop is still published
+            self.__publish_changed()
+        self.resyncing = True
+        self.dropped_at = time.time()
+        self.reconnect_attempts = 0
+        self.__tables = {}
+        self.__books = {}
+        self.keys = {}
+        self.instruments = {}
+        self.book_backlog = {}
+        self.resynced = {}  # subscription -> (table, rows of its new partial)
+
+    def __finish_resync(self):
+        '''Swap the rebuilt tables in for readers, publish them in one snapshot and tell listeners.'''
+        # Orders and executions the new images don't have anymore (e.g. orders that ended during the gap)
+        for table in self.archive:
+            old, new = self.data.get(table), self.__tables.get(table)
+            if old is not None and new is not None:
+                self.__archive(table, [row for row in old if new.find(row) is None])
+        with self.__snapshot_lock:
+            self.data = self.__tables
+            self.books = self.__books
+            self.__changed = set()
+            self._snapshot = self._snapshot.evolve(**self.__snapshot_parts(SNAPSHOT_TABLES & set(self.__tables)))
+        self.ready_subscriptions = set(self.resynced)
+        self.resyncing = False
+        self.last_gap = time.time() - self.dropped_at
+        self.logger.warning("Websocket reconnected and resynced after a %.1fs gap (%d attempts)." %
+                            (self.last_gap, self.reconnect_attempts))
+        resynced, self.resynced = self.resynced, {}
+        for table, rows in resynced.values():
+            self.__notify(table, 'partial', rows)
+
+    def _get_auth(self):
         '''Return auth headers. Will use API Keys if present in settings.'''
 
         if self.shouldAuth is False:
@@ -218,29 +436,92 @@ class BitMEXWebsocket():
     def __wait_for_account(self):
         '''On subscribe, this data will come down. Wait for it.'''
         # Wait for the keys to show up from the ws
-        while not {'margin', 'position', 'order'} <= set(self.data):
+        account = {'margin', 'position'} | {'order:' + s for s in self.symbols}
+        while not account <= self.ready_subscriptions:
             sleep(0.1)
 
     def __wait_for_symbol(self, symbol):
         '''On subscribe, this data will come down. Wait for it.'''
-        while not {'instrument', 'trade', 'quote'} <= set(self.data):
+        needed = {'trade:' + symbol}
+        needed.add('instrument' if settings.WS_INSTRUMENTS == 'all' else 'instrument:' + symbol)
+        if self.quote_table:
+            needed.add(self.quote_table + ':' + symbol)
+        while not needed <= self.ready_subscriptions:
             sleep(0.1)
 
+    def __symbol_subscriptions(self, tables):
+        return [table + ':' + s for s in self.symbols for table in tables]
+
+    def __instrument_subscriptions(self):
+        '''Instrument updates for the symbols we watch (and any extra ones asked for), or all of them.'''
+        if settings.WS_INSTRUMENTS == 'all':
+            return ['instrument']
+        extra = [s for s in (settings.WS_INSTRUMENTS or []) if s not in self.symbols]
+        return ['instrument:' + s for s in self.symbols + extra]
+
     def __send_command(self, command, args):
         '''Send a raw command.'''
         self.ws.send(json.dumps({"op": command, "args": args or []}))
 
     def __on_message(self, message):
-        '''Handler for parsing WS messages.'''
-        message = json.loads(message)
-        self.logger.debug(json.dumps(message))
-
-        table = message['table'] if 'table' in message else None
-        action = message['action'] if 'action' in message else None
+        '''Handler for WS messages.'''
+        recv_ts = time.time()
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.record(message, recv_ts)
+        self.__process(message, recv_ts)
+
+    def __process(self, frame, recv_ts=None, queued=None):
+        '''Parse a raw WS message and apply it.'''
+        started = time.perf_counter()
+        message = self.decode(frame)
+        decoded = time.perf_counter()
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(json.dumps(message))
+
+        table = message.get('table')
+        action = message.get('action')
         try:
-            if 'subscribe' in message:
+            if action:
+                if table in BOOK_TABLES:
+                    self.__apply_book(action, message['data'])
+                else:
+                    # There are four possible actions from the WS:
+                    # 'partial' - full table image
+                    # 'insert'  - new row
+                    # 'update'  - update row
+                    # 'delete'  - delete row
+                    handler = self.__handlers.get(action)
+                    if handler is None:
+                        raise Exception("Unknown action: %s" % action)
+                    if table not in self.__tables:
+                        self.__tables[table] = self.__new_table(table)
+                    if table in SNAPSHOT_TABLES:
+                        # Readers build snapshots from these tables (see snapshot()), never halfway through a message
+                        with self.__snapshot_lock:
+                            handler(table, message)
+                            if not self.resyncing:
+                                self.__changed.add(table)
+                    else:
+                        handler(table, message)
+                self.__record(table, action, message['data'], len(frame), decoded - started,
+                              time.perf_counter() - decoded, recv_ts, queued)
+
+                if self.resyncing:
+                    # Readers don't see the rebuilt tables (or hear about them) until they are all in
+                    if action == 'partial':
+                        self.resynced[subscription_of(message)] = (table, message['data'])
+                        if self.subscriptions <= set(self.resynced):
+                            self.__finish_resync()
+                    return
+                if action == 'partial':
+                    # Only now is the table's image in place (and published) for readers
+                    self.ready_subscriptions.add(subscription_of(message))
+
+                self.__notify(table, action, message['data'])
+            elif 'subscribe' in message:
                 if message['success']:
-                    self.logger.debug("Subscribed to %s." % message['subscribe'])
+                    self.logger.debug("Subscribed to %s.", message['subscribe'])
                 else:
                     self.error("Unable to subscribe to %s. Error: \"%s\" Please check and restart." %
                                (message['request']['args'][0], message['error']))
@@ -249,94 +530,283 @@ class BitMEXWebsocket():
                     self.error(message['error'])
                 if message['status'] == 401:
                     self.error("API Key incorrect, please check and restart.")
-            elif action:
-
-                if table not in self.data:
-                    self.data[table] = []
-
-                if table not in self.keys:
-                    self.keys[table] = []
-
-                # There are four possible actions from the WS:
-                # 'partial' - full table image
-                # 'insert'  - new row
-                # 'update'  - update row
-                # 'delete'  - delete row
-                if action == 'partial':
-                    self.logger.debug("%s: partial" % table)
-                    self.data[table] += message['data']
-                    # Keys are communicated on partials to let you know how to uniquely identify
-                    # an item. We use it for updates.
-                    self.keys[table] = message['keys']
-                elif action == 'insert':
-                    self.logger.debug('%s: inserting %s' % (table, message['data']))
-                    self.data[table] += message['data']
-
-                    # Limit the max length of the table to avoid excessive memory usage.
-                    # Don't trim orders because we'll lose valuable state if we do.
-                    if table not in ['order', 'orderBookL2'] and len(self.data[table]) > BitMEXWebsocket.MAX_TABLE_LEN:
-                        self.data[table] = self.data[table][(BitMEXWebsocket.MAX_TABLE_LEN // 2):]
-
-                elif action == 'update':
-                    self.logger.debug('%s: updating %s' % (table, message['data']))
-                    # Locate the item in the collection and update it.
-                    for updateData in message['data']:
-                        item = findItemByKeys(self.keys[table], self.data[table], updateData)
-                        if not item:
-                            continue  # No item found to update. Could happen before push
-
-                        # Log executions
-                        if table == 'order':
-                            is_canceled = 'ordStatus' in updateData and updateData['ordStatus'] == 'Canceled'
-                            if 'cumQty' in updateData and not is_canceled:
-                                contExecuted = updateData['cumQty'] - item['cumQty']
-                                if contExecuted > 0:
-                                    instrument = self.get_instrument(item['symbol'])
-                                    if item['ordType'] == 'Stop':
-                                        price_text = 'stopPx'
-                                    else:
-                                        price_text = 'price'
-                                    print(f"side {item['side']} 'contExec {contExecuted} symbol {item['symbol']} ticklog {instrument['tickLog']} price {item['price']} ordtype {item['ordType']}")
-                                    self.logger.info("Execution: %s %d Contracts of %s at %.*f" %
-                                             (item['side'], contExecuted, item['symbol'],
-                                              instrument['tickLog'], item[price_text]))
-
-                        # Update this item.
-                        item.update(updateData)
-
-                        # Remove canceled / filled orders
-                        if table == 'order' and item['leavesQty'] <= 0:
-                            self.data[table].remove(item)
-
-                elif action == 'delete':
-                    self.logger.debug('%s: deleting %s' % (table, message['data']))
-                    # Locate the item in the collection and remove it.
-                    for deleteData in message['data']:
-                        item = findItemByKeys(self.keys[table], self.data[table], deleteData)
-                        self.data[table].remove(item)
-                else:
-                    raise Exception("Unknown action: %s" % action)
         except:
             self.logger.error(traceback.format_exc())
 
+    def __record(self, table, action, rows, nbytes, decode_s, apply_s, recv_ts, queued):
+        '''Add a message to the ingest stats, and log them every WS_STATS_INTERVAL seconds.'''
+        lag_s = None
+        # A partial is an image of the table, not news: its timestamps can be old
+        if recv_ts is not None and table in LAG_TABLES and action != 'partial' and rows:
+            ts = rows[-1].get('timestamp')
+            if ts is not None:
+                lag_s = recv_ts - iso_to_epoch(ts)
+        self.ingest.record(table, action, nbytes, decode_s, apply_s, lag_s, queued)
+        if settings.WS_STATS_INTERVAL and time.time() - self.ingest.since >= settings.WS_STATS_INTERVAL:
+            ingest, self.ingest = self.ingest, IngestStats()
+            self.logger.info(ingest.format())
+
+    # Debug log arguments below are passed to the logger rather than %-formatted, so the (large)
+    # row payloads are only turned into strings when DEBUG logging is actually on.
+
+    def __on_partial(self, table, message):
+        self.logger.debug("%s: partial", table)
+        # Keys are communicated on partials to let you know how to uniquely identify
+        # an item. The table indexes its rows by them for updates and deletes.
+        rows = self.__tables[table].partial(message['data'], message['keys'])
+        self.keys[table] = message['keys']
+        if table == 'instrument':
+            self.__index_instruments(rows)
+        elif table == 'execution':
+            self.fills.add(message['data'])
+        elif table == 'order':
+            self.__retire_orders(rows)
+
+    def __on_insert(self, table, message):
+        self.logger.debug('%s: inserting %s', table, message['data'])
+        rows = self.__tables[table].insert(message['data'])
+        if table == 'instrument':
+            self.__index_instruments(rows)
+        elif table == 'execution':
+            self.fills.add(message['data'])
+
+        # Limit the max length of the table to avoid excessive memory usage.
+        # Orders aren't trimmed: live ones are state we need, and terminal ones are moved to the archive.
+        # Trimmed executions are archived too. (Trade and quote buffers have a fixed capacity.)
+        if table == 'order':
+            self.__retire_orders(rows)
+        else:
+            dropped = self.__tables[table].trim(BitMEXWebsocket.MAX_TABLE_LEN)
+            if dropped and table in self.archive:
+                self.__archive(table, dropped)
+
+    def __on_update(self, table, message):
+        self.logger.debug('%s: updating %s', table, message['data'])
+        # Locate the item in the collection and update it.
+        for updateData in message['data']:
+            item = self.__tables[table].find(updateData)
+            if item is None:
+                continue  # No item found to update. Could happen before push
+
+            # Log executions
+            if table == 'order':
+                is_canceled = 'ordStatus' in updateData and updateData['ordStatus'] == 'Canceled'
+                if 'cumQty' in updateData and not is_canceled:
+                    contExecuted = updateData['cumQty'] - item['cumQty']
+                    if contExecuted > 0:
+                        # The WS thread's own instrument map: a snapshot can't be built halfway through a message
+                        instrument = self.instruments[item['symbol']]
+                        if item['ordType'] == 'Stop':
+                            price_text = 'stopPx'
+                        else:
+                            price_text = 'price'
+                        self.logger.debug("Execution of %s %s order %s: %s filled at %s", item['ordType'],
+                                          item['side'], item['orderID'], contExecuted, item[price_text])
+                        self.logger.info("Execution: %s %d Contracts of %s at %.*f" %
+                                 (item['side'], contExecuted, item['symbol'],
+                                  instrument['tickLog'], item[price_text]))
+
+            # Update this item. Snapshot tables hand back an updated copy; published rows never change.
+            item = self.__tables[table].update(updateData)
+
+            if table == 'instrument':
+                # Only recompute derived instrument fields if what they derive from changed
+                if not INSTRUMENT_DERIVED_FROM.isdisjoint(updateData):
+                    add_instrument_fields(item)
+                self.instruments[item['symbol']] = item
+
+            # Move canceled / filled orders to the archive
+            if table == 'order' and item['leavesQty'] <= 0:
+                self.__tables[table].delete(item)
+                self.__archive('order', [item])
+
+    def __on_delete(self, table, message):
+        self.logger.debug('%s: deleting %s', table, message['data'])
+        # Locate the item in the collection and remove it.
+        for deleteData in message['data']:
+            item = self.__tables[table].delete(deleteData)
+            if table == 'instrument' and item is not None:
+                self.instruments.pop(item['symbol'], None)
+            elif table in self.archive and item is not None:
+                self.__archive(table, [item])
+
+    def __retire_orders(self, rows):
+        '''Move orders that arrived already terminal (leavesQty 0) straight to the archive.'''
+        done = [row for row in rows if row['leavesQty'] <= 0]
+        for row in done:
+            self.__tables['order'].delete(row)
+        if done:
+            self.__archive('order', done)
+
+    def __archive(self, table, rows):
+        '''Move rows that left `table` to its archive; keep filled orders at hand for filled_orders().'''
+        self.archive[table].add(rows)
+        if table == 'order':
+            self.filled.extend(row for row in rows if row['ordStatus'] == 'Filled')
+
+    def __publish_changed(self):
+        '''Publish a new Snapshot with the current state of the tables changed since the last one; the other
+        parts are shared. Call with the snapshot lock held.'''
+        if self.__changed:
+            changed, self.__changed = self.__changed, set()
+            # A single reference assignment: readers see either the old snapshot or the new one
+            self._snapshot = self._snapshot.evolve(**self.__snapshot_parts(changed))
+
+    def __snapshot_parts(self, tables):
+        '''The Snapshot parts holding the current state of each of `tables`.'''
+        parts = {}
+        for table in tables:
+            if table == 'instrument':
+                parts['instruments'] = MappingProxyType(dict(self.instruments))
+            elif table == 'position':
+                parts['positions'] = MappingProxyType({p['symbol']: p for p in self.__tables['position']})
+            elif table == 'margin':
+                parts['margin'] = tuple(self.__tables['margin'])
+            else:
+                orders = parts['orders'] = tuple(self.__tables['order'])
+                parts['registry'] = OrderRegistry(orders)
+        return parts
+
+    def __notify(self, table, action, rows):
+        '''Tell change listeners about a message that has just been applied. Runs on the WS thread.'''
+        for listener in self.listeners:
+            callback, tables, symbols = listener
+            if tables is not None and table not in tables:
+                continue
+            if symbols is not None and not any(row.get('symbol') in symbols for row in rows):
+                continue
+            try:
+                callback(table, action, rows)
+            except Exception:
+                self.logger.error("Change listener failed: %s" % traceback.format_exc())
+
+    def __new_table(self, table):
+        '''Trades and quotes go to fixed-size columnar buffers, one per symbol; everything else to a keyed Table,
+        with order, position, margin and instrument rows as compact records (see ws.records).'''
+        if table == 'trade':
+            return Partitioned(lambda: TradeBuffer(settings.TRADE_BUFFER_LEN))
+        if table == 'quote' or table.startswith('quoteBin'):
+            return Partitioned(lambda: QuoteBuffer(settings.QUOTE_BUFFER_LEN))
+        if table == 'execution':
+            return Partitioned(Table)
+        record = None
+        if settings.WS_COMPACT_ROWS:
+            record = record_type(table, (settings.WS_ROW_FIELDS or {}).get(table, ()))
+        return Table(copy_on_write=table in SNAPSHOT_TABLES, record=record)
+
+    def __index_instruments(self, instruments):
+        '''Keep the symbol -> instrument map current and precompute derived fields once per row.'''
+        for instrument in instruments:
+            add_instrument_fields(instrument)
+            self.instruments[instrument['symbol']] = instrument
+            # Book data that arrived before its instrument can be applied now that we know the tick size
+            for action, rows in self.book_backlog.pop(instrument['symbol'], []):
+                self.__apply_book(action, rows)
+
+    def __apply_book(self, action, rows):
+        '''Apply an orderBookL2 message to the per-symbol books.'''
+        bySymbol = {}
+        for row in rows:
+            bySymbol.setdefault(row['symbol'], []).append(row)
+        for symbol, symbolRows in iteritems(bySymbol):
+            book = self.__books.get(symbol)
+            if book is None:
+                instrument = self.instruments.get(symbol)
+                if instrument is None:
+                    # Prices are indexed in ticks, so hold on to this until the instrument shows up.
+                    self.book_backlog.setdefault(symbol, []).append((action, symbolRows))
+                    continue
+                book = self.__books[symbol] = OrderBook(symbol, instrument['tickSize'])
+            book.apply(action, symbolRows)
+
     def __on_open(self):
         self.logger.debug("Websocket Opened.")
 
     def __on_close(self):
+        # A close we didn't ask for is reconnected from __run, once run_forever returns.
         self.logger.info('Websocket Closed')
-        self.exit()
 
     def __on_error(self, error):
-        if not self.exited:
+        if self.exited:
+            return
+        if self.synced:
+            # Network trouble once running: the connection closes and is re-established.
+            self.logger.warning("Websocket error: %s" % error)
+        else:
             self.error(error)
 
     def __reset(self):
-        self.data = {}
+        # data and books are what readers see; __tables and __books are what the WS thread writes to.
+        # They are the same dicts, except while resyncing after a reconnect.
+        self.data = self.__tables = {}
         self.keys = {}
+        self.subscriptions = frozenset()
+        self.quote_table = 'quote'
+        self.ready_subscriptions = set()
+        self.instruments = {}
+        self._snapshot = Snapshot()
+        self.__changed = set()  # snapshot tables changed since the last snapshot was built
+        # Not rebuilt on resync: fills repeated by the new execution partial are recognised by execID
+        self.fills = FillLedger()
+        # Terminal orders and trimmed executions, by orderID / execID
+        self.archive = {'order': Archive('orderID', settings.WS_ARCHIVE_LEN),
+                        'execution': Archive('execID', settings.WS_ARCHIVE_LEN)}
+        self.filled = deque(maxlen=settings.WS_ARCHIVE_LEN)  # filled orders, also in the order archive
+        self.ingest = IngestStats()
+        self.books = self.__books = {}
+        self.book_backlog = {}
+        self.listeners = []
         self.exited = False
         self._error = None
+        self.synced = False
+        self.resyncing = False
+        self.reconnect_attempts = 0
+        self.last_gap = None  # Seconds without data during the last reconnect
+
+
+# L2 book tables; these are kept in OrderBooks rather than row tables.
+BOOK_TABLES = frozenset(['orderBookL2', 'orderBookL2_25'])
+
+# Tables published to the trading thread through snapshots.
+SNAPSHOT_TABLES = frozenset(['instrument', 'position', 'margin', 'order'])
+
+# Instrument fields the derived fields below are computed from.
+INSTRUMENT_DERIVED_FROM = frozenset(['tickSize', 'multiplier', 'underlyingToSettleMultiplier',
+                                     'quoteToSettleMultiplier'])
+
+
+def subscription_of(message):
+    '''The subscription a partial answers, e.g. 'trade:XBTUSD' or 'margin'. Symbol-filtered
+    subscriptions name their symbol in the partial's filter.'''
+    symbol = (message.get('filter') or {}).get('symbol')
+    return message['table'] + ':' + symbol if symbol else message['table']
+
+
+def add_instrument_fields(instrument):
+    '''Add fields derived from an instrument's static properties, so readers don't recompute them.
+
+    tickLog:            decimals in tickSize, for use in rounding and printing.
+    tickScale/tickInt:  tickSize as an integer number of 10^-tickLog units (0.5 -> 5 / 10).
+    settleMultiplier:   contract multiplier expressed in the settlement currency.
+    '''
+    tickSize = instrument.get('tickSize')
+    if tickSize:
+        # Turn the 'tickSize' into 'tickLog' for use in rounding
+        # http://stackoverflow.com/a/6190291/832202
+        tickLog = max(decimal.Decimal(str(tickSize)).as_tuple().exponent * -1, 0)
+        instrument['tickLog'] = tickLog
+        instrument['tickScale'] = 10 ** tickLog
+        instrument['tickInt'] = int(round(tickSize * instrument['tickScale']))
+
+    if instrument.get('multiplier') is not None:
+        divisor = instrument.get('underlyingToSettleMultiplier')
+        if divisor is None:
+            divisor = instrument.get('quoteToSettleMultiplier')
+        # None when the instrument has neither divisor (or a zero one); readers skip such instruments.
+        instrument['settleMultiplier'] = float(instrument['multiplier']) / float(divisor) if divisor else None
 
 
+# Linear scan kept for callers holding plain lists of rows; the websocket tables use Table.find.
 def findItemByKeys(keys, table, matchData):
     for item in table:
         matched = True